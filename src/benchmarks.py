@@ -0,0 +1,720 @@
+# Micro-benchmarks for hot paths in the client.
+#
+# Run from the project directory with e.g.:
+#
+#   python src/benchmarks.py framing
+
+import argparse
+import collections
+import io
+import logging
+import os
+import random
+import shutil
+import tempfile
+import time
+import types
+from typing import List, Tuple
+
+import bitarray
+import h11
+import trio
+import trio.testing
+
+import bencode
+import config
+import file_manager
+import http_stream
+import messages
+import peer_connection
+import storage
+import tracker
+import udp_tracker_server
+from rate_meter import RateMeter
+from token_bucket import TokenBucket
+from torrent import Torrent, TrackerUrl
+
+logger = logging.getLogger("benchmarks")
+
+
+def _report(name, num_bytes, seconds):
+    print(
+        "{:<30} {:>10.1f} MB/s  ({} bytes in {:.3f}s)".format(
+            name, num_bytes / seconds / 1024 ** 2, num_bytes, seconds
+        )
+    )
+
+
+# ----- framing ---------------------------------------------------------------
+
+
+class _ChunkedStream(object):
+    """
+    Stand-in for a trio stream that returns pre-generated data in chunks.
+    """
+
+    def __init__(self, data: bytes, chunk_size: int) -> None:
+        self._data = data
+        self._chunk_size = chunk_size
+        self._pos = 0
+
+    async def receive_some(self, max_bytes):
+        n = min(max_bytes, self._chunk_size)
+        chunk = self._data[self._pos : self._pos + n]
+        self._pos += n
+        return chunk
+
+
+class _LegacyPeerStream(object):
+    """
+    The framing used before PeerStream had a ReceiveBuffer, kept to
+    compare against.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._msg_data = b""
+
+    def _parse_msg_data(self) -> List[Tuple[int, bytes]]:
+        messages: List[Tuple[int, bytes]] = []
+        while True:
+            total_length = len(self._msg_data)
+            if total_length < 4:
+                return messages
+            msg_length = int.from_bytes(self._msg_data[:4], byteorder="big")
+            if total_length < 4 + msg_length:
+                return messages
+            messages.append((msg_length, self._msg_data[4 : 4 + msg_length]))
+            self._msg_data = self._msg_data[4 + msg_length :]
+            logger.debug("Parsed message of length {} from {}".format(msg_length, self._stream))
+
+    async def receive_message(self) -> List[Tuple[int, bytes]]:
+        while True:
+            messages = self._parse_msg_data()
+            if messages:
+                return messages
+            data = await self._stream.receive_some(config.STREAM_CHUNK_SIZE)
+            if data == b"":
+                raise Exception("EOF")
+            logger.debug("received_message: Got {} from {}".format(len(data), self._stream))
+            self._msg_data += data
+
+
+def _piece_frames(num_blocks: int, block_size: int) -> bytes:
+    block = os.urandom(block_size)
+    frames = []
+    for i in range(num_blocks):
+        msg = bytes([messages.PeerMsg.PIECE])
+        msg += (i // 16).to_bytes(4, byteorder="big")
+        msg += ((i % 16) * block_size).to_bytes(4, byteorder="big")
+        msg += block
+        frames.append(len(msg).to_bytes(4, byteorder="big") + msg)
+    return b"".join(frames)
+
+
+def _time_framing(make_stream, data: bytes) -> float:
+    async def parse_all():
+        peer_stream = make_stream()
+        parsed = 0
+        while parsed < len(data):
+            for length, msg in await peer_stream.receive_message():
+                _index, _begin, block = messages.parse_piece(msg[1:])
+                parsed += 4 + length
+        return parsed
+
+    start = time.perf_counter()
+    trio.run(parse_all)
+    return time.perf_counter() - start
+
+
+def framing(args):
+    data = _piece_frames(args.blocks, args.block_size)
+    print(
+        "Parsing {} PIECE frames of {} bytes, received in {} byte chunks".format(
+            args.blocks, args.block_size, args.chunk_size
+        )
+    )
+    for name, make_stream in [
+        ("before (bytes +=)", lambda: _LegacyPeerStream(_ChunkedStream(data, args.chunk_size))),
+        (
+            "after (ReceiveBuffer)",
+            lambda: peer_connection.PeerStream(_ChunkedStream(data, args.chunk_size)),
+        ),
+    ]:
+        _report(name, len(data), _time_framing(make_stream, data))
+
+
+# ----- sending ---------------------------------------------------------------
+
+
+class _CountingStream(object):
+    """
+    Stand-in for a trio stream that only counts what is sent to it.
+    """
+
+    def __init__(self) -> None:
+        self.writes = 0
+        self.bytes_sent = 0
+
+    async def send_all(self, data):
+        self.writes += 1
+        self.bytes_sent += len(data)
+
+
+class _FakeTorrent(object):
+    def __init__(self):
+        self._complete = bitarray.bitarray(8)
+        self._complete.setall(False)
+
+
+class _LegacyTokenBucket(object):
+    """
+    The token bucket used before TokenBucket was event driven: senders
+    poll it and a loop refills it 10 times a second.
+    """
+
+    def __init__(self, bytes_per_second, updates_per_second=10):
+        self.bucket = 0
+        self.max_size_in_bytes = 2 * bytes_per_second
+        self.bytes_per_second = bytes_per_second
+        self.updates_per_second = updates_per_second
+
+    @property
+    def update_period(self):
+        return 1.0 / self.updates_per_second
+
+    def check_and_decrement(self, packet_size):
+        if self.bucket >= packet_size:
+            self.bucket -= packet_size
+            return True
+        else:
+            return False
+
+    async def loop(self):
+        while True:
+            await trio.sleep(self.update_period)
+            increment = self.bytes_per_second / self.updates_per_second
+            self.bucket = min(self.bucket + increment, self.max_size_in_bytes)
+
+
+async def _legacy_send_requests(stream, token_bucket, requests):
+    # REQUEST sending as it was done before sending_loop batched writes
+    for index, begin, length in requests:
+        raw_msg = bytes([messages.PeerMsg.REQUEST])
+        raw_msg += (index).to_bytes(4, byteorder="big")
+        raw_msg += (begin).to_bytes(4, byteorder="big")
+        raw_msg += (length).to_bytes(4, byteorder="big")
+        data = len(raw_msg).to_bytes(4, byteorder="big") + raw_msg
+        while not token_bucket.check_and_decrement(len(data)):
+            await trio.sleep(token_bucket.update_period)
+        await stream.send_all(data)
+
+
+def _time_sending(batches: List[List[Tuple[int, int, int]]], legacy: bool):
+    stream = _CountingStream()
+    legacy_bucket = _LegacyTokenBucket(1024 ** 3)
+    legacy_bucket.bucket = legacy_bucket.max_size_in_bytes
+    engine = types.SimpleNamespace(
+        _state=_FakeTorrent(),
+        token_bucket=TokenBucket(None),
+        download_token_bucket=TokenBucket(None),
+        upload_meter=RateMeter(),
+        download_meter=RateMeter(),
+    )
+    peer_engine = peer_connection.PeerEngine(
+        engine, None, None, stream, send_peer_msg_to_engine=None
+    )
+    outgoing_send, outgoing_receive = trio.open_memory_channel(len(batches))
+    peer_engine._peer_id_and_state = (b"benchmark", None)
+    peer_engine._receive_outgoing_data = outgoing_receive
+    expected_bytes = sum(17 * len(b) for b in batches)
+
+    async def send_all_batches():
+        if legacy:
+            for b in batches:
+                await _legacy_send_requests(stream, legacy_bucket, b)
+            return
+        for b in batches:
+            outgoing_send.send_nowait(("blocks_to_request", b))
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(peer_engine.sending_loop)
+            while stream.bytes_sent < expected_bytes:
+                await trio.sleep(0)
+            nursery.cancel_scope.cancel()
+
+    start = time.perf_counter()
+    trio.run(send_all_batches)
+    return time.perf_counter() - start, stream.writes
+
+
+def sending(args):
+    batches = [
+        [(i, j * config.BLOCK_SIZE, config.BLOCK_SIZE) for j in range(args.requests_per_batch)]
+        for i in range(args.batches)
+    ]
+    num_requests = args.batches * args.requests_per_batch
+    print(
+        "Sending {} batches of {} REQUESTs through PeerEngine".format(
+            args.batches, args.requests_per_batch
+        )
+    )
+    for name, legacy in [("before (one write each)", True), ("after (batched)", False)]:
+        seconds, writes = _time_sending(batches, legacy)
+        print(
+            "{:<30} {:>8.2f} us/request  {:>8} writes ({:.2f} per request)".format(
+                name, seconds / num_requests * 1e6, writes, writes / num_requests
+            )
+        )
+
+
+# ----- rate limit ------------------------------------------------------------
+
+
+def _jain_index(values) -> float:
+    # 1.0 when every value is the same, 1/n when one sender gets everything
+    total = sum(values)
+    squares = sum(v * v for v in values)
+    return total * total / (len(values) * squares) if squares else 1.0
+
+
+def _time_rate_limit(args, legacy: bool):
+    # senders of small (REQUEST sized) and large (PIECE sized) messages
+    # share one limit, on trio's mock clock so the result is repeatable
+    sizes = [17] * args.small_senders + [config.BLOCK_SIZE + 13] * args.large_senders
+    sent = [0] * len(sizes)
+    max_wait = [0.0] * len(sizes)
+    wakeups = 0
+    limit = args.limit_kb * 1024
+
+    async def send_forever(i, take):
+        while True:
+            start = trio.current_time()
+            await take(sizes[i])
+            max_wait[i] = max(max_wait[i], trio.current_time() - start)
+            sent[i] += sizes[i]
+            await trio.sleep(0)  # stands in for send_all
+
+    async def run_senders():
+        nonlocal wakeups
+        async with trio.open_nursery() as nursery:
+            if legacy:
+                bucket = _LegacyTokenBucket(limit)
+
+                async def take(n):
+                    nonlocal wakeups
+                    while not bucket.check_and_decrement(n):
+                        wakeups += 1
+                        await trio.sleep(bucket.update_period)
+
+                nursery.start_soon(bucket.loop)
+            else:
+                global_bucket = TokenBucket(limit)
+                peer_buckets = [TokenBucket(None, parent=global_bucket) for _ in sizes]
+
+            for i in range(len(sizes)):
+                nursery.start_soon(send_forever, i, take if legacy else peer_buckets[i].take)
+            await trio.sleep(args.seconds)
+            if not legacy:
+                wakeups = global_bucket.waits
+            nursery.cancel_scope.cancel()
+
+    trio.run(run_senders, clock=trio.testing.MockClock(autojump_threshold=0))
+    large = range(args.small_senders, len(sizes))
+    return {
+        "rate": sum(sent) / args.seconds / limit,
+        "large_fairness": _jain_index([sent[i] for i in large]),
+        "all_fairness": _jain_index([sent[i] / sizes[i] for i in range(len(sizes))]),
+        "large_max_wait": max(max_wait[i] for i in large),
+        "wakeups": wakeups,
+        "messages": sum(sent[i] // sizes[i] for i in range(len(sizes))),
+    }
+
+
+def rate_limit(args):
+    print(
+        "{} small and {} large senders sharing {} KB/s for {} seconds (mock clock)".format(
+            args.small_senders, args.large_senders, args.limit_kb, args.seconds
+        )
+    )
+    for name, legacy in [("before (polling)", True), ("after (FIFO waiters)", False)]:
+        r = _time_rate_limit(args, legacy)
+        print(
+            "{:<22} {:>5.1%} of limit  fairness: {:.3f} (large, bytes) {:.3f} "
+            "(all, messages)  max PIECE wait {:.2f}s  {} wakeups for {} messages".format(
+                name,
+                r["rate"],
+                r["large_fairness"],
+                r["all_fairness"],
+                r["large_max_wait"],
+                r["wakeups"],
+                r["messages"],
+            )
+        )
+
+
+# ----- bencode ---------------------------------------------------------------
+
+
+def _legacy_parse_value(s: io.BytesIO):
+    # the stream decoder used before bencode.decode, reading a byte at a time
+    c = s.read(1)
+    if c.isdigit():
+        while True:
+            d = s.read(1)
+            if d == b":":
+                return s.read(int(c))
+            c += d
+    elif c == b"i":
+        i = b""
+        c = s.read(1)
+        while c != b"e":
+            i += c
+            c = s.read(1)
+        return int(i)
+    elif c == b"l":
+        l = []
+        v = _legacy_parse_value(s)
+        while v is not None:
+            l.append(v)
+            v = _legacy_parse_value(s)
+        return l
+    elif c == b"d":
+        d = collections.OrderedDict()
+        k = _legacy_parse_value(s)
+        while k is not None:
+            d[k] = _legacy_parse_value(s)
+            k = _legacy_parse_value(s)
+        return d
+    return None
+
+
+def _legacy_read_torrent(raw: bytes):
+    torrent_data = _legacy_parse_value(io.BytesIO(raw))
+    return torrent_data, bencode.encode_value(torrent_data[b"info"])
+
+
+def _time_decoding(decode, raw: bytes, repeat: int) -> float:
+    # best of 3, as small inputs are noisy
+    times = []
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            decode(raw)
+        times.append((time.perf_counter() - start) / repeat)
+    return min(times)
+
+
+def bencode_decoding(args):
+    piece_length = 2 ** 18
+    length = args.pieces * piece_length
+    info = {
+        b"files": [
+            {
+                b"length": length // args.files,
+                b"path": [b"dir", "file-{}".format(i).encode()],
+            }
+            for i in range(args.files)
+        ],
+        b"name": b"large",
+        b"piece length": piece_length,
+        b"pieces": os.urandom(20 * args.pieces),
+    }
+    torrent_file = bencode.encode_value(
+        {b"announce": b"http://localhost:8000/announce", b"info": info}
+    )
+    peers = {
+        b"interval": 1800,
+        b"peers": [
+            {b"ip": b"10.0.0.1", b"peer id": os.urandom(20), b"port": 6881 + i}
+            for i in range(args.peers)
+        ],
+    }
+    compact_peers = {b"interval": 1800, b"peers": os.urandom(6 * args.peers)}
+    assert bencode.decode_torrent(torrent_file) == _legacy_read_torrent(torrent_file)
+    print("{:<40} {:>10} {:>10} {:>10}".format("", "bytes", "old ms", "new ms"))
+    for name, raw, old, new in [
+        (
+            "torrent ({} pieces, {} files)".format(args.pieces, args.files),
+            torrent_file,
+            _legacy_read_torrent,
+            bencode.decode_torrent,
+        ),
+        (
+            "tracker response ({} dictionary peers)".format(args.peers),
+            bencode.encode_value(peers),
+            lambda raw: _legacy_parse_value(io.BytesIO(raw)),
+            bencode.decode,
+        ),
+        (
+            "tracker response ({} compact peers)".format(args.peers),
+            bencode.encode_value(compact_peers),
+            lambda raw: _legacy_parse_value(io.BytesIO(raw)),
+            bencode.decode,
+        ),
+    ]:
+        old_seconds = _time_decoding(old, raw, args.repeat)
+        new_seconds = _time_decoding(new, raw, args.repeat)
+        print(
+            "{:<40} {:>10} {:>10.3f} {:>10.3f}".format(
+                name, len(raw), old_seconds * 1000, new_seconds * 1000
+            )
+        )
+
+
+# ----- tracker response ------------------------------------------------------
+
+
+def tracker_response(args):
+    torrent = types.SimpleNamespace(listening_port=0)
+    peers = [
+        (bytes(random.randrange(256) for _ in range(4)), random.randrange(1, 65536))
+        for _ in range(args.peers)
+    ]
+    dictionary = {
+        b"interval": 1800,
+        b"peers": [
+            {
+                b"ip": ".".join(str(b) for b in ip).encode(),
+                b"peer id": os.urandom(20),
+                b"port": port,
+            }
+            for ip, port in peers
+        ],
+    }
+    compact = {
+        b"interval": 1800,
+        b"peers": b"".join(ip + port.to_bytes(2, byteorder="big") for ip, port in peers),
+    }
+    print("Parsing an announce response with {} peers".format(args.peers))
+    for name, response in [
+        ("dictionary (compact=0)", dictionary),
+        ("compact (compact=1)", compact),
+    ]:
+        raw = bencode.encode_value(response)
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            tracker_info = bencode.decode(raw)
+            parsed = bencode.parse_peers(tracker_info[b"peers"], torrent)
+        seconds = (time.perf_counter() - start) / args.repeat
+        assert len(parsed) == args.peers
+        print("{:<30} {:>8} bytes  {:>8.3f} ms".format(name, len(raw), seconds * 1000))
+
+
+# ----- tracker announce ------------------------------------------------------
+
+
+def tracker_announce(args):
+    peers = [("10.0.{}.{}".format(i // 256, i % 256), 6881) for i in range(args.peers)]
+    compact_peers = b"".join(bytes(int(b) for b in ip.split(".")) + b"\x1a\xe1" for ip, _ in peers)
+    response_body = bencode.encode_value({b"interval": 1800, b"peers": compact_peers})
+    http_bytes = [0]
+
+    async def http_handler(stream):
+        # a stand-in HTTP tracker, answering every announce with the same peers
+        h = http_stream.Http_stream(stream, h11.SERVER)
+        request, data = await h.receive_with_data()
+        http_bytes[0] += len(request.target) + len(data)
+        await h.send_event(h11.Response(status_code=200, reason=b"OK", headers=[]))
+        await h.send_event(h11.Data(data=response_body))
+        await h.send_event(h11.EndOfMessage())
+        http_bytes[0] += len(response_body)
+        await h.close()
+
+    async def time_announces(torrent, url):
+        start = time.perf_counter()
+        for _ in range(args.announces):
+            tracker_info = await tracker.announce(torrent, url, None)
+        assert len(bencode.parse_peers(tracker_info[b"peers"], torrent)) == args.peers
+        return (time.perf_counter() - start) / args.announces
+
+    async def run():
+        udp_server = udp_tracker_server.UdpTrackerServer(peers, drop_every=args.drop_every)
+        with tempfile.TemporaryDirectory() as directory:
+            torrent = _make_torrent(directory, "announce", 1024 ** 2, 2 ** 16)
+            async with trio.open_nursery() as nursery:
+                listeners = await nursery.start(trio.serve_tcp, http_handler, 0)
+                http_port = listeners[0].socket.getsockname()[1]
+                udp_port = await nursery.start(udp_server.serve, 0)
+                http_url = TrackerUrl("http", b"127.0.0.1", http_port, b"/announce")
+                udp_url = TrackerUrl("udp", b"127.0.0.1", udp_port, b"/announce")
+                http_seconds = await time_announces(torrent, http_url)
+                udp_seconds = await time_announces(torrent, udp_url)
+                nursery.cancel_scope.cancel()
+        print("{} announces to local trackers, {} peers each".format(args.announces, args.peers))
+        print(
+            "{:<6} {:>8.3f} ms  {:>8} payload bytes per announce".format(
+                "http", http_seconds * 1000, http_bytes[0] // args.announces
+            )
+        )
+        print(
+            "{:<6} {:>8.3f} ms  {:>8} datagrams ({} connects, {} dropped)".format(
+                "udp",
+                udp_seconds * 1000,
+                udp_server.received,
+                udp_server.connects,
+                udp_server.received // args.drop_every if args.drop_every else 0,
+            )
+        )
+
+    trio.run(run)
+
+
+# ----- preallocation ---------------------------------------------------------
+
+
+def _make_torrent(
+    directory: str, name: str, length: int, piece_length: int, num_files: int = 1
+) -> Torrent:
+    # the piece hashes don't matter when only the file layout is used
+    num_pieces = (length + piece_length - 1) // piece_length
+    info = {
+        b"name": name.encode(),
+        b"piece length": piece_length,
+        b"pieces": bytes(20 * num_pieces),
+    }
+    if num_files == 1:
+        info[b"length"] = length
+    else:
+        # files of slightly different sizes, so pieces span file boundaries
+        lengths = [length // num_files + (i % 2) for i in range(num_files - 1)]
+        lengths.append(length - sum(lengths))
+        info[b"files"] = [
+            {
+                b"length": l,
+                b"path": ["dir-{}".format(i // 1000).encode(), "file-{}".format(i).encode()],
+            }
+            for i, l in enumerate(lengths)
+        ]
+    tdict = {b"announce": b"http://localhost:8000/announce", b"info": info}
+    return Torrent(tdict, bencode.encode_value(tdict[b"info"]), directory)
+
+
+def preallocation(args):
+    length = args.size_mb * 1024 ** 2
+    print("Creating a {} MB file in {}".format(args.size_mb, args.dir))
+    for mode in sorted(file_manager.PREALLOCATION_MODES):
+        path = os.path.join(args.dir, "preallocation-benchmark.part")
+        start = time.perf_counter()
+        file_manager.PREALLOCATION_MODES[mode](path, length)
+        seconds = time.perf_counter() - start
+        allocated = os.stat(path).st_blocks * 512
+        os.remove(path)
+        print(
+            "{:<30} {:>8.3f}s  ({} MB allocated on disk)".format(
+                mode, seconds, allocated // 1024 ** 2
+            )
+        )
+
+
+# ----- storage ---------------------------------------------------------------
+
+
+def storage_backends(args):
+    length = args.size_mb * 1024 ** 2
+    piece_length = 256 * 1024
+    t = _make_torrent(args.dir, "storage-benchmark", length, piece_length, args.files)
+    data = os.urandom(length)
+    offset = 0
+    for f in t.files:
+        path = os.path.join(t.file_path, *f.path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as out:
+            out.write(data[offset : offset + f.length])
+        offset += f.length
+    blocks_per_piece = piece_length // config.BLOCK_SIZE
+    requests = [
+        (random.randrange(length // piece_length), random.randrange(blocks_per_piece))
+        for _ in range(args.reads)
+    ]
+    print(
+        "Reading {} random {} byte blocks from {} MB in {} files".format(
+            args.reads, config.BLOCK_SIZE, args.size_mb, args.files
+        )
+    )
+    try:
+        for backend in sorted(storage.STORAGE_BACKENDS):
+            fw = file_manager.FileWrapper(torrent=t, storage_backend=backend)
+            fw.create_file_or_return_hashes()  # opens the file and warms the page cache
+            start = time.perf_counter()
+            for index, block in requests:
+                fw.read_block(index, block * config.BLOCK_SIZE, config.BLOCK_SIZE)
+            seconds = time.perf_counter() - start
+            _report(backend, args.reads * config.BLOCK_SIZE, seconds)
+    finally:
+        if args.files == 1:
+            os.remove(t.file_path)
+        else:
+            shutil.rmtree(t.file_path)
+        os.remove(t.file_path + ".resume")
+
+
+# -----------------------------------------------------------------------------
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    sub_commands = argparser.add_subparsers(help="benchmarks")
+    framing_parser = sub_commands.add_parser(
+        "framing", help="MB/s of PIECE frames parsed by PeerStream on one core"
+    )
+    framing_parser.add_argument("--blocks", type=int, default=20000)
+    framing_parser.add_argument("--block-size", type=int, default=config.BLOCK_SIZE)
+    framing_parser.add_argument("--chunk-size", type=int, default=64 * 1024)
+    framing_parser.set_defaults(func=framing)
+    sending_parser = sub_commands.add_parser(
+        "sending", help="CPU time and writes per REQUEST sent by PeerEngine.sending_loop"
+    )
+    sending_parser.add_argument("--batches", type=int, default=2000)
+    sending_parser.add_argument("--requests-per-batch", type=int, default=30)
+    sending_parser.set_defaults(func=sending)
+    rate_limit_parser = sub_commands.add_parser(
+        "rate-limit", help="throughput, fairness and wakeups of senders sharing a TokenBucket"
+    )
+    rate_limit_parser.add_argument("--small-senders", type=int, default=20)
+    rate_limit_parser.add_argument("--large-senders", type=int, default=4)
+    rate_limit_parser.add_argument("--limit-kb", type=int, default=512)
+    rate_limit_parser.add_argument("--seconds", type=int, default=30)
+    rate_limit_parser.set_defaults(func=rate_limit)
+    bencode_parser = sub_commands.add_parser(
+        "bencode", help="decode time of a large .torrent file and of tracker responses"
+    )
+    bencode_parser.add_argument("--pieces", type=int, default=40000)
+    bencode_parser.add_argument("--files", type=int, default=1000)
+    bencode_parser.add_argument("--peers", type=int, default=200)
+    bencode_parser.add_argument("--repeat", type=int, default=20)
+    bencode_parser.set_defaults(func=bencode_decoding)
+    tracker_response_parser = sub_commands.add_parser(
+        "tracker-response", help="size and parse time of dictionary and compact peer lists"
+    )
+    tracker_response_parser.add_argument("--peers", type=int, default=200)
+    tracker_response_parser.add_argument("--repeat", type=int, default=100)
+    tracker_response_parser.set_defaults(func=tracker_response)
+    tracker_announce_parser = sub_commands.add_parser(
+        "tracker-announce", help="announce latency to local HTTP and UDP tracker stand-ins"
+    )
+    tracker_announce_parser.add_argument("--announces", type=int, default=1000)
+    tracker_announce_parser.add_argument("--peers", type=int, default=50)
+    tracker_announce_parser.add_argument(
+        "--drop-every", type=int, default=0, help="UDP tracker ignores every nth datagram"
+    )
+    tracker_announce_parser.set_defaults(func=tracker_announce)
+    preallocation_parser = sub_commands.add_parser(
+        "preallocation", help="time to create a new file with each preallocation mode"
+    )
+    preallocation_parser.add_argument("--size-mb", type=int, default=1024)
+    preallocation_parser.add_argument("--dir", default=".")
+    preallocation_parser.set_defaults(func=preallocation)
+    storage_parser = sub_commands.add_parser(
+        "storage", help="MB/s of random block reads (the seeding hot path) per storage backend"
+    )
+    storage_parser.add_argument("--size-mb", type=int, default=256)
+    storage_parser.add_argument("--reads", type=int, default=200000)
+    storage_parser.add_argument("--files", type=int, default=1)
+    storage_parser.add_argument("--dir", default=".")
+    storage_parser.set_defaults(func=storage_backends)
+    args = argparser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,102 +1,122 @@
 # encode and decode the Bittorrent serialization format
 # http://www.bittorrent.org/beps/bep_0003.html
 
-import collections
-import io
-
-
-def parse_string_length(s: io.BytesIO, i: bytes = b""):
-    # Take string from the front and return the rest
-    c = s.read(1)
-    while c.isdigit():
-        i += c
-        c = s.read(1)
-    # c should be ':' here
-    if c == b":":
-        return int(i)
-    else:
-        raise Exception("String length should be terminated by ':'")
+import socket
+import struct
 
 
-def parse_string(s: io.BytesIO, n: int):
-    return s.read(n)
+class BencodeError(Exception):
+    pass
 
 
-def parse_int(s: io.BytesIO):
-    i = b""
-    c = s.read(1)
-    while c.isdigit():
-        i += c
-        c = s.read(1)
-    # c should be 'e' here
-    if c == b"e":
-        return int(i)
-    else:
-        raise Exception("Integer not terminated by 'e'")
+# Decoding works on an index into the whole bytes object, each function
+# returns the decoded value and the index just after it. Running off the
+# end of the data raises IndexError, which decode turns into BencodeError.
+
+
+def _decode_int(data: bytes, i: int):
+    # i is the index of the 'i'
+    end = data.find(b"e", i)
+    digits = data[i + 1 : end]
+    if end == -1 or not (digits.isdigit() or (digits[:1] == b"-" and digits[1:].isdigit())):
+        raise BencodeError("Invalid integer at {}".format(i))
+    return int(digits), end + 1
+
 
+def _decode_string(data: bytes, i: int):
+    # i is the index of the first digit of the length
+    # most keys and short strings have a one digit length, so skip the search for ':'
+    if data[i + 1] == 58:  # ':'
+        end = i + 2 + data[i] - 48
+        if end > len(data):
+            raise BencodeError("String at {} runs past the end of the data".format(i))
+        return data[i + 2 : end], end
+    colon = data.find(b":", i)
+    length = data[i:colon]
+    if colon == -1 or not length.isdigit():
+        raise BencodeError("Invalid string length at {}".format(i))
+    start = colon + 1
+    end = start + int(length)
+    if end > len(data):
+        raise BencodeError("String at {} runs past the end of the data".format(i))
+    return data[start:end], end
 
-def parse_list(s: io.BytesIO):
+
+def _decode_list(data: bytes, i: int):
+    # i is the index of the 'l'
     l: list = []
-    while True:
-        v = parse_value(s)
-        if v is None:
-            return l
-        else:
-            l.append(v)
-
-
-def parse_dict(s: io.BytesIO):
-    d: dict = collections.OrderedDict()
-    while True:
-        k = parse_value(s)
-        if k is None:
-            return d
-        else:
-            v = parse_value(s)
-            d[k] = v
-
-
-def parse_value(s: io.BytesIO):
-    # `s` is a string stream object
-    # look at first character
-    # digit -> string
-    # 'i'   -> integer
-    # 'l'   -> list
-    # 'd'   -> dictionary
-    c = s.read(1)
-    if c.isdigit():
-        length = parse_string_length(s, c)
-        return parse_string(s, length)
-    elif c == b"i":
-        return parse_int(s)
-    elif c == b"l":
-        return parse_list(s)
-    elif c == b"d":
-        return parse_dict(s)
-    elif c == b"e" or c == "":
-        None
-    else:
-        raise Exception("Expected a digit, 'i', 'l', or 'd'. Got {}".format(c))
+    i += 1
+    while data[i] != 101:  # 'e'
+        v, i = _DECODERS[data[i]](data, i)
+        l.append(v)
+    return l, i + 1
+
 
+def _decode_dict(data: bytes, i: int):
+    # i is the index of the 'd'
+    d: dict = {}
+    i += 1
+    while data[i] != 101:  # 'e'
+        if not 48 <= data[i] <= 57:
+            raise BencodeError("Dictionary key at {} is not a string".format(i))
+        k, i = _decode_string(data, i)
+        d[k], i = _DECODERS[data[i]](data, i)
+    return d, i + 1
 
-# def parse(s):
-#    stream = io.StringIO(s)
-#    return parse_value(stream)
 
-# print(parse('l8:abcdefgh4:spamdi10e11:abcdefghijke'))
+# first byte of a value -> function to decode it
+_DECODERS = {ord("i"): _decode_int, ord("l"): _decode_list, ord("d"): _decode_dict}
+_DECODERS.update((c, _decode_string) for c in b"0123456789")
 
-# def extract_info(s):
-#    c = s.read(1)
-#    if c != b'd':
-#        raise Exception("Need a dictionary to get 'info' string")
-#    d = dict()
-#    while True:
-#        k = parse_value(s)
-#        if k == b'info':
-#            return parse_value(s)
-#        else:
-#            _ = parse_value(s)
-#    raise Exception("No 'info' key found")
+
+def _decode(data: bytes, i: int):
+    try:
+        return _DECODERS[data[i]](data, i)
+    except IndexError:
+        raise BencodeError("Unexpected end of data")
+    except RecursionError:
+        # lists and dicts are decoded recursively
+        raise BencodeError("Data is nested too deeply")
+    except KeyError as e:
+        raise BencodeError("Expected a digit, 'i', 'l', or 'd'. Got {!r}".format(chr(e.args[0])))
+
+
+def decode(data: bytes):
+    """
+    Decode the bencoded value at the start of `data` (bytes or a
+    memoryview), raises BencodeError if it isn't valid.
+    """
+    value, _ = _decode(bytes(data), 0)
+    return value
+
+
+def decode_torrent(data: bytes):
+    """
+    Decode a .torrent file, returning the decoded dictionary and the exact
+    bytes of its 'info' value. The info hash has to be taken from the
+    original bytes, re-encoding the dictionary only gives the same bytes
+    if the file was encoded canonically.
+    """
+    data = bytes(data)
+    if data[:1] != b"d":
+        raise BencodeError("A torrent file should be a dictionary")
+    d: dict = {}
+    info = None
+    i = 1
+    try:
+        while data[i : i + 1] != b"e":
+            if not data[i : i + 1].isdigit():
+                raise BencodeError("Dictionary key at {} is not a string".format(i))
+            k, i = _decode_string(data, i)
+            start = i
+            d[k], i = _decode(data, i)
+            if k == b"info":
+                info = data[start:i]
+    except IndexError:
+        raise BencodeError("Unexpected end of data")
+    if info is None:
+        raise BencodeError("No 'info' key found")
+    return d, info
 
 
 def encode_bytes(s):
@@ -137,15 +157,23 @@ def encode_value(v):
 
 
 def parse_compact_peers(raw_bytes):
+    # 4 byte IPv4 address and 2 byte port for each peer
     if (len(raw_bytes) % 6) != 0:
         raise Exception("Peer list length is not a multiple of 6.")
-    else:
-        peers = []
-        for i in range(len(raw_bytes) // 6):
-            ip = ".".join(str(i) for i in raw_bytes[i : i + 4]).encode()
-            port = int.from_bytes(raw_bytes[i + 4 : i + 6], byteorder="big")
-            peers.append((ip, port))
-        return peers
+    return [
+        (socket.inet_ntop(socket.AF_INET, ip).encode(), port)
+        for ip, port in struct.iter_unpack("!4sH", raw_bytes)
+    ]
+
+
+def parse_compact_peers6(raw_bytes):
+    # 16 byte IPv6 address and 2 byte port for each peer
+    if (len(raw_bytes) % 18) != 0:
+        raise Exception("IPv6 peer list length is not a multiple of 18.")
+    return [
+        (socket.inet_ntop(socket.AF_INET6, ip).encode(), port)
+        for ip, port in struct.iter_unpack("!16sH", raw_bytes)
+    ]
 
 
 def replace_with_localhost(tripple):
@@ -155,14 +183,16 @@ def replace_with_localhost(tripple):
         return tripple
 
 
-def parse_peers(data, torrent):
-    # TODO this try/except logic probably shouldn't be here as it's not really
-    # a bencode issue
-    try:
-        peer_list = parse_compact_peers(data)
-        peer_list = [(ip, port, None) for ip, port in peer_list]
-    except:
-        peer_list = [(x[b"ip"], x[b"port"], x[b"peer id"]) for x in data]
+def parse_peers(data, torrent, data6=b""):
+    # `data` is the "peers" value from the tracker, either a compact string
+    # or a list of dictionaries, and `data6` is the compact "peers6" value
+    # TODO this probably shouldn't be here as it's not really a bencode issue
+    if isinstance(data, bytes):
+        peer_list = [(ip, port, None) for ip, port in parse_compact_peers(data)]
+    else:
+        peer_list = [(x[b"ip"], x[b"port"], x.get(b"peer id")) for x in data]
+    if data6:
+        peer_list.extend((ip, port, None) for ip, port in parse_compact_peers6(data6))
     return [
         replace_with_localhost(tripple)
         for tripple in peer_list
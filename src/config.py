@@ -2,17 +2,117 @@ DEFAULT_LISTENING_PORT = 50881
 
 STREAM_CHUNK_SIZE = 1024 * 8
 
+RECEIVE_BUFFER_SIZE = 1024 * 256
+
+# messages queued for a peer are written together until the batch reaches
+# this size, so a batch can be bigger by one message (at most a PIECE with
+# its header), it should be smaller than the token bucket
+MAX_SEND_BATCH_BYTES = 1024 * 128
+
 BLOCK_SIZE = 1024 * 8
 
 INTERNAL_QUEUE_SIZE = 100
 
 MAX_OUTSTANDING_REQUESTS_PER_PEER = 30
 
+# a peer's requests are only topped up once fewer than this are in flight
+REQUEST_PIPELINE_LOW_WATERMARK = 10
+
 KEEPALIVE_SECONDS = 115
 
 NUM_UNCHOKED_PEERS = 4
 
+# transfer rates are measured over a sliding window of RATE_WINDOW_SECONDS
+# (the choker uses this), and as a moving average with a time constant of
+# RATE_EWMA_SECONDS
+RATE_WINDOW_SECONDS = 20
+RATE_EWMA_SECONDS = 5
+
+# peer connections open at once, shared by all the torrents in a Session
+MAX_PEER_CONNECTIONS = 200
+# and for each torrent
+MAX_PEER_CONNECTIONS_PER_TORRENT = 50
+# outgoing connections being opened at once, shared like MAX_PEER_CONNECTIONS
+MAX_CONCURRENT_DIALS = 8
+
+# opening a connection to a peer, and exchanging handshakes, are abandoned
+# after this long
+PEER_CONNECT_TIMEOUT_SECONDS = 10
+PEER_HANDSHAKE_TIMEOUT_SECONDS = 10
+# a peer is dialled again PEER_RETRY_SECONDS after its connection closes,
+# doubling each time connecting to it fails, up to PEER_RETRY_MAX_SECONDS
+PEER_RETRY_SECONDS = 30
+PEER_RETRY_MAX_SECONDS = 30 * 60
+
+# number of threads used to check piece hashes, while downloading and
+# when checking an existing file at startup
+HASH_WORKERS = 2
+
+# when checking an existing file at startup, each thread reads this many
+# bytes at a time and hashes ranges of pieces of about RESUME_TASK_SIZE
+RESUME_READ_SIZE = 1024 ** 2 * 8
+RESUME_TASK_SIZE = 1024 ** 2 * 64
+
+# how often blocks of incomplete pieces are written to disk, so they
+# don't need to be downloaded again after a restart
+PARTIAL_PIECES_SAVE_SECONDS = 30
+
+# the fast-resume file is saved this often if anything has been written,
+# rather than after every write
+RESUME_SAVE_SECONDS = 10
+
+# number of threads used for disk reads and writes
+DISK_IO_WORKERS = 4
+
+# memory used to cache pieces that are being uploaded, 0 disables the cache
+PIECE_CACHE_BYTES = 64 * 1024 ** 2
+
+# how the file is read and written: "file" (positional reads and writes)
+# or "mmap" (memory map the whole file)
+STORAGE_BACKEND = "file"
+
+# files of a multi-file torrent that are kept open at once, the least
+# recently used ones are closed
+MAX_OPEN_FILES = 256
+
+# how a new file is created: "sparse" (set the size only), "fallocate"
+# (reserve disk blocks without writing them) or "full" (write zeros)
+PREALLOCATION_MODE = "sparse"
+
+# "rarest-first" or "random"
+PIECE_PICKER_STRATEGY = "rarest-first"
+
 DELETE_STALE_REQUESTS_SECONDS = 10 * 60
 
+# an announce to one tracker is abandoned after TRACKER_TIMEOUT_SECONDS,
+# if no tracker answers we try again after TRACKER_RETRY_SECONDS, doubling
+# each time up to the announce interval
+TRACKER_TIMEOUT_SECONDS = 15
+TRACKER_RETRY_SECONDS = 15
+
+# UDP tracker requests are sent again if there's no answer after this long,
+# doubling each time, up to UDP_TRACKER_ATTEMPTS times
+UDP_TRACKER_RETRANSMIT_SECONDS = 1
+UDP_TRACKER_ATTEMPTS = 4
+UDP_TRACKER_MAX_DATAGRAM = 2048
+
+# upload limits, for the whole process (all torrents in a Session), for
+# each torrent and for each peer, None for no limit
 MAX_OUTGOING_BYTES_PER_SECOND = 6 * 1024 ** 2
 # MAX_OUTGOING_BYTES_PER_SECOND = None
+MAX_OUTGOING_BYTES_PER_SECOND_PER_TORRENT = None
+MAX_OUTGOING_BYTES_PER_SECOND_PER_PEER = None
+
+# download limits in the same way, reads from peers are delayed so TCP
+# slows them down
+MAX_INCOMING_BYTES_PER_SECOND = None
+MAX_INCOMING_BYTES_PER_SECOND_PER_TORRENT = None
+MAX_INCOMING_BYTES_PER_SECOND_PER_PEER = None
+
+# with a download limit, requests in flight to a peer are cut to about
+# this many seconds of data at the limit
+REQUEST_QUEUE_SECONDS = 2
+
+# serve metrics for Prometheus at http://127.0.0.1:METRICS_PORT/metrics,
+# None to not serve them
+METRICS_PORT = None
@@ -0,0 +1,218 @@
+import logging
+import math
+from typing import Dict, List, Optional, Tuple
+
+import trio
+
+import config
+import peer_connection
+import peer_state
+
+logger = logging.getLogger("connection_manager")
+
+
+class _KnownPeer(object):
+    def __init__(self, peer_id: Optional[bytes]) -> None:
+        # the peer_id from the tracker, if it sent one, the handshake must match it
+        self.expected_peer_id = peer_id
+        # the peer_id from the tracker or from the last handshake
+        self.peer_id = peer_id
+        self.connected = False
+        self.failures = 0
+        # trio time when the address can be dialled again
+        self.retry_at = 0.0
+
+
+class ConnectionManager(object):
+    """
+    Opens and accepts the peer connections for one torrent.
+
+    Addresses from trackers are remembered, so an address is only dialled
+    once at a time however many announces return it, and not while a
+    connection to the same peer_id is open. Connections are limited to
+    max_connections for the torrent, and by connection_limiter, which may
+    be shared with other torrents in a Session. At most
+    dial_limiter connections are opened at once (it can be shared too),
+    and opening a connection times out after PEER_CONNECT_TIMEOUT_SECONDS.
+
+    An address is dialled again PEER_RETRY_SECONDS after its connection
+    closes, and each time connecting or the handshake fails the wait
+    doubles, up to PEER_RETRY_MAX_SECONDS.
+    """
+
+    def __init__(
+        self,
+        engine,
+        connection_limiter: trio.CapacityLimiter,
+        dial_limiter: trio.CapacityLimiter,
+        max_connections: int,
+    ) -> None:
+        self._engine = engine
+        self._connection_limiter = connection_limiter
+        self._dial_limiter = dial_limiter
+        self._max_connections = max_connections
+        self._known: Dict[peer_state.PeerAddress, _KnownPeer] = dict()
+        self._num_connections = 0
+        self._wake = trio.open_memory_channel(1)
+        # stats
+        self.dials = 0
+        self.failed_dials = 0
+        self.refused_incoming = 0
+
+    @property
+    def num_connections(self) -> int:
+        return self._num_connections
+
+    @property
+    def num_known(self) -> int:
+        return len(self._known)
+
+    def add_peers(self, peers: List[Tuple[peer_state.PeerAddress, Optional[bytes]]]) -> int:
+        """
+        Remember new peer addresses, returns how many weren't already known.
+        """
+        new = 0
+        for address, peer_id in peers:
+            if address not in self._known:
+                self._known[address] = _KnownPeer(peer_id)
+                new += 1
+        if new:
+            self._schedule_dial()
+        return new
+
+    def _schedule_dial(self) -> None:
+        # wake dial_loop, there's no need to queue more than one wakeup
+        try:
+            self._wake[0].send_nowait(None)
+        except trio.WouldBlock:
+            pass
+
+    def _reserve(self, token: Optional[object] = None) -> Optional[object]:
+        # Reserve a connection within the torrent's and the global limits,
+        # returns the token to release it with, None if either is full.
+        # A token passed in already holds a place in the global limit.
+        if self._num_connections >= self._max_connections:
+            return None
+        if token is None:
+            token = object()
+            try:
+                self._connection_limiter.acquire_on_behalf_of_nowait(token)
+            except trio.WouldBlock:
+                return None
+        self._num_connections += 1
+        return token
+
+    def _release(self, token: object) -> None:
+        self._connection_limiter.release_on_behalf_of(token)
+        self._num_connections -= 1
+        self._schedule_dial()
+
+    async def dial_loop(self):
+        async with trio.open_nursery() as nursery:
+            while True:
+                wait = self._start_dials(nursery)
+                with trio.move_on_after(wait):
+                    await self._wake[1].receive()
+
+    def _start_dials(self, nursery) -> float:
+        # Start dialling the addresses that are due, while there's room,
+        # returns how long to wait before trying again.
+        now = trio.current_time()
+        next_retry = math.inf
+        for address, known in self._known.items():
+            if known.connected:
+                continue
+            if known.retry_at > now:
+                next_retry = min(next_retry, known.retry_at)
+                continue
+            if known.peer_id in self._engine._peers:  # TODO remove private access
+                # already connected from another address, or it connected to us
+                known.retry_at = now + config.PEER_RETRY_SECONDS
+                next_retry = min(next_retry, known.retry_at)
+                continue
+            token = self._reserve()
+            if token is None:
+                if self._num_connections >= self._max_connections:
+                    # woken when one of our connections closes
+                    return math.inf
+                # the global limit is full, other torrents don't wake us
+                return 1
+            known.connected = True
+            nursery.start_soon(self._dial, address, known, token)
+        return next_retry - now
+
+    async def _dial(self, address: peer_state.PeerAddress, known: _KnownPeer, token: object):
+        logger.debug("Starting outgoing peer connection to {}".format(address))
+        stream = None
+        peer_engine = None
+        try:
+            async with self._dial_limiter:
+                self.dials += 1
+                with trio.fail_after(config.PEER_CONNECT_TIMEOUT_SECONDS):
+                    stream = await trio.open_tcp_stream(address.ip, address.port)
+            peer_engine = peer_connection.PeerEngine(
+                self._engine,
+                address,
+                known.expected_peer_id,
+                stream,
+                send_peer_msg_to_engine=self._engine.peer_messages,
+            )
+            await peer_engine.run(initiate=True)
+        except Exception as e:  # TODO this might be too general
+            logger.warning(
+                "Failed to maintain peer connection to {} because of {}".format(address, e)
+            )
+        finally:
+            if stream:
+                await stream.aclose()
+            known.connected = False
+            if peer_engine is not None and peer_engine.peer_id is not None:
+                # the handshake worked, even if the peer was already connected
+                known.peer_id = peer_engine.peer_id
+                known.failures = 0
+                delay = config.PEER_RETRY_SECONDS
+            else:
+                self.failed_dials += 1
+                known.failures += 1
+                delay = min(
+                    config.PEER_RETRY_SECONDS * 2 ** (known.failures - 1),
+                    config.PEER_RETRY_MAX_SECONDS,
+                )
+            known.retry_at = trio.current_time() + delay
+            self._release(token)
+
+    async def handle_incoming(
+        self, stream, peer_address, peer_stream=None, handshake=None, limiter_token=None
+    ):
+        """
+        Run a connection from a peer, or close it if there are too many
+        connections. `peer_stream` and `handshake` are passed on to the
+        PeerEngine if the handshake has already been read, and
+        `limiter_token` is a place already taken in connection_limiter
+        (e.g. by a Session while it read the handshake), which is released
+        when the connection closes.
+        """
+        token = self._reserve(limiter_token)
+        if token is None:
+            if limiter_token is not None:
+                self._connection_limiter.release_on_behalf_of(limiter_token)
+            self.refused_incoming += 1
+            logger.info("Too many connections, closing {}".format(peer_address))
+            await stream.aclose()
+            return
+        try:
+            await peer_connection.start_peer_engine(
+                self._engine,
+                peer_address,
+                stream,
+                initiate=False,
+                peer_stream=peer_stream,
+                handshake=handshake,
+            )
+        except Exception as e:  # TODO this might be too general
+            logger.warning(
+                "Failed to maintain peer connection to {} because of {}".format(peer_address, e)
+            )
+        finally:
+            await stream.aclose()
+            self._release(token)
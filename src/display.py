@@ -2,6 +2,8 @@ import math
 import os
 import shutil
 
+from rate_meter import format_bytes
+
 CGREEN = "\33[32m"
 CBLUE = "\33[34m"
 CBEIGE = "\33[36m"
@@ -38,12 +40,22 @@ def display_piece(count, display_block):
 MAX_TEXT_LENGTH = 35
 
 
+def print_check_progress(name, checked, total):
+    # overwrites the same line until the check is finished
+    end = "\n" if checked == total else ""
+    print("\rChecking existing pieces of {}: {}/{}".format(name, checked, total), end=end)
+
+
+def format_meter(meter):
+    return "{}, {}/s".format(format_bytes(meter.total), format_bytes(meter.window_rate()))
+
+
 def pretty_print(width, p_id, pieces, received_from, sent_to):
     lines = [
         p_id.decode("ascii"),
         "Complete      : {}%".format(math.floor(sum(pieces) / len(pieces) * 100)),
-        "Received from : {} blocks".format(received_from) if (received_from is not None) else "",
-        "Sent to       : {} blocks".format(sent_to) if (sent_to is not None) else "",
+        "Received from : {}".format(format_meter(received_from)) if received_from else "",
+        "Sent to       : {}".format(format_meter(sent_to)) if sent_to else "",
     ]
     ##
     # MAX_TEXT_LENGTH = max(map(len,lines))
@@ -66,17 +78,40 @@ def pretty_print(width, p_id, pieces, received_from, sent_to):
         print(line)
 
 
-def print_peers(torrent, peers):
+def print_peers(torrent, peers, download_meter=None, upload_meter=None):
     terminal_info = shutil.get_terminal_size()
     width = terminal_info.columns
     print(chr(27) + "[2J")
-    # pretty_print(width, torrent.peer_id + b' (self)', torrent._complete, "not applicable", "not applicable")
-    pretty_print(width, torrent.peer_id + b" (self)", torrent._complete, None, None)
+    pretty_print(
+        width, torrent.peer_id + b" (self)", torrent._complete, download_meter, upload_meter
+    )
     for _, p_state in sorted(peers.items())[:4]:
         pretty_print(
             width,
             p_state.peer_id,
             p_state.get_pieces(),
-            p_state._total_download_count,
-            p_state._total_upload_count,
+            p_state.download_meter,
+            p_state.upload_meter,
+        )
+
+
+def print_torrents(torrents):
+    # one line for each (name, pieces, number of peers, download meter,
+    # upload meter) in a Session
+    width = shutil.get_terminal_size().columns
+    print(chr(27) + "[2J")
+    print(width * "-")
+    for name, pieces, num_peers, download_meter, upload_meter in torrents:
+        complete = math.floor(pieces.count() / len(pieces) * 100) if len(pieces) else 100
+        text = name[:MAX_TEXT_LENGTH]
+        spaces = (MAX_TEXT_LENGTH - len(text) + 1) * " "
+        print(
+            "{}{}{:>3}%  {} peers  down {}/s  up {}/s".format(
+                text,
+                spaces,
+                complete,
+                num_peers,
+                format_bytes(download_meter.window_rate()),
+                format_bytes(upload_meter.window_rate()),
+            )
         )
@@ -1,53 +1,157 @@
 import datetime
 import hashlib
-import io
 import logging
 import math
 import random
-from typing import List, Dict, Tuple, Set, Union
+from typing import List, Dict, Optional, Tuple, Set
 
 import bitarray
 import trio
 
 import bencode
+import connection_manager
 import display
 import file_manager
 import messages
+import metrics
 import peer_connection
-import requests
 import peer_state
-from token_bucket import NullBucket, TokenBucket
+import piece_picker
+import requests
+from peer_state import UploadRequest
+from rate_meter import RateMeter
+from token_bucket import TokenBucket
 import torrent as state
 import tracker
 
 import config
 
 
-def _pick_random_one_in_bitarray(b):
-    n = len(b)
-    start = random.randint(0, n - 1)
-    # look at tail
-    try:
-        i = b.index(True, start)
-        return i
-    except ValueError:
-        pass
-    # look at head
-    try:
-        i = b.index(True, 0, start)
-        return i
-    except ValueError:
-        return None
-
-
 logger = logging.getLogger("engine")
 
-stats = {"requests_in": 0, "blocks_out": 0, "requests_out": 0, "blocks_in": 0}
-
 
-def incStats(field):
-    stats[field] += 1
-    logger.debug("stats updated: {}".format(stats))
+def _sha1(data) -> bytes:
+    return hashlib.sha1(data).digest()
+
+
+# counters for the whole process, shared by the Engines in a Session
+REQUESTS_IN = metrics.REGISTRY.counter("kouzui_requests_in_total", "REQUEST messages received")
+BLOCKS_OUT = metrics.REGISTRY.counter("kouzui_blocks_out_total", "Blocks read for peers")
+REQUESTS_OUT = metrics.REGISTRY.counter("kouzui_requests_out_total", "Blocks requested")
+BLOCKS_IN = metrics.REGISTRY.counter("kouzui_blocks_in_total", "PIECE messages received")
+ENDGAME_REQUESTS_OUT = metrics.REGISTRY.counter(
+    "kouzui_endgame_requests_out_total", "Duplicate requests made in endgame mode"
+)
+CANCELS_OUT = metrics.REGISTRY.counter("kouzui_cancels_out_total", "CANCEL messages sent")
+CANCELS_IN = metrics.REGISTRY.counter("kouzui_cancels_in_total", "CANCEL messages received")
+CANCELLED_BEFORE_READ = metrics.REGISTRY.counter(
+    "kouzui_cancelled_before_read_total", "Uploads cancelled before the block was read"
+)
+CANCELLED_BEFORE_SEND = metrics.REGISTRY.counter(
+    "kouzui_cancelled_before_send_total", "Uploads cancelled after the read, before sending"
+)
+BLOCK_LATENCY = metrics.REGISTRY.histogram(
+    "kouzui_block_latency_seconds", "Time from requesting a block to receiving it"
+)
+HASH_SECONDS = metrics.REGISTRY.histogram(
+    "kouzui_piece_hash_seconds", "Time to check a piece's hash, including waiting for a thread"
+)
+
+# gauges (and totals) read from each running Engine when the metrics are scraped
+PEERS = metrics.REGISTRY.gauge("kouzui_peers", "Peers with a running connection", ["torrent"])
+CONNECTIONS = metrics.REGISTRY.gauge(
+    "kouzui_connections", "Peer connections, including ones still connecting", ["torrent"]
+)
+KNOWN_PEERS = metrics.REGISTRY.gauge("kouzui_known_peers", "Known peer addresses", ["torrent"])
+DIALS = metrics.REGISTRY.counter("kouzui_dials_total", "Outgoing connection attempts", ["torrent"])
+FAILED_DIALS = metrics.REGISTRY.counter(
+    "kouzui_failed_dials_total", "Outgoing connections that failed", ["torrent"]
+)
+REFUSED_INCOMING = metrics.REGISTRY.counter(
+    "kouzui_refused_incoming_total", "Incoming connections refused at the limit", ["torrent"]
+)
+PIECES = metrics.REGISTRY.gauge("kouzui_pieces", "Pieces in the torrent", ["torrent"])
+COMPLETE_PIECES = metrics.REGISTRY.gauge(
+    "kouzui_complete_pieces", "Pieces downloaded and written", ["torrent"]
+)
+PARTIAL_PIECES = metrics.REGISTRY.gauge(
+    "kouzui_partial_pieces", "Pieces with received blocks that aren't complete", ["torrent"]
+)
+PIECES_BEING_HASHED = metrics.REGISTRY.gauge(
+    "kouzui_pieces_being_hashed", "Pieces queued for, or going through, a hash check", ["torrent"]
+)
+OUTSTANDING_REQUESTS = metrics.REGISTRY.gauge(
+    "kouzui_outstanding_requests", "Block requests waiting for an answer", ["torrent"]
+)
+CHANNEL_ITEMS = metrics.REGISTRY.gauge(
+    "kouzui_channel_items", "Items buffered in an internal memory channel", ["torrent", "channel"]
+)
+DOWNLOADED_BYTES = metrics.REGISTRY.counter(
+    "kouzui_downloaded_bytes_total", "Bytes received from peers", ["torrent"]
+)
+UPLOADED_BYTES = metrics.REGISTRY.counter(
+    "kouzui_uploaded_bytes_total", "Bytes sent to peers", ["torrent"]
+)
+DOWNLOAD_RATE = metrics.REGISTRY.gauge(
+    "kouzui_download_bytes_per_second",
+    "Download rate over the last RATE_WINDOW_SECONDS",
+    ["torrent"],
+)
+UPLOAD_RATE = metrics.REGISTRY.gauge(
+    "kouzui_upload_bytes_per_second", "Upload rate over the last RATE_WINDOW_SECONDS", ["torrent"]
+)
+PEER_DOWNLOAD_RATE = metrics.REGISTRY.gauge(
+    "kouzui_peer_download_bytes_per_second",
+    "Download rate from a peer over the last RATE_WINDOW_SECONDS",
+    ["torrent", "peer"],
+)
+PEER_UPLOAD_RATE = metrics.REGISTRY.gauge(
+    "kouzui_peer_upload_bytes_per_second",
+    "Upload rate to a peer over the last RATE_WINDOW_SECONDS",
+    ["torrent", "peer"],
+)
+PEER_REQUESTS = metrics.REGISTRY.gauge(
+    "kouzui_peer_requests", "Block requests to a peer waiting for an answer", ["torrent", "peer"]
+)
+PEER_UPLOAD_REQUESTS = metrics.REGISTRY.gauge(
+    "kouzui_peer_upload_requests",
+    "Requests from a peer that haven't been sent",
+    ["torrent", "peer"],
+)
+
+# per-torrent metrics, removed when an Engine stops
+_TORRENT_METRICS = [
+    PEERS,
+    CONNECTIONS,
+    KNOWN_PEERS,
+    DIALS,
+    FAILED_DIALS,
+    REFUSED_INCOMING,
+    PIECES,
+    COMPLETE_PIECES,
+    PARTIAL_PIECES,
+    PIECES_BEING_HASHED,
+    OUTSTANDING_REQUESTS,
+    CHANNEL_ITEMS,
+    DOWNLOADED_BYTES,
+    UPLOADED_BYTES,
+    DOWNLOAD_RATE,
+    UPLOAD_RATE,
+    PEER_DOWNLOAD_RATE,
+    PEER_UPLOAD_RATE,
+    PEER_REQUESTS,
+    PEER_UPLOAD_REQUESTS,
+]
+
+
+def make_token_bucket() -> TokenBucket:
+    # the upload limit for the whole process
+    return TokenBucket(config.MAX_OUTGOING_BYTES_PER_SECOND)
+
+
+def make_download_token_bucket() -> TokenBucket:
+    # the download limit for the whole process
+    return TokenBucket(config.MAX_INCOMING_BYTES_PER_SECOND)
 
 
 class Engine(object):
@@ -59,12 +163,24 @@ class Engine(object):
         write_confirmations: trio.MemoryReceiveChannel,
         blocks_to_read: trio.MemorySendChannel,
         blocks_for_peers: trio.MemoryReceiveChannel,
+        piece_picker_strategy: str = config.PIECE_PICKER_STRATEGY,
+        hash_workers: int = config.HASH_WORKERS,
+        partial_pieces: Optional[file_manager.PartialPieces] = None,
+        global_token_bucket: Optional[TokenBucket] = None,
+        global_download_token_bucket: Optional[TokenBucket] = None,
+        connection_limiter: Optional[trio.CapacityLimiter] = None,
+        dial_limiter: Optional[trio.CapacityLimiter] = None,
+        max_connections: int = config.MAX_PEER_CONNECTIONS_PER_TORRENT,
+        serve_incoming: bool = True,
+        show_display: bool = True,
         auto_shutdown=False
     ) -> None:
         self._auto_shutdown = auto_shutdown
         self._state = torrent
-        # interact with self
-        self._peers_without_connection = trio.open_memory_channel(config.INTERNAL_QUEUE_SIZE)
+        # a Session accepts incoming connections and shows its own display
+        # for all of its torrents
+        self._serve_incoming = serve_incoming
+        self._show_display = show_display
         # interact with FileManager
         self._complete_pieces_to_write = complete_pieces_to_write
         self._write_confirmations = write_confirmations
@@ -72,28 +188,77 @@ class Engine(object):
         self._blocks_for_peers = blocks_for_peers
         # interact with peer connections
         self._msg_from_peer = trio.open_memory_channel(config.INTERNAL_QUEUE_SIZE)
+        self._refill_all_needed = trio.open_memory_channel(1)
         # queues for sending TO peers are initialized on a per-peer basis
         self._peers: Dict[bytes, peer_state.PeerState] = dict()
         # data received but not written to disk
         self._received_blocks: Dict[int, Tuple[bitarray, bytearray]] = dict()
+        if partial_pieces:
+            self._received_blocks.update(partial_pieces)
+        # complete pieces that are queued for, or going through, a hash check
+        self._pieces_being_hashed: Set[int] = set()
+        self._pieces_to_hash = trio.open_memory_channel(config.INTERNAL_QUEUE_SIZE)
+        self._hash_workers = hash_workers
         self.requests = requests.RequestManager()
-
-        if config.MAX_OUTGOING_BYTES_PER_SECOND is None:
-            self.token_bucket: Union[NullBucket, TokenBucket] = NullBucket()
-        else:
-            self.token_bucket = TokenBucket(config.MAX_OUTGOING_BYTES_PER_SECOND)
+        # set once every block we still need has been requested
+        self._endgame = False
+        self._picker = piece_picker.make_picker(piece_picker_strategy, self._state._complete)
+
+        # the global token buckets and connection limits may be shared with
+        # other Engines, each peer's bucket is a child of this torrent's
+        if global_token_bucket is None:
+            global_token_bucket = make_token_bucket()
+        self.token_bucket = TokenBucket(
+            config.MAX_OUTGOING_BYTES_PER_SECOND_PER_TORRENT, parent=global_token_bucket
+        )
+        if global_download_token_bucket is None:
+            global_download_token_bucket = make_download_token_bucket()
+        self.download_token_bucket = TokenBucket(
+            config.MAX_INCOMING_BYTES_PER_SECOND_PER_TORRENT, parent=global_download_token_bucket
+        )
+        # bytes sent and received for the torrent, each peer's meters add to these
+        self.upload_meter = RateMeter()
+        self.download_meter = RateMeter()
+        if connection_limiter is None:
+            connection_limiter = trio.CapacityLimiter(config.MAX_PEER_CONNECTIONS)
+        if dial_limiter is None:
+            dial_limiter = trio.CapacityLimiter(config.MAX_CONCURRENT_DIALS)
+        self.connections = connection_manager.ConnectionManager(
+            self, connection_limiter, dial_limiter, max_connections
+        )
 
     @property
     def peer_messages(self) -> trio.MemorySendChannel:
         return self._msg_from_peer[0]
 
+    @property
+    def torrent(self) -> state.Torrent:
+        return self._state
+
+    @property
+    def num_peers(self) -> int:
+        return len(self._peers)
+
     async def run(self):
+        metrics.REGISTRY.add_collector(self.collect_metrics)
+        try:
+            await self._run()
+        finally:
+            metrics.REGISTRY.remove_collector(self.collect_metrics)
+            for metric in _TORRENT_METRICS:
+                metric.clear(self._state.name)
+
+    async def _run(self):
         async with trio.open_nursery() as nursery:
             nursery.start_soon(self.control_loop)
             nursery.start_soon(self.peer_clients_loop)
-            nursery.start_soon(self.peer_server_loop)
+            if self._serve_incoming:
+                nursery.start_soon(self.peer_server_loop)
             nursery.start_soon(self.tracker_loop)
             nursery.start_soon(self.peer_messages_loop)
+            nursery.start_soon(self.refill_all_loop)
+            for _ in range(self._hash_workers):
+                nursery.start_soon(self.piece_hashing_loop)
             nursery.start_soon(self.file_write_confirmation_loop)
             nursery.start_soon(self.file_reading_loop)
             nursery.start_soon(self.info_loop)
@@ -101,7 +266,7 @@ class Engine(object):
             nursery.start_soon(
                 self.delete_stale_requests_loop, config.DELETE_STALE_REQUESTS_SECONDS
             )
-            nursery.start_soon(self.token_bucket.loop)
+            nursery.start_soon(self.partial_pieces_loop)
 
     async def control_loop(self):
         while True:
@@ -109,21 +274,61 @@ class Engine(object):
             if (
                 self._auto_shutdown and all(complete_peers) and self._state._complete.all()
             ):  # TODO remove private variable access
-                await self._complete_pieces_to_write.send((None, None))
+                await self._complete_pieces_to_write.send(("move_to_final_location", None))
                 raise KeyboardInterrupt  # TODO should use a better exception, or something else entirely
             elif self._state._complete.all():  # TODO remove private variable access
-                await self._complete_pieces_to_write.send((None, None))
+                await self._complete_pieces_to_write.send(("move_to_final_location", None))
             await trio.sleep(2)
 
+    def collect_metrics(self) -> None:
+        name = self._state.name
+        PEERS.labels(name).set(len(self._peers))
+        CONNECTIONS.labels(name).set(self.connections.num_connections)
+        KNOWN_PEERS.labels(name).set(self.connections.num_known)
+        # the ConnectionManager and RateMeters keep their own totals
+        DIALS.labels(name).value = self.connections.dials
+        FAILED_DIALS.labels(name).value = self.connections.failed_dials
+        REFUSED_INCOMING.labels(name).value = self.connections.refused_incoming
+        DOWNLOADED_BYTES.labels(name).value = self.download_meter.total
+        UPLOADED_BYTES.labels(name).value = self.upload_meter.total
+        PIECES.labels(name).set(len(self._state._complete))  # TODO remove private access
+        COMPLETE_PIECES.labels(name).set(self._state._complete.count())
+        PARTIAL_PIECES.labels(name).set(len(self._received_blocks))
+        PIECES_BEING_HASHED.labels(name).set(self.hash_queue_depth)
+        OUTSTANDING_REQUESTS.labels(name).set(self.requests.size)
+        DOWNLOAD_RATE.labels(name).set(self.download_meter.window_rate())
+        UPLOAD_RATE.labels(name).set(self.upload_meter.window_rate())
+        channels = [
+            ("pieces_to_write", self._complete_pieces_to_write),
+            ("write_confirmations", self._write_confirmations),
+            ("blocks_to_read", self._blocks_to_read),
+            ("blocks_for_peers", self._blocks_for_peers),
+            ("peer_messages", self._msg_from_peer[0]),
+            ("pieces_to_hash", self._pieces_to_hash[0]),
+        ]
+        for channel_name, channel in channels:
+            CHANNEL_ITEMS.labels(name, channel_name).set(channel.statistics().current_buffer_used)
+        # peers come and go, so only the current ones are kept
+        for metric in (PEER_DOWNLOAD_RATE, PEER_UPLOAD_RATE, PEER_REQUESTS, PEER_UPLOAD_REQUESTS):
+            metric.clear(name)
+        for peer_id, p_state in self._peers.items():
+            peer = peer_id.decode("ascii", errors="backslashreplace")
+            PEER_DOWNLOAD_RATE.labels(name, peer).set(p_state.download_meter.window_rate())
+            PEER_UPLOAD_RATE.labels(name, peer).set(p_state.upload_meter.window_rate())
+            PEER_REQUESTS.labels(name, peer).set(self.requests.num_requests_for_peer(peer_id))
+            PEER_UPLOAD_REQUESTS.labels(name, peer).set(len(p_state.upload_requests))
+
     async def info_loop(self):
         while True:
             unwritten_blocks = len(self._received_blocks.items())
             outstanding_requests = self.requests.size
-            logger.info("stats = {}".format(stats))
+            logger.info("download {}, upload {}".format(self.download_meter, self.upload_meter))
             logger.info(
-                "{} unwritten blocks, {} outstanding_requests, {}/{} complete pieces".format(
+                "{} unwritten blocks, {} outstanding_requests, {} pieces being hashed, "
+                "{}/{} complete pieces".format(
                     unwritten_blocks,
                     outstanding_requests,
+                    self.hash_queue_depth,
                     sum(self._state._complete),
                     len(self._state._complete),
                 )
@@ -132,50 +337,94 @@ class Engine(object):
                 sum(self._state._complete) - len(self._state._complete) - sum(self._state._complete)
                 > 0.97
             ):
-                logger.info("Outstanding requests = {}".format(self.requests._requests))
+                logger.info("Outstanding requests = {}".format(self.requests.all_requests()))
                 unwritten_blocks = [
                     (i, b, len(data))
                     for i, blocks in self._received_blocks.items()
                     for b, data in blocks
                 ]
                 logger.info("Unwritten blocks: {}".format(unwritten_blocks))
-            channels = [
-                self._peers_without_connection[0],
-                self._complete_pieces_to_write,
-                self._write_confirmations,
-                self._blocks_to_read,
-                self._blocks_for_peers,
-                self._msg_from_peer[0],
-            ]
-            logger.info("Memory channels {}".format([c.statistics() for c in channels]))
             logger.info("Alive peers {}".format(self._peers.keys()))
-            display.print_peers(self._state, self._peers)
+            logger.info(
+                "{} connections, {} known peer addresses, {} dials ({} failed), "
+                "{} incoming refused".format(
+                    self.connections.num_connections,
+                    self.connections.num_known,
+                    self.connections.dials,
+                    self.connections.failed_dials,
+                    self.connections.refused_incoming,
+                )
+            )
+            if self._show_display:
+                display.print_peers(
+                    self._state, self._peers, self.download_meter, self.upload_meter
+                )
             await trio.sleep(1)
 
     async def tracker_loop(self):
-        new = True
+        # BEP 12: tiers are tried in order until a tracker in one of them
+        # answers, the trackers within a tier are announced to at once.
+        event: Optional[bytes] = b"started"
+        retry_seconds = config.TRACKER_RETRY_SECONDS
         while True:
             logger.debug("tracker_loop")
             start_time = trio.current_time()
-            event = b"started" if new else None
-            raw_tracker_info = await tracker.query(self._state, event)
-            tracker_info = bencode.parse_value(io.BytesIO(raw_tracker_info))
-            # update peers
-            # TODO we could recieve peers in a different format
-            peer_ips_and_ports = bencode.parse_peers(tracker_info[b"peers"], self._state)
-            peers = [
-                (peer_state.PeerAddress(ip, port), peer_id)
-                for ip, port, peer_id in peer_ips_and_ports
-            ]
-            logger.info("Found peers from tracker: {}".format(peers))
+            tracker_info = None
+            for tier in self._state.trackers:
+                tracker_info = await self._announce_to_tier(tier, event)
+                if tracker_info is not None:
+                    break
+            if tracker_info is None:
+                # back off, but still announce at least once an interval
+                wait = retry_seconds
+                retry_seconds = min(retry_seconds * 2, self._state.interval)
+                logger.warning("No tracker answered, trying again in {}s".format(wait))
+            else:
+                self._state.update_from_tracker(tracker_info)
+                event = None
+                retry_seconds = config.TRACKER_RETRY_SECONDS
+                wait = max(self._state.interval, self._state.min_interval or 0)
+            await trio.sleep_until(start_time + wait)
+
+    async def _announce_to_tier(self, tier, event) -> Optional[dict]:
+        responses = []
+        seen = set()
+
+        async def announce(url):
+            tracker_info = None
+            with trio.move_on_after(config.TRACKER_TIMEOUT_SECONDS):
+                try:
+                    tracker_info = await tracker.announce(self._state, url, event)
+                except Exception as e:
+                    logger.warning("Announce to {} failed: {}".format(url, e))
+                    return
+            if tracker_info is None:
+                logger.warning("Announce to {} timed out".format(url))
+                return
+            responses.append((url, tracker_info))
+            # connect to the peers as soon as each tracker answers
+            peer_ips_and_ports = bencode.parse_peers(
+                tracker_info.get(b"peers", b""), self._state, tracker_info.get(b"peers6", b"")
+            )
+            peers = []
+            for ip, port, peer_id in peer_ips_and_ports:
+                address = peer_state.PeerAddress(ip, port)
+                if address not in seen:
+                    seen.add(address)
+                    peers.append((address, peer_id))
+            logger.info("Found peers from tracker {}: {}".format(url, peers))
             await self.update_peers(peers)
-            # update other info:
-            # self._state.complete_peers = tracker_info['complete']
-            # self._state.incomplete_peers = tracker_info['incomplete']
-            # self._state.interval = int(tracker_info['interval'])
-            # tell tracker the new interval
-            await trio.sleep_until(start_time + self._state.interval)
-            new = False
+
+        async with trio.open_nursery() as nursery:
+            for url in tier:
+                nursery.start_soon(announce, url)
+        if not responses:
+            return None
+        # BEP 12: the first tracker to answer moves to the front of its tier
+        url, tracker_info = responses[0]
+        tier.remove(url)
+        tier.insert(0, url)
+        return tracker_info
 
     async def peer_server_loop(self):
         await trio.serve_tcp(peer_connection.make_handler(self), self._state.listening_port)
@@ -185,19 +434,17 @@ class Engine(object):
         Start up clients for new peers that are not from the serve.
         """
         logger.debug("starting peer_clients_loop")
-        async with trio.open_nursery() as nursery:
-            while True:
-                logger.debug("peer_clients_loop")
-                address = await self._peers_without_connection[1].receive()
-                nursery.start_soon(peer_connection.make_standalone, self, address)
+        await self.connections.dial_loop()
 
     async def update_peers(self, peers: List[peer_state.PeerAddress]) -> None:
+        new_peers = []
         for address, peer_id in peers:
-            if peer_id in self._peers:
+            if peer_id is not None and peer_id in self._peers:
                 logger.info("Peer already exists: {}".format(peer_id))
             else:
-                logger.info("Adding new peer to queue: {} / {}".format(address, peer_id))
-                await self._peers_without_connection[0].send(address)
+                new_peers.append((address, peer_id))
+        num_new = self.connections.add_peers(new_peers)
+        logger.info("Added {} new peer addresses of {}".format(num_new, len(peers)))
 
     def _blocks_from_index(self, index):
         piece_length = self._state.piece_length(index)
@@ -207,51 +454,121 @@ class Engine(object):
             (index, begin, min(block_length, piece_length - begin)) for begin in begin_indexes
         )
 
-    async def update_peer_requests(self):
-        # Look at what the client has, what the peers have
-        # and update the requested pieces for each peer.
+    def _missing_blocks(self, index):
+        if index in self._pieces_being_hashed:
+            return set()
+        blocks = self._blocks_from_index(index)
+        if index in self._received_blocks:
+            received = self._received_blocks[index][0]
+            blocks = set(b for b in blocks if not received[b[1] // config.BLOCK_SIZE])
+        return blocks
+
+    def _unrequested_blocks(self, index):
+        return self._missing_blocks(index).difference(
+            self.requests.existing_requests_for_piece(index)
+        )
+
+    def _in_endgame(self) -> bool:
+        # Endgame starts once every block we still need has been requested,
+        # from then on peers are also asked for blocks already requested from
+        # other peers, so the last pieces don't wait on the slowest peer.
+        if not self._endgame:
+            if any(self._unrequested_blocks(i) for i in self._picker.wanted_pieces()):
+                return False
+            logger.info("Starting endgame")
+            self._endgame = True
+        return True
+
+    def _endgame_requests(self, peer_id: bytes, p_state: peer_state.PeerState, exclude, count):
+        # Blocks requested from other peers that this peer could send us,
+        # the ones requested from the fewest peers first.
+        existing_requests = self.requests.existing_requests_for_peer(peer_id)
+        blocks = [
+            block
+            for index in self._picker.candidates(p_state.get_pieces(), self._received_blocks)
+            for block in self._missing_blocks(index)
+            if block not in existing_requests and block not in exclude
+        ]
+        blocks.sort(key=self.requests.num_requests_for_block)
+        return blocks[:count]
+
+    async def refill_peer_requests(self, peer_id: bytes) -> None:
+        # Top up the requests we have in flight to one peer, using the
+        # picker to choose pieces it has that we still want.
         if self._state._complete.all():
             logger.info("Not making new requests, download is complete")
             return
-        if not self._peers:
-            logger.info("Not making new requests as there are no peers")
+        p_state = self._peers.get(peer_id)
+        if p_state is None or p_state.is_client_choked:
             return
-        for address, peer_state in self._peers.items():
-            if peer_state.is_client_choked:
-                continue
-            # TODO don't read private field of another object
-            targets = (~self._state._complete) & peer_state._pieces
-            target_index = _pick_random_one_in_bitarray(targets)
-            if target_index is not None:
-                logger.info(
-                    "{}: self any? {}, peer any? {}, target_index = {}".format(
-                        address, self._state._complete.any(), peer_state._pieces.any(), target_index
-                    )
-                )
-                existing_requests = self.requests.existing_requests_for_peer(address)
-                if len(existing_requests) > config.MAX_OUTSTANDING_REQUESTS_PER_PEER:
-                    logger.info(
-                        "{}: Not making new requests: {} existing".format(
-                            address, len(existing_requests)
-                        )
-                    )
-                    new_requests = set()
-                else:
-                    suggested_requests = self._blocks_from_index(target_index)
-                    new_requests = suggested_requests.difference(existing_requests)
-                    logger.info(
-                        "{}: {} suggested requests, {} existing".format(
-                            address, len(suggested_requests), len(existing_requests)
-                        )
-                    )
-                logger.info("{}: new_requests = {}".format(address, new_requests))
-                if new_requests:
-                    for r in new_requests:
-                        self.requests.add_request(address, r)
-                        incStats("requests_out")
-                    await peer_state.send_outgoing_data.send(("blocks_to_request", new_requests))
-            else:
-                logger.info("No target pieces for {}".format(address))
+        existing_requests = self.requests.num_requests_for_peer(peer_id)
+        capacity = self._request_pipeline_depth(p_state) - existing_requests
+        if capacity <= 0:
+            logger.info("{}: Not making new requests: {} existing".format(peer_id, existing_requests))
+            return
+        new_requests: List[Tuple[int, int, int]] = []
+        # NB - the picker must not be updated while we iterate over its candidates
+        for index in self._picker.candidates(p_state.get_pieces(), self._received_blocks):
+            new_requests.extend(sorted(self._unrequested_blocks(index)))
+            if len(new_requests) >= capacity:
+                new_requests = new_requests[:capacity]
+                break
+        if len(new_requests) < capacity and self._in_endgame():
+            duplicates = self._endgame_requests(
+                peer_id, p_state, set(new_requests), capacity - len(new_requests)
+            )
+            ENDGAME_REQUESTS_OUT.inc(len(duplicates))
+            new_requests.extend(duplicates)
+        if not new_requests:
+            logger.info("No target pieces for {}".format(peer_id))
+            return
+        logger.info(
+            "{}: {} new requests, {} existing".format(peer_id, len(new_requests), existing_requests)
+        )
+        logger.debug("{}: new_requests = {}".format(peer_id, new_requests))
+        for r in new_requests:
+            self.requests.add_request(peer_id, r)
+            REQUESTS_OUT.inc()
+        await p_state.send_outgoing_data.send(("blocks_to_request", new_requests))
+
+    def _request_pipeline_depth(self, p_state: peer_state.PeerState) -> int:
+        # With a download limit, only ask a peer for about as much as will
+        # be let in over REQUEST_QUEUE_SECONDS, it can't send us any more
+        # than that anyway.
+        if p_state.download_token_bucket is None:
+            rate = self.download_token_bucket.lowest_rate()
+        else:
+            rate = p_state.download_token_bucket.lowest_rate()
+        if rate is None:
+            return config.MAX_OUTSTANDING_REQUESTS_PER_PEER
+        depth = math.ceil(rate * config.REQUEST_QUEUE_SECONDS / config.BLOCK_SIZE)
+        return max(1, min(depth, config.MAX_OUTSTANDING_REQUESTS_PER_PEER))
+
+    async def refill_all_peer_requests(self) -> None:
+        for peer_id in list(self._peers):
+            await self.refill_peer_requests(peer_id)
+
+    def _schedule_refill_all(self) -> None:
+        # Called when requests are freed up (e.g. a peer leaves or chokes us)
+        # so other peers can pick up the blocks. Several calls before the
+        # refill runs only cause one refill.
+        try:
+            self._refill_all_needed[0].send_nowait(None)
+        except trio.WouldBlock:
+            pass
+
+    async def refill_all_loop(self):
+        while True:
+            await self._refill_all_needed[1].receive()
+            await self.refill_all_peer_requests()
+
+    def remove_peer(self, peer_id: bytes) -> None:
+        peer_s = self._peers.pop(peer_id)
+        # don't read blocks nobody will send
+        peer_s.cancel_uploads()
+        self._picker.remove_peer_pieces(peer_s.get_pieces())
+        self.requests.delete_all_for_peer(peer_id)
+        self._schedule_refill_all()
 
     async def handle_peer_message(self, peer_id, msg_type, msg_payload):
         if peer_id not in self._peers:
@@ -261,9 +578,13 @@ class Engine(object):
         if msg_type == messages.PeerMsg.CHOKE:
             logger.info("Received CHOKE from {}".format(peer_id))
             peer_state.choke_us()
+            # a peer discards our pending requests when it chokes us
+            self.requests.delete_all_for_peer(peer_id)
+            self._schedule_refill_all()
         elif msg_type == messages.PeerMsg.UNCHOKE:
             logger.info("Received UNCHOKE from {}".format(peer_id))
             peer_state.unchoke_us()
+            await self.refill_peer_requests(peer_id)
         elif msg_type == messages.PeerMsg.INTERESTED:
             logger.warning("Received INTERESTED from {} (not implemented)".format(peer_id))  # TODO
         elif msg_type == messages.PeerMsg.NOT_INTERESTED:
@@ -273,14 +594,21 @@ class Engine(object):
         elif msg_type == messages.PeerMsg.HAVE:
             index: int = messages.parse_have(msg_payload)
             logger.debug("Received HAVE {} from {}".format(index, peer_id))
-            peer_state.get_pieces()[index] = True
+            if not peer_state.get_pieces()[index]:
+                peer_state.get_pieces()[index] = True
+                self._picker.peer_has_piece(index)
+                if self._picker.is_wanted(index):
+                    await self.refill_peer_requests(peer_id)
         elif msg_type == messages.PeerMsg.BITFIELD:
             logger.info("Received BITFIELD from {}".format(peer_id))
             # TODO would be useful to log what percentage of the file the peer has
             bitfield = messages.parse_bitfield(msg_payload)
+            self._picker.remove_peer_pieces(peer_state.get_pieces())
             peer_state.set_pieces(bitfield)
+            self._picker.add_peer_pieces(peer_state.get_pieces())
+            await self.refill_peer_requests(peer_id)
         elif msg_type == messages.PeerMsg.REQUEST:
-            incStats("requests_in")
+            REQUESTS_IN.inc()
             request_info: Tuple[int, int, int] = messages.parse_request_or_cancel(msg_payload)
             logger.info("Received REQUEST from {} from {}".format(request_info, peer_state.peer_id))
             index = request_info[0]
@@ -288,30 +616,73 @@ class Engine(object):
                 logger.warning(
                     "{} requested {} but peer is choked".format(peer_state.peer_id, index)
                 )
+            elif request_info in peer_state.upload_requests:
+                logger.info("{} requested {} again".format(peer_state.peer_id, request_info))
             elif self._state._complete[index]:
-                await self._blocks_to_read.send((peer_state.peer_id, request_info))
+                upload_request = UploadRequest(peer_id, request_info)
+                peer_state.upload_requests[request_info] = upload_request
+                await self._blocks_to_read.send(upload_request)
             else:
                 logger.warning(
                     "{} requested {} but piece is incomplete".format(peer_state.peer_id, index)
                 )
         elif msg_type == messages.PeerMsg.PIECE:
             (index, begin, data) = messages.parse_piece(msg_payload)
-            incStats("blocks_in")
+            BLOCKS_IN.inc()
             logger.info(
                 "Received block {} from {}".format((index, begin, len(data)), peer_state.peer_id)
             )
-            peer_state.inc_download_counters()
+            self._state.add_downloaded(len(data))
+            block = (index, begin, len(data))
+            requested_at = self.requests.request_time(peer_id, block)
+            if requested_at is not None:
+                BLOCK_LATENCY.observe((datetime.datetime.now() - requested_at).total_seconds())
+            self.requests.delete_request(peer_id, block)
+            await self.cancel_requests(block)
             await self.handle_block_received(index, begin, data)
+            if (
+                self.requests.num_requests_for_peer(peer_id)
+                < config.REQUEST_PIPELINE_LOW_WATERMARK
+            ):
+                await self.refill_peer_requests(peer_id)
         elif msg_type == messages.PeerMsg.CANCEL:
-            logger.warning("Received CANCEL from {} (not implemented)".format(peer_id))  # TODO
+            CANCELS_IN.inc()
             request_info = messages.parse_request_or_cancel(msg_payload)
+            logger.info("Received CANCEL {} from {}".format(request_info, peer_id))
+            upload_request = peer_state.upload_requests.pop(request_info, None)
+            if upload_request is None:
+                logger.info("{} was already sent to {}".format(request_info, peer_id))
+            else:
+                upload_request.cancelled = True
+                if upload_request.read_started:
+                    CANCELLED_BEFORE_SEND.inc()
+                else:
+                    CANCELLED_BEFORE_READ.inc()
         else:
             # TODO - Exceptions are bad here! Should this be assert false?
             logger.warning("Bad message: length = {}".format(length))
             logger.warning("Bad message: data = {}".format(data))
             raise Exception("bad peer message")
 
+    async def cancel_requests(self, block: Tuple[int, int, int]) -> None:
+        # Once a block has arrived, tell any other peers we asked for it
+        # (in endgame) not to send it.
+        peer_ids = self.requests.peers_for_block(block)
+        for peer_id in peer_ids:
+            self.requests.delete_request(peer_id, block)
+            p_state = self._peers.get(peer_id)
+            if p_state is not None:
+                logger.info("Cancelling request for {} from {}".format(block, peer_id))
+                CANCELS_OUT.inc()
+                await p_state.send_outgoing_data.send(("blocks_to_cancel", [block]))
+        if peer_ids:
+            # the peers have room for other requests
+            self._schedule_refill_all()
+
     async def handle_block_received(self, index: int, begin: int, data: bytes) -> None:
+        if index in self._pieces_being_hashed or not self._picker.is_wanted(index):
+            logger.info("Ignoring block {} for a piece we already have".format((index, begin)))
+            return
         if index not in self._received_blocks:
             piece_length = self._state.piece_length(index)
             completed_blocks = bitarray.bitarray(math.ceil(piece_length / config.BLOCK_SIZE))
@@ -325,15 +696,37 @@ class Engine(object):
         completed_blocks[block_index] = True
         piece_data[begin : begin + len(data)] = data
         if completed_blocks.all():
+            # NB - the piece is marked as being hashed before it is removed from
+            # _received_blocks so its blocks are never requested again meanwhile
+            self._pieces_being_hashed.add(index)
+            self._received_blocks.pop(index)
+            await self._pieces_to_hash[0].send((index, piece_data))
+
+    @property
+    def hash_queue_depth(self) -> int:
+        """
+        Number of complete pieces waiting for, or going through, a hash check.
+        """
+        return len(self._pieces_being_hashed)
+
+    async def piece_hashing_loop(self):
+        # Several of these loops run at once. hashlib releases the GIL for
+        # large inputs, so hashing in threads doesn't hold up the event loop.
+        while True:
+            index, piece_data = await self._pieces_to_hash[1].receive()
             piece_info = self._state.piece_info(index)
-            complete_piece = bytes(piece_data)
-            if hashlib.sha1(complete_piece).digest() == piece_info.sha1hash:
-                self._received_blocks.pop(index)  # TODO is this ordering significant?
-                await self._complete_pieces_to_write.send((index, complete_piece))
+            start = trio.current_time()
+            sha1hash = await trio.to_thread.run_sync(_sha1, piece_data)
+            HASH_SECONDS.observe(trio.current_time() - start)
+            self._pieces_being_hashed.discard(index)
+            if sha1hash == piece_info.sha1hash:
+                # stop requesting the piece while it is being written
+                self._picker.piece_complete(index)
+                await self._complete_pieces_to_write.send(("write_piece", (index, piece_data)))
             else:
-                self._received_blocks.pop(index)
                 self.requests.delete_all_for_piece(index)
                 logger.warning("sha1hash does not match for index {}".format(index))
+                self._schedule_refill_all()
 
     async def peer_messages_loop(self):
         while True:
@@ -345,7 +738,6 @@ class Engine(object):
             await self.handle_peer_message(
                 peer_state.peer_id, msg_type, msg_payload
             )  # TODO should use peer_id
-            await self.update_peer_requests()
 
     async def announce_have_piece(self, index):
         peers = (
@@ -363,21 +755,22 @@ class Engine(object):
             # the most upto date bitfield (they may also get a redundant HAVE message)
             self._state._complete[index] = True  # TODO remove private property access
             await self.announce_have_piece(index)
-            await self.update_peer_requests()
 
     async def file_reading_loop(self):
         while True:
             logger.debug("file_reading_loop")
-            peer_id, block_details, block = await self._blocks_for_peers.receive()
-            incStats("blocks_out")
+            upload_request, block = await self._blocks_for_peers.receive()
+            if upload_request.cancelled:
+                continue
+            BLOCKS_OUT.inc()
+            peer_id = upload_request.peer_id
             if peer_id in self._peers:
                 p_state = self._peers[peer_id]
-                p_state.inc_upload_counters()
-                await p_state.send_outgoing_data.send(("block_to_upload", (block_details, block)))
+                await p_state.send_outgoing_data.send(("block_to_upload", (upload_request, block)))
             else:
                 logger.info(
                     "dropped block {} for {} because peer no longer exists".format(
-                        block_details, peer_id
+                        upload_request.block, peer_id
                     )
                 )
 
@@ -387,14 +780,16 @@ class Engine(object):
         while True:
             await trio.sleep(10)
             peers = [
-                (peer_id, peer_s.get_20_second_rolling_download_count())
+                (peer_id, peer_s.download_meter.window_rate())
                 for peer_id, peer_s in self._peers.items()
             ]
             if period == 0 and peers:
                 optimistic_unchoke = random.choice(peers)[0]
             peers = sorted(peers, key=lambda x: x[1], reverse=True)
             logger.info(
-                "Peers ordered by successful downloads in last 20 seconds: {}".format(peers)
+                "Peers ordered by download rate in last {} seconds: {}".format(
+                    config.RATE_WINDOW_SECONDS, peers
+                )
             )
             # First X are unchoked
             # Rest are choked
@@ -407,67 +802,143 @@ class Engine(object):
                 if p_id in self._peers:  # protect against state change while putting in queue
                     p_state = self._peers[p_id]
                     alert = p_state.unchoke_them()
-                    p_state.reset_rolling_download_count()
                     if alert == peer_state.ChokeAlert.ALERT:
                         await p_state.send_outgoing_data.send(("unchoke", None))
             for p_id in choke:
                 if p_id in self._peers:  # protect against state change while putting in queue
                     p_state = self._peers[p_id]
                     alert = p_state.choke_them()
-                    p_state.reset_rolling_download_count()
                     if alert == peer_state.ChokeAlert.ALERT:
+                        # a choked peer discards its requests, so don't send them
+                        p_state.cancel_uploads()
                         await p_state.send_outgoing_data.send(("choke", None))
             # update period
             period = (period + 1) % 3  # rotate period every 30 seconds
 
+    async def partial_pieces_loop(self):
+        # Regularly send blocks of incomplete pieces to be written to disk,
+        # so they are kept in the fast-resume file.
+        saved_counts: Dict[int, int] = dict()
+        while True:
+            await trio.sleep(config.PARTIAL_PIECES_SAVE_SECONDS)
+            saved_counts = {i: c for i, c in saved_counts.items() if i in self._received_blocks}
+            for index, (blocks, piece_data) in list(self._received_blocks.items()):
+                count = blocks.count()
+                if saved_counts.get(index) != count:
+                    saved_counts[index] = count
+                    await self._complete_pieces_to_write.send(
+                        ("write_partial_piece", (index, blocks.copy(), piece_data))
+                    )
+
     async def delete_stale_requests_loop(self, seconds):
         while True:
             await trio.sleep(seconds)
             count = self.requests.delete_older_than(seconds=seconds)
             logging.info("Deleted {} stale requests (older than {} seconds)".format(count, seconds))
-
-
-def run(torrent):
-    try:
-        # create FileManager and check hashes if file already exists
-        file_wrapper = file_manager.FileWrapper(torrent=torrent)
-        existing_hashes = file_wrapper.create_file_or_return_hashes()
-
+            if count:
+                self._schedule_refill_all()
+
+
+def _check_progress(torrent, show_display=True):
+    # progress callback for checking a torrent's existing pieces at startup
+    def progress(checked, total):
+        logger.info("Checked {}/{} existing pieces of {}".format(checked, total, torrent.name))
+        if show_display:
+            display.print_check_progress(torrent.name, checked, total)
+
+    return progress
+
+
+def make_engine(
+    torrent,
+    piece_picker_strategy=config.PIECE_PICKER_STRATEGY,
+    hash_workers=config.HASH_WORKERS,
+    preallocation=config.PREALLOCATION_MODE,
+    piece_cache_bytes=config.PIECE_CACHE_BYTES,
+    storage_backend=config.STORAGE_BACKEND,
+    **engine_options
+) -> Tuple[file_manager.FileManager, Engine]:
+    """
+    Open (or create) the files for a torrent, checking the pieces that
+    are already there, and return the FileManager and Engine for it.
+    Any other keyword arguments are passed to the Engine.
+    """
+    # create FileManager and check hashes if file already exists
+    file_wrapper = file_manager.FileWrapper(
+        torrent=torrent, preallocation=preallocation, storage_backend=storage_backend
+    )
+    resume_data = file_wrapper.load_fast_resume()
+    partial_pieces = None
+
+    if resume_data:
+        complete, partial_pieces = resume_data
+        torrent._complete[:] = complete  # TODO remove private property access
+    else:
+        existing_hashes = file_wrapper.create_file_or_return_hashes(
+            hash_workers=hash_workers,
+            progress=_check_progress(torrent, engine_options.get("show_display", True)),
+        )
         if existing_hashes:
             for index, h in enumerate(existing_hashes):
                 piece_info = torrent.piece_info(index)
                 if piece_info.sha1hash == h:
                     torrent._complete[index] = True  # TODO remove private property access
 
-        s_complete_pieces, r_complete_pieces = trio.open_memory_channel(config.INTERNAL_QUEUE_SIZE)
-        s_write_confirmations, r_write_confirmations = trio.open_memory_channel(
-            config.INTERNAL_QUEUE_SIZE
-        )
-        s_blocks_to_read, r_blocks_to_read = trio.open_memory_channel(config.INTERNAL_QUEUE_SIZE)
-        s_blocks_for_peers, r_blocks_for_peers = trio.open_memory_channel(
-            config.INTERNAL_QUEUE_SIZE
-        )
-
-        file_engine = file_manager.FileManager(
-            file_wrapper=file_wrapper,
-            pieces_to_write=r_complete_pieces,
-            write_confirmations=s_write_confirmations,
-            blocks_to_read=r_blocks_to_read,
-            blocks_for_peers=s_blocks_for_peers,
-        )
-
-        engine = Engine(
-            torrent=torrent,
-            complete_pieces_to_write=s_complete_pieces,
-            write_confirmations=r_write_confirmations,
-            blocks_to_read=s_blocks_to_read,
-            blocks_for_peers=r_blocks_for_peers,
+    s_complete_pieces, r_complete_pieces = trio.open_memory_channel(config.INTERNAL_QUEUE_SIZE)
+    s_write_confirmations, r_write_confirmations = trio.open_memory_channel(
+        config.INTERNAL_QUEUE_SIZE
+    )
+    s_blocks_to_read, r_blocks_to_read = trio.open_memory_channel(config.INTERNAL_QUEUE_SIZE)
+    s_blocks_for_peers, r_blocks_for_peers = trio.open_memory_channel(config.INTERNAL_QUEUE_SIZE)
+
+    file_engine = file_manager.FileManager(
+        file_wrapper=file_wrapper,
+        pieces_to_write=r_complete_pieces,
+        write_confirmations=s_write_confirmations,
+        blocks_to_read=r_blocks_to_read,
+        blocks_for_peers=s_blocks_for_peers,
+        piece_cache_bytes=piece_cache_bytes,
+    )
+
+    engine = Engine(
+        torrent=torrent,
+        complete_pieces_to_write=s_complete_pieces,
+        write_confirmations=r_write_confirmations,
+        blocks_to_read=s_blocks_to_read,
+        blocks_for_peers=r_blocks_for_peers,
+        piece_picker_strategy=piece_picker_strategy,
+        hash_workers=hash_workers,
+        partial_pieces=partial_pieces,
+        **engine_options
+    )
+    return file_engine, engine
+
+
+def run(
+    torrent,
+    piece_picker_strategy=config.PIECE_PICKER_STRATEGY,
+    hash_workers=config.HASH_WORKERS,
+    preallocation=config.PREALLOCATION_MODE,
+    piece_cache_bytes=config.PIECE_CACHE_BYTES,
+    storage_backend=config.STORAGE_BACKEND,
+    metrics_port=config.METRICS_PORT,
+):
+    try:
+        file_engine, engine = make_engine(
+            torrent,
+            piece_picker_strategy=piece_picker_strategy,
+            hash_workers=hash_workers,
+            preallocation=preallocation,
+            piece_cache_bytes=piece_cache_bytes,
+            storage_backend=storage_backend,
         )
 
         async def run():
             async with trio.open_nursery() as nursery:
                 nursery.start_soon(file_engine.run)
                 nursery.start_soon(engine.run)
+                if metrics_port is not None:
+                    nursery.start_soon(metrics.serve, metrics_port)
 
         trio.run(run)
     except KeyboardInterrupt:
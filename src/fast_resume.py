@@ -0,0 +1,143 @@
+# Fast-resume files are kept next to the downloaded file so that a restart
+# doesn't need to hash the whole file again, and blocks of incomplete
+# pieces that were written to disk aren't downloaded again.
+#
+# The file is a bencoded dictionary:
+#
+# d['complete'] -> bitfield of the pieces that were written and verified
+#
+# d['file size'], d['mtime'] -> total size and latest modification time of
+# the downloaded files when the resume file was saved, if either has changed
+# since then the resume file is ignored (so pieces written after the last
+# save, e.g. before a crash, mean the file is hashed again)
+#
+# d['info hash'] -> the torrent the file belongs to
+#
+# d['partial'] -> list of [index, block bitfield] for pieces where only some
+# blocks have been written
+
+import logging
+import math
+import os
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import bitarray
+
+import bencode
+import config
+
+logger = logging.getLogger("fast_resume")
+
+ResumeData = NamedTuple(
+    "ResumeData", [("complete", bitarray.bitarray), ("partial", Dict[int, bitarray.bitarray])]
+)
+
+
+def _blocks_in_piece(torrent, index: int) -> int:
+    return math.ceil(torrent.piece_length(index) / config.BLOCK_SIZE)
+
+
+def _bitarray_from_bytes(raw: bytes, length: int) -> bitarray.bitarray:
+    b = bitarray.bitarray()
+    b.frombytes(raw)
+    return b[:length]
+
+
+def stat_file(torrent, data_path: str, file_index: int) -> Tuple[int, int]:
+    """
+    Size and modification time of one of the torrent's files, data_path is
+    the file, or the directory of a multi-file torrent.
+    """
+    stat = os.stat(os.path.join(data_path, *torrent.files[file_index].path))
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _stat(torrent, data_path: str, file_stats: Optional[List[Tuple[int, int]]] = None):
+    if file_stats is None:
+        file_stats = [stat_file(torrent, data_path, i) for i in range(len(torrent.files))]
+    size = sum(s for s, _ in file_stats)
+    mtime = max((m for _, m in file_stats), default=0)
+    return size, mtime
+
+
+def _valid_partial(torrent, partial, num_pieces: int) -> bool:
+    # a list of [index, block bitfield] with a bitfield of the right length
+    if not isinstance(partial, list):
+        return False
+    for entry in partial:
+        if not (isinstance(entry, list) and len(entry) == 2):
+            return False
+        index, raw_blocks = entry
+        if not (isinstance(index, int) and 0 <= index < num_pieces):
+            return False
+        if not isinstance(raw_blocks, bytes):
+            return False
+        if len(raw_blocks) != math.ceil(_blocks_in_piece(torrent, index) / 8):
+            return False
+    return True
+
+
+def save(
+    path: str,
+    torrent,
+    data_path: str,
+    resume_data: ResumeData,
+    file_stats: Optional[List[Tuple[int, int]]] = None,
+) -> None:
+    """
+    Write the resume file. `file_stats` is the stat_file result for each of
+    the torrent's files, if the caller keeps them up to date, otherwise
+    every file is stat'ed.
+    """
+    size, mtime = _stat(torrent, data_path, file_stats)
+    d = {
+        b"complete": resume_data.complete.tobytes(),
+        b"file size": size,
+        b"info hash": torrent.info_hash,
+        b"mtime": mtime,
+        b"partial": [[i, blocks.tobytes()] for i, blocks in sorted(resume_data.partial.items())],
+    }
+    # write then rename, so a crash can't leave a half written resume file
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(bencode.encode_value(d))
+    os.replace(tmp_path, path)
+
+
+def load(path: str, torrent, data_path: str) -> Optional[ResumeData]:
+    try:
+        with open(path, "rb") as f:
+            d = bencode.decode(f.read())
+        size, mtime = _stat(torrent, data_path)
+    except FileNotFoundError:
+        return None
+    except Exception:
+        logger.exception("Could not read fast-resume file {}".format(path))
+        return None
+    num_pieces = torrent._num_pieces  # TODO remove private property access
+    if not isinstance(d, dict):
+        reason = "not a dictionary"
+    elif d.get(b"info hash") != torrent.info_hash:
+        reason = "info hash does not match"
+    elif d.get(b"file size") != size:
+        reason = "file size has changed"
+    elif d.get(b"mtime") != mtime:
+        reason = "file has been modified"
+    elif not isinstance(d.get(b"complete"), bytes):
+        reason = "no complete pieces"
+    elif len(d[b"complete"]) != math.ceil(num_pieces / 8):
+        reason = "wrong number of pieces"
+    elif not _valid_partial(torrent, d.get(b"partial"), num_pieces):
+        reason = "invalid partial pieces"
+    else:
+        reason = None
+    if reason:
+        logger.info("Ignoring fast-resume file {}: {}".format(path, reason))
+        return None
+    complete = _bitarray_from_bytes(d[b"complete"], num_pieces)
+    partial = {
+        index: _bitarray_from_bytes(raw_blocks, _blocks_in_piece(torrent, index))
+        for index, raw_blocks in d[b"partial"]
+        if not complete[index]
+    }
+    return ResumeData(complete, partial)
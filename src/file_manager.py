@@ -1,72 +1,387 @@
+import concurrent.futures
+import errno
 import hashlib
 import logging
 import os
-from typing import Any
+import threading
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
 
 logger = logging.getLogger("file_manager")
 
+import bitarray
 import trio
 
+import config
+import fast_resume
+import metrics
+from piece_cache import PieceCache
+from storage import STORAGE_BACKENDS, FileSpans, TorrentStorage
 import torrent as tstate
 
 
-def _create_empty_file(path, torrent):
+# index -> (received blocks, piece data), as in Engine._received_blocks
+PartialPieces = Dict[int, Tuple[bitarray.bitarray, bytearray]]
+
+DISK_SECONDS = metrics.REGISTRY.histogram(
+    "kouzui_disk_seconds",
+    "Time taken by disk reads and writes, including waiting for a thread",
+    ["op"],
+)
+DISK_QUEUE = metrics.REGISTRY.gauge(
+    "kouzui_disk_queue", "Disk operations queued or in progress", ["torrent", "queue"]
+)
+
+
+def _preallocate_full(path: str, length: int) -> None:
+    # write zeros for the whole file
+    chunk = bytes(min(length, 1024 ** 2))
     with open(path, "wb") as f:
-        for i in range(torrent._num_pieces):  # TODO remove private property access
-            b = bytes(torrent.piece_length(i))
-            f.write(b)
+        for start in range(0, length, len(chunk) or 1):
+            f.write(chunk[: length - start])
+
+
+def _preallocate_sparse(path: str, length: int) -> None:
+    # set the size without allocating any blocks, the filesystem allocates
+    # them as pieces are written
+    with open(path, "wb") as f:
+        f.truncate(length)
+
+
+def _preallocate_fallocate(path: str, length: int) -> None:
+    # reserve the blocks up front without writing them
+    if not hasattr(os, "posix_fallocate"):
+        logger.warning("fallocate is not available on this platform, using a sparse file")
+        _preallocate_sparse(path, length)
+        return
+    try:
+        with open(path, "wb") as f:
+            if length > 0:
+                os.posix_fallocate(f.fileno(), 0, length)
+    except OSError as e:
+        if e.errno in (errno.EOPNOTSUPP, errno.ENOTSUP, errno.EINVAL):
+            # e.g. some network and FUSE filesystems
+            logger.warning(
+                "fallocate is not supported for {} ({}), using a sparse file".format(path, e)
+            )
+            _preallocate_sparse(path, length)
+            return
+        # don't leave a short file that would be taken for an existing download
+        os.remove(path)
+        if e.errno == errno.ENOSPC:
+            raise OSError(
+                e.errno, "Not enough disk space to allocate {} bytes for {}".format(length, path)
+            ) from e
+        raise
+
+
+PREALLOCATION_MODES = {
+    "sparse": _preallocate_sparse,
+    "fallocate": _preallocate_fallocate,
+    "full": _preallocate_full,
+}
+
+
+def _hash_piece_range(root, torrent, spans: FileSpans, first: int, last: int) -> List[bytes]:
+    # Read several pieces at a time into one buffer and hash them in place
+    piece_length = torrent._piece_length  # TODO remove private property access
+    total_length = torrent._file_length  # TODO remove private property access
+    pieces_per_read = max(1, config.RESUME_READ_SIZE // piece_length)
+    buffer = bytearray(pieces_per_read * piece_length)
+    view = memoryview(buffer)
+    hashes = []
+    # the ranges are read in order, so only one file needs to be open
+    open_index, f = None, None
+    try:
+        for start in range(first, last, pieces_per_read):
+            end = min(last, start + pieces_per_read)
+            read_start = start * piece_length
+            read_length = min(end * piece_length, total_length) - read_start
+            pos = 0
+            for file_index, file_offset, n in spans.segments(read_start, read_length):
+                if file_index != open_index:
+                    if f:
+                        f.close()
+                    f = open(os.path.join(root, *torrent.files[file_index].path), "rb", buffering=0)
+                    open_index = file_index
+                f.seek(file_offset)
+                got = f.readinto(view[pos : pos + n])
+                if got < n:
+                    # the file is shorter than it should be
+                    view[pos + got : pos + n] = bytes(n - got)
+                pos += n
+            for i in range(start, end):
+                offset = (i - start) * piece_length
+                piece_end = offset + torrent.piece_length(i)
+                hashes.append(hashlib.sha1(view[offset:piece_end]).digest())
+    finally:
+        if f:
+            f.close()
+    return hashes
+
+
+def hash_pieces(
+    path, torrent, workers: int = 1, progress: Optional[Callable[[int, int], None]] = None
+) -> List[bytes]:
+    """
+    Hash every piece of existing files. The pieces are split into
+    contiguous ranges that are read sequentially and hashed by a pool of
+    threads, both file reads and hashlib release the GIL.
+    `progress` is called with the number of pieces checked so far and the
+    total number of pieces.
+    """
+    num_pieces = torrent._num_pieces  # TODO remove private property access
+    pieces_per_task = max(1, config.RESUME_TASK_SIZE // torrent._piece_length)
+    spans = FileSpans([f.length for f in torrent.files])
+    ranges = [
+        (i, min(i + pieces_per_task, num_pieces)) for i in range(0, num_pieces, pieces_per_task)
+    ]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(_hash_piece_range, path, torrent, spans, first, last): last - first
+            for first, last in ranges
+        }
+        checked = 0
+        for future in concurrent.futures.as_completed(futures):
+            checked += futures[future]
+            if progress:
+                progress(checked, num_pieces)
+        return [h for future in futures for h in future.result()]
 
 
 class FileWrapper(object):
-    def __init__(self, *, torrent: tstate.Torrent, file_suffix: str = "") -> None:
+    def __init__(
+        self,
+        *,
+        torrent: tstate.Torrent,
+        file_suffix: str = "",
+        preallocation: str = config.PREALLOCATION_MODE,
+        storage_backend: str = config.STORAGE_BACKEND,
+    ) -> None:
+        if preallocation not in PREALLOCATION_MODES:
+            raise Exception("Unknown preallocation mode: {}".format(preallocation))
+        if storage_backend not in STORAGE_BACKENDS:
+            raise Exception("Unknown storage backend: {}".format(storage_backend))
         self._torrent = torrent
+        self._preallocate = PREALLOCATION_MODES[preallocation]
+        self._storage_class = STORAGE_BACKENDS[storage_backend]
         self._tmp_path = torrent.file_path + file_suffix + ".part"
         self._final_path = torrent.file_path + file_suffix
+        self._resume_path = torrent.file_path + file_suffix + ".resume"
         self._file_path = None
-        self._file: Any = None
+        self._storage: Any = None
+        # what has been written to the file, for the fast-resume file
+        self._written: Optional[bitarray.bitarray] = None
+        self._partial: Dict[int, bitarray.bitarray] = dict()
+        # the fast-resume file is saved by save_fast_resume_if_changed, the
+        # size and mtime of each file are kept and only the files written
+        # since the last save are stat'ed again
+        self._resume_changed = False
+        self._spans = FileSpans([f.length for f in torrent.files])
+        self._file_stats: Optional[List[Tuple[int, int]]] = None
+        self._files_written: Set[int] = set()
+        # Reads and writes can be called from several threads at once.
+        # Writes to the same piece are serialised and the fast-resume state
+        # has its own lock.
+        self._piece_locks = [threading.Lock() for _ in range(64)]
+        self._resume_lock = threading.Lock()
+
+    @property
+    def torrent_name(self) -> str:
+        return self._torrent.name
+
+    def _open(self):
+        files = self._torrent.files
+        if len(files) == 1 and not files[0].path:
+            # a single file doesn't need TorrentStorage to map offsets
+            self._storage = self._storage_class(self._file_path)
+        else:
+            self._storage = TorrentStorage(self._file_path, files, self._storage_class)
 
-    def create_file_or_return_hashes(self):
+    def _choose_file_path(self):
         if os.path.exists(self._final_path):
             self._file_path = self._final_path
         else:
             self._file_path = self._tmp_path
-        try:
-            self._file = open(self._file_path, "rb")
-            hashes = []
-            for i, _ in enumerate(self._torrent._complete):
-                l = self._torrent.piece_length(i)
-                p = self.read_block(i, 0, l)
-                h = hashlib.sha1(p).digest()
-                hashes.append(h)
-            self._file.close()
-        except FileNotFoundError:
-            _create_empty_file(self._file_path, self._torrent)  # TODO don't read private property
+
+    def load_fast_resume(self) -> Optional[Tuple[bitarray.bitarray, PartialPieces]]:
+        """
+        Open an existing file using its fast-resume file instead of hashing it.
+        Returns None if there is no up to date fast-resume file, otherwise
+        the complete pieces and the blocks already written for incomplete
+        pieces (in the same format as Engine._received_blocks).
+        """
+        self._choose_file_path()
+        resume_data = fast_resume.load(self._resume_path, self._torrent, self._file_path)
+        if resume_data is None:
+            return None
+        self._open()
+        self._written = resume_data.complete
+        self._partial = resume_data.partial
+        partial_pieces = dict()
+        for index, blocks in self._partial.items():
+            piece_data = bytearray(self._torrent.piece_length(index))
+            for begin, length in self._block_ranges(index, blocks):
+                piece_data[begin : begin + length] = self.read_block(index, begin, length)
+            partial_pieces[index] = (blocks.copy(), piece_data)
+        logger.info(
+            "Loaded fast-resume file {}: {} complete pieces, {} partial pieces".format(
+                self._resume_path, self._written.count(), len(self._partial)
+            )
+        )
+        return (self._written.copy(), partial_pieces)
+
+    def _create_missing_files(self) -> bool:
+        # Returns True if any of the files already existed
+        existed = False
+        for f in self._torrent.files:
+            path = os.path.join(self._file_path, *f.path)
+            if os.path.exists(path):
+                existed = True
+                continue
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._preallocate(path, f.length)
+        return existed
+
+    def create_file_or_return_hashes(self, hash_workers=1, progress=None):
+        self._choose_file_path()
+        if self._create_missing_files():
+            hashes = hash_pieces(self._file_path, self._torrent, hash_workers, progress)
+        else:
             hashes = None
-        self._file = open(self._file_path, "rb+")
+        self._open()
+        self._written = bitarray.bitarray(self._torrent._num_pieces)  # TODO
+        self._written.setall(False)
+        if hashes:
+            for index, h in enumerate(hashes):
+                self._written[index] = self._torrent.piece_info(index).sha1hash == h
+        self._partial = dict()
+        self._save_fast_resume()
         return hashes
 
+    def _save_fast_resume(self) -> None:
+        # called with _resume_lock held, except before any reads or writes
+        if self._file_stats is None:
+            self._files_written = set(range(len(self._torrent.files)))
+            self._file_stats = [(0, 0)] * len(self._torrent.files)
+        for i in self._files_written:
+            self._file_stats[i] = fast_resume.stat_file(self._torrent, self._file_path, i)
+        self._files_written = set()
+        fast_resume.save(
+            self._resume_path,
+            self._torrent,
+            self._file_path,
+            fast_resume.ResumeData(self._written, self._partial),
+            self._file_stats,
+        )
+        self._resume_changed = False
+
+    def _resume_changed_by_write(self, start: int, length: int) -> None:
+        # called with _resume_lock held
+        self._resume_changed = True
+        for file_index, _, _ in self._spans.segments(start, length):
+            self._files_written.add(file_index)
+
+    def save_fast_resume_if_changed(self) -> None:
+        with self._resume_lock:
+            if self._resume_changed:
+                self._save_fast_resume()
+
+    def _block_ranges(self, index: int, blocks: bitarray.bitarray) -> List[Tuple[int, int]]:
+        piece_length = self._torrent.piece_length(index)
+        return [
+            (i * config.BLOCK_SIZE, min(config.BLOCK_SIZE, piece_length - i * config.BLOCK_SIZE))
+            for i, received in enumerate(blocks)
+            if received
+        ]
+
     def write_piece(self, index: int, piece: bytes) -> None:
         start = index * self._torrent._piece_length  # TODO
-        self._file.seek(start)
-        self._file.write(piece)
-        self._file.flush()
+        with self._piece_locks[index % len(self._piece_locks)]:
+            self._storage.write(start, piece)
+            self._storage.flush(start, len(piece))
+            # still holding the piece lock, so a queued write_partial_piece
+            # sees the piece is written
+            with self._resume_lock:
+                self._written[index] = True
+                self._partial.pop(index, None)
+                self._resume_changed_by_write(start, len(piece))
+
+    def write_partial_piece(self, index: int, blocks: bitarray.bitarray, piece: bytes) -> None:
+        """
+        Write the received blocks of an incomplete piece, so they don't
+        need to be downloaded again after a restart.
+        """
+        piece_start = index * self._torrent._piece_length  # TODO
+        with self._piece_locks[index % len(self._piece_locks)]:
+            # the complete piece may have been written since this was queued
+            if self._written[index]:
+                return
+            piece_view = memoryview(piece)
+            for begin, length in self._block_ranges(index, blocks):
+                self._storage.write(piece_start + begin, piece_view[begin : begin + length])
+            self._storage.flush(piece_start, len(piece))
+            with self._resume_lock:
+                self._partial[index] = blocks
+                self._resume_changed_by_write(piece_start, len(piece))
 
     def read_block(self, index: int, begin: int, length: int) -> bytes:
         start = index * self._torrent._piece_length + begin
-        self._file.seek(start)
-        block = self._file.read(length)
-        return block
+        return self._storage.read(start, length)
+
+    def read_piece(self, index: int) -> bytes:
+        return self.read_block(index, 0, self._torrent.piece_length(index))
+
+    def piece_length(self, index: int) -> int:
+        return self._torrent.piece_length(index)
 
     def move_file_to_final_location(self):
-        if self._file_path != self._final_path:
-            self._file.close()
-            os.rename(self._file_path, self._final_path)
-            logger.info("Moved {} to {}".format(self._file_path, self._final_path))
-            self._file_path = self._final_path
-            self._file = open(self._file_path, "rb+")
+        with self._resume_lock:
+            if self._file_path != self._final_path:
+                os.rename(self._file_path, self._final_path)
+                logger.info("Moved {} to {}".format(self._file_path, self._final_path))
+                self._file_path = self._final_path
+                self._storage.moved(self._file_path)
+                self._save_fast_resume()
+
+
+class IOLatency(object):
+    """
+    Count, mean and maximum of the time taken by disk operations,
+    including any time spent waiting for a worker thread.
+    """
+
+    def __init__(self, histogram: Optional[metrics.Histogram] = None) -> None:
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self._histogram = histogram
+
+    def add(self, seconds: float) -> None:
+        if self._histogram is not None:
+            self._histogram.observe(seconds)
+        self.count += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    @property
+    def mean_seconds(self) -> float:
+        return self.total_seconds / self.count if self.count else 0.0
+
+    def __repr__(self):
+        return "IOLatency(count={}, mean={:.4f}s, max={:.4f}s)".format(
+            self.count, self.mean_seconds, self.max_seconds
+        )
 
 
 class FileManager(object):
+    """
+    Runs reads and writes for the Engine on a bounded pool of worker
+    threads, so a slow disk doesn't hold up the event loop. Several
+    reading and writing loops run at once, sharing the thread pool.
+    """
+
     def __init__(
         self,
         *,
@@ -75,33 +390,133 @@ class FileManager(object):
         write_confirmations: trio.MemorySendChannel,
         blocks_to_read: trio.MemoryReceiveChannel,
         blocks_for_peers: trio.MemorySendChannel,
+        io_workers: int = config.DISK_IO_WORKERS,
+        piece_cache_bytes: int = config.PIECE_CACHE_BYTES,
     ) -> None:
         self._file_wrapper = file_wrapper
         self._pieces_to_write = pieces_to_write
         self._write_confirmations = write_confirmations
         self._blocks_to_read = blocks_to_read
         self._blocks_for_peers = blocks_for_peers
-
-    # async def move_file_to_final_location(self):
-    #    self._file_wrapper.move_file_to_final_location()
+        self._io_workers = io_workers
+        self._io_limiter = trio.CapacityLimiter(io_workers)
+        self.read_latency = IOLatency(DISK_SECONDS.labels("read"))
+        self.write_latency = IOLatency(DISK_SECONDS.labels("write"))
+        self.piece_cache = PieceCache(piece_cache_bytes)
+        # pieces being read into the cache, so only one reader goes to disk
+        self._piece_reads: Dict[int, trio.Event] = dict()
 
     async def run(self):
-        async with trio.open_nursery() as nursery:
-            nursery.start_soon(self.piece_writing_loop)
-            nursery.start_soon(self.block_reading_loop)
+        metrics.REGISTRY.add_collector(self.collect_metrics)
+        try:
+            async with trio.open_nursery() as nursery:
+                for _ in range(self._io_workers):
+                    nursery.start_soon(self.piece_writing_loop)
+                    nursery.start_soon(self.block_reading_loop)
+                nursery.start_soon(self.info_loop)
+                nursery.start_soon(self.resume_saving_loop)
+        finally:
+            metrics.REGISTRY.remove_collector(self.collect_metrics)
+            DISK_QUEUE.clear(self._file_wrapper.torrent_name)
+
+    async def _run_in_thread(self, latency: IOLatency, fn, *args):
+        start = trio.current_time()
+        result = await trio.to_thread.run_sync(fn, *args, limiter=self._io_limiter)
+        latency.add(trio.current_time() - start)
+        return result
+
+    def queue_depths(self) -> Dict[str, int]:
+        limiter_stats = self._io_limiter.statistics()
+        return {
+            "writes_queued": self._pieces_to_write.statistics().current_buffer_used,
+            "reads_queued": self._blocks_to_read.statistics().current_buffer_used,
+            "waiting_for_thread": limiter_stats.tasks_waiting,
+            "in_progress": limiter_stats.borrowed_tokens,
+        }
+
+    def collect_metrics(self) -> None:
+        name = self._file_wrapper.torrent_name
+        for queue, depth in self.queue_depths().items():
+            DISK_QUEUE.labels(name, queue).set(depth)
+
+    async def info_loop(self):
+        while True:
+            logger.info(
+                "Disk I/O queues {}, reads {}, writes {}, {}".format(
+                    self.queue_depths(), self.read_latency, self.write_latency, self.piece_cache
+                )
+            )
+            await trio.sleep(1)
+
+    async def resume_saving_loop(self):
+        try:
+            while True:
+                await trio.sleep(config.RESUME_SAVE_SECONDS)
+                await trio.to_thread.run_sync(
+                    self._file_wrapper.save_fast_resume_if_changed, limiter=self._io_limiter
+                )
+        finally:
+            # keep what has been written when the FileManager stops
+            self._file_wrapper.save_fast_resume_if_changed()
 
     async def piece_writing_loop(self):
         while True:
-            index, piece = await self._pieces_to_write.receive()
-            if (index is None) and (piece is None):  # TODO better msg types
+            command, data = await self._pieces_to_write.receive()
+            if command == "move_to_final_location":
                 self._file_wrapper.move_file_to_final_location()
-            else:
-                self._file_wrapper.write_piece(index, piece)
+            elif command == "write_piece":
+                index, piece = data
+                await self._run_in_thread(
+                    self.write_latency, self._file_wrapper.write_piece, index, piece
+                )
                 logger.info("Wrote #{} to disk".format(index))
                 await self._write_confirmations.send(index)
+            elif command == "write_partial_piece":
+                index, blocks, piece = data
+                await self._run_in_thread(
+                    self.write_latency, self._file_wrapper.write_partial_piece, index, blocks, piece
+                )
+                logger.info("Wrote {} blocks of #{} to disk".format(blocks.count(), index))
+            else:
+                logger.warning("FileManager received unsupported command: {}".format(command))
+
+    async def _read_piece(self, index: int) -> bytes:
+        # Read the whole piece the first time one of its blocks is requested,
+        # later requests for it are served from the cache.
+        piece = self.piece_cache.get(index)
+        if piece is not None:
+            return piece
+        # wait for another task's read of the piece, if that fails (or the
+        # piece isn't cached) another waiter may have started a new read
+        while index in self._piece_reads:
+            await self._piece_reads[index].wait()
+            piece = self.piece_cache.get(index, count=False)
+            if piece is not None:
+                return piece
+        done = trio.Event()
+        self._piece_reads[index] = done
+        try:
+            piece = await self._run_in_thread(
+                self.read_latency, self._file_wrapper.read_piece, index
+            )
+            self.piece_cache.put(index, piece)
+        finally:
+            del self._piece_reads[index]
+            done.set()
+        return piece
 
     async def block_reading_loop(self):
         while True:
-            who, (index, begin, length) = await self._blocks_to_read.receive()
-            block = self._file_wrapper.read_block(index, begin, length)
-            await self._blocks_for_peers.send((who, (index, begin, length), block))
+            request = await self._blocks_to_read.receive()
+            if request.cancelled:
+                continue
+            request.read_started = True
+            index, begin, length = request.block
+            if self._file_wrapper.piece_length(index) > self.piece_cache.max_bytes:
+                block = await self._run_in_thread(
+                    self.read_latency, self._file_wrapper.read_block, index, begin, length
+                )
+            else:
+                piece = await self._read_piece(index)
+                block = memoryview(piece)[begin : begin + length]
+            await self._blocks_for_peers.send((request, block))
@@ -11,8 +11,12 @@ import time
 import trio
 
 import bencode
+import config
 import engine
 import file_manager
+import piece_picker
+import session
+import storage
 from torrent import Torrent
 
 logger = logging.getLogger("main")
@@ -20,18 +24,14 @@ logger = logging.getLogger("main")
 
 def read_torrent_file(torrent_path):
     with open(torrent_path, "rb") as f:
-        torrent_data: dict = bencode.parse_value(f)
+        # the info hash is taken from the info bytes as they are in the file
+        torrent_data, torrent_info = bencode.decode_torrent(f.read())
         logger.debug("torrent_data = {}".format(torrent_data))
-    torrent_info = bencode.encode_value(torrent_data[b"info"])
     logger.debug("torrent info = {}".format(torrent_info))
-    # if True:
-    #    with open(args.torrent_path, 'rb') as f:
-    #        raw = f.read()
-    #        logger.debug("info_string matches {}".format(torrent_info in raw))
     return (torrent_data, torrent_info)
 
 
-def run(log_level, torrent_path, listening_port, download_dir):
+def _setup_logging(log_level, listening_port):
     if log_level:
         log_level = getattr(logging, log_level.upper())
     else:
@@ -42,15 +42,107 @@ def run(log_level, torrent_path, listening_port, download_dir):
         level=log_level,
         format="%(asctime)s %(levelname)s %(filename)s:%(lineno)d `%(funcName)s` -- %(message)s",
     )
+
+
+def _engine_options(
+    piece_picker_strategy=None,
+    hash_workers=None,
+    preallocation=None,
+    piece_cache_mb=None,
+    storage_backend=None,
+):
+    if not piece_picker_strategy:
+        piece_picker_strategy = config.PIECE_PICKER_STRATEGY
+    if not hash_workers:
+        hash_workers = config.HASH_WORKERS
+    if not preallocation:
+        preallocation = config.PREALLOCATION_MODE
+    if piece_cache_mb is None:
+        piece_cache_bytes = config.PIECE_CACHE_BYTES
+    else:
+        piece_cache_bytes = piece_cache_mb * 1024 ** 2
+    if not storage_backend:
+        storage_backend = config.STORAGE_BACKEND
+    return dict(
+        piece_picker_strategy=piece_picker_strategy,
+        hash_workers=hash_workers,
+        preallocation=preallocation,
+        piece_cache_bytes=piece_cache_bytes,
+        storage_backend=storage_backend,
+    )
+
+
+def run(log_level, torrent_path, listening_port, download_dir, metrics_port=None, **options):
+    _setup_logging(log_level, listening_port)
     torrent_data, torrent_info = read_torrent_file(torrent_path)
     download_dir = download_dir if download_dir else os.path.dirname(os.path.abspath(__file__))
     port = int(listening_port) if listening_port else None
     t = Torrent(torrent_data, torrent_info, download_dir, port)
-    engine.run(t)
+    if metrics_port is None:
+        metrics_port = config.METRICS_PORT
+    engine.run(t, metrics_port=metrics_port, **_engine_options(**options))
 
 
 def run_command(args):
-    run(args.log_level, args.torrent_path, args.listening_port, args.download_dir)
+    run(
+        args.log_level,
+        args.torrent_path,
+        args.listening_port,
+        args.download_dir,
+        piece_picker_strategy=args.piece_picker,
+        hash_workers=args.hash_workers,
+        preallocation=args.preallocation,
+        piece_cache_mb=args.piece_cache_mb,
+        storage_backend=args.storage,
+        metrics_port=args.metrics_port,
+    )
+
+
+def run_dir(log_level, torrent_dir, listening_port, download_dir, metrics_port=None, **options):
+    """
+    Run every .torrent file in a directory in one Session.
+    """
+    _setup_logging(log_level, listening_port)
+    download_dir = download_dir if download_dir else os.path.dirname(os.path.abspath(__file__))
+    port = int(listening_port) if listening_port else config.DEFAULT_LISTENING_PORT
+    torrent_paths = sorted(pathlib.Path(torrent_dir).glob("*.torrent"))
+    if not torrent_paths:
+        print("No .torrent files in {}".format(torrent_dir))
+        return
+    engine_options = _engine_options(**options)
+    # the piece cache memory is split between the torrents
+    engine_options["piece_cache_bytes"] //= len(torrent_paths)
+    if metrics_port is None:
+        metrics_port = config.METRICS_PORT
+    s = session.Session(port, metrics_port=metrics_port)
+    for torrent_path in torrent_paths:
+        torrent_data, torrent_info = read_torrent_file(torrent_path)
+        t = Torrent(torrent_data, torrent_info, download_dir, port)
+        try:
+            s.add_torrent(t, **engine_options)
+        except Exception as e:
+            logger.exception("Could not add {}".format(torrent_path))
+            print("Skipping {}: {}".format(torrent_path, e))
+    try:
+        trio.run(s.run)
+    except KeyboardInterrupt:
+        print()
+        print("Shutting down without cleanup...")
+
+
+def run_dir_command(args):
+    run_dir(
+        args.log_level,
+        args.torrent_dir,
+        args.listening_port,
+        args.download_dir,
+        piece_picker_strategy=args.piece_picker,
+        hash_workers=args.hash_workers,
+        preallocation=args.preallocation,
+        piece_cache_mb=args.piece_cache_mb,
+        storage_backend=args.storage,
+        metrics_port=args.metrics_port,
+    )
 
 
 def make_test_files(torrent_data, torrent_info, download_dir, number_of_files):
@@ -124,6 +216,49 @@ def test_command(args):
     test(args.test_dir, args.torrent_path, int(args.number_of_clients))
 
 
+def _add_engine_arguments(parser, piece_cache_help):
+    parser.add_argument(
+        "--piece-picker",
+        choices=sorted(piece_picker.PICKERS),
+        help="strategy for choosing which pieces to request (default: {})".format(
+            config.PIECE_PICKER_STRATEGY
+        ),
+    )
+    parser.add_argument(
+        "--hash-workers",
+        type=int,
+        help="number of threads used to check piece hashes (default: {})".format(
+            config.HASH_WORKERS
+        ),
+    )
+    parser.add_argument(
+        "--preallocation",
+        choices=sorted(file_manager.PREALLOCATION_MODES),
+        help="how to create a new file for the download (default: {})".format(
+            config.PREALLOCATION_MODE
+        ),
+    )
+    parser.add_argument(
+        "--piece-cache-mb",
+        type=int,
+        help="{}, 0 to disable (default: {})".format(
+            piece_cache_help, config.PIECE_CACHE_BYTES // 1024 ** 2
+        ),
+    )
+    parser.add_argument(
+        "--storage",
+        choices=sorted(storage.STORAGE_BACKENDS),
+        help="how the file is read and written (default: {})".format(config.STORAGE_BACKEND),
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="serve Prometheus metrics at http://127.0.0.1:PORT/metrics (default: {})".format(
+            config.METRICS_PORT
+        ),
+    )
+
+
 def main():
     argparser = argparse.ArgumentParser()
     # run sub-command ----------------------
@@ -133,7 +268,25 @@ def main():
     run.add_argument("--listening-port", help="listening port for incoming peer connections")
     run.add_argument("--log-level", help="DEBUG/INFO/WARNING")
     run.add_argument("--download-dir", help="directory to save the file in")
+    _add_engine_arguments(run, "memory for caching pieces being uploaded")
     run.set_defaults(func=run_command)
+    # run-dir sub-command ------------------
+    run_dir = sub_commands.add_parser(
+        "run-dir", help="Run every .torrent file in a directory on one listening port"
+    )
+    run_dir.add_argument("torrent_dir", help="directory containing .torrent files")
+    run_dir.add_argument(
+        "--listening-port",
+        help="listening port for incoming peer connections (default: {})".format(
+            config.DEFAULT_LISTENING_PORT
+        ),
+    )
+    run_dir.add_argument("--log-level", help="DEBUG/INFO/WARNING")
+    run_dir.add_argument("--download-dir", help="directory to save the files in")
+    _add_engine_arguments(
+        run_dir, "memory for caching pieces being uploaded, split between torrents"
+    )
+    run_dir.set_defaults(func=run_dir_command)
     # make-test-files sub-command ----------
     make_test_files = sub_commands.add_parser(
         "make-test-files", help="Split a complete file into incomplete files for testing"
@@ -1,4 +1,5 @@
 from enum import IntEnum
+import struct
 from typing import Tuple
 
 import bitarray
@@ -24,7 +25,7 @@ def parse_bitfield(s: bytes) -> bitarray:
     # NOTE the input will be an integer number of bytes, so it may
     # have extra bits
     b = bitarray.bitarray()
-    b.frombytes(s)
+    b.frombytes(bytes(s))
     return b
 
 
@@ -41,3 +42,36 @@ def parse_piece(s):
     begin = int.from_bytes(s[4:8], byteorder="big")
     data = s[8:]
     return (index, begin, data)
+
+
+# Encoders return complete messages, including the 4 byte length prefix,
+# so several of them can be joined and sent in one write.
+
+_LENGTH_AND_TYPE = struct.Struct(">IB")
+_HAVE = struct.Struct(">IBI")
+_REQUEST_OR_CANCEL = struct.Struct(">IBIII")
+_PIECE_HEADER = struct.Struct(">IBII")
+
+KEEPALIVE = (0).to_bytes(4, byteorder="big")
+
+
+def encode_no_payload(msg_type: PeerMsg) -> bytes:
+    return _LENGTH_AND_TYPE.pack(1, msg_type)
+
+
+def encode_have(index: int) -> bytes:
+    return _HAVE.pack(5, PeerMsg.HAVE, index)
+
+
+def encode_bitfield(pieces: bitarray.bitarray) -> bytes:
+    raw_pieces = pieces.tobytes()
+    return _LENGTH_AND_TYPE.pack(1 + len(raw_pieces), PeerMsg.BITFIELD) + raw_pieces
+
+
+def encode_request_or_cancel(msg_type: PeerMsg, index: int, begin: int, length: int) -> bytes:
+    return _REQUEST_OR_CANCEL.pack(13, msg_type, index, begin, length)
+
+
+def encode_piece_header(index: int, begin: int, length: int) -> bytes:
+    # the block data itself should follow the header
+    return _PIECE_HEADER.pack(9 + length, PeerMsg.PIECE, index, begin)
@@ -0,0 +1,249 @@
+# Counters, gauges and histograms for watching a running client, served in
+# the Prometheus text format:
+# https://prometheus.io/docs/instrumenting/exposition_formats/
+#
+# Updating a metric is a few attribute updates, anything that is costly to
+# keep up to date (queue depths, rates) is read by a collector function
+# when the metrics are scraped instead.
+
+import bisect
+import logging
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple
+
+import h11
+import trio
+
+import http_stream
+
+logger = logging.getLogger("metrics")
+
+# upper bounds of histogram buckets for timings, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    pairs = ['{}="{}"'.format(n, _escape(v)) for n, v in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, int) or value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _Metric(object):
+    """
+    A metric with no labels is updated directly, one with labels has a
+    child for each combination of label values, created by labels().
+    """
+
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], "_Metric"] = dict()
+
+    def _new_child(self) -> "_Metric":
+        return type(self)(self.name, self.help_text)
+
+    def labels(self, *values: str) -> "_Metric":
+        if len(values) != len(self.labelnames):
+            raise ValueError("{} has labels {}".format(self.name, self.labelnames))
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def clear(self, *values: str) -> None:
+        """
+        Remove the children whose label values start with `values`.
+        """
+        for key in [k for k in self._children if k[: len(values)] == values]:
+            del self._children[key]
+
+    def _own_samples(self, labels: str) -> Iterator[str]:
+        raise NotImplementedError
+
+    def samples(self) -> Iterator[str]:
+        if not self.labelnames:
+            yield from self._own_samples("")
+        for values, child in sorted(self._children.items()):
+            yield from child._own_samples(_format_labels(self.labelnames, values))
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, help_text, labelnames)
+        self.value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        self.value += amount
+
+    def _own_samples(self, labels: str) -> Iterator[str]:
+        yield "{}{} {}".format(self.name, labels, _format_value(self.value))
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, help_text, labelnames)
+        self.value = 0.0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def _own_samples(self, labels: str) -> Iterator[str]:
+        yield "{}{} {}".format(self.name, labels, _format_value(self.value))
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> None:
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+        # observations in each bucket (not cumulative), the last is +Inf
+        self._counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def _new_child(self) -> "_Metric":
+        return Histogram(self.name, self.help_text, buckets=self.buckets)
+
+    def observe(self, value: float) -> None:
+        self._counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def _own_samples(self, labels: str) -> Iterator[str]:
+        # the labels are already formatted, so add "le" inside the braces
+        inner = labels[1:-1]
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self._counts):
+            cumulative += count
+            le = 'le="{}"'.format(_format_value(bound))
+            yield "{}_bucket{{{}}} {}".format(
+                self.name, inner + "," + le if inner else le, cumulative
+            )
+        yield "{}_sum{} {}".format(self.name, labels, _format_value(self.sum))
+        yield "{}_count{} {}".format(self.name, labels, self.count)
+
+
+class Registry(object):
+    """
+    The metrics for the process. Collector functions are called before
+    each scrape to update gauges that are read from elsewhere.
+    """
+
+    def __init__(self) -> None:
+        self._metrics: Dict[str, _Metric] = dict()
+        self._collectors: List[Callable[[], None]] = []
+
+    def _add(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError("Metric {} already exists".format(metric.name))
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._add(Counter(name, help_text, labelnames))  # type: ignore
+
+    def gauge(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._add(Gauge(name, help_text, labelnames))  # type: ignore
+
+    def histogram(
+        self,
+        name: str,
+        help_text: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self._add(Histogram(name, help_text, labelnames, buckets))  # type: ignore
+
+    def add_collector(self, collector: Callable[[], None]) -> None:
+        self._collectors.append(collector)
+
+    def remove_collector(self, collector: Callable[[], None]) -> None:
+        self._collectors.remove(collector)
+
+    def get(self, name: str) -> _Metric:
+        return self._metrics[name]
+
+    def render(self) -> bytes:
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception:
+                logger.exception("Metrics collector {} failed".format(collector))
+        lines = []
+        for metric in self._metrics.values():
+            lines.append("# HELP {} {}".format(metric.name, metric.help_text))
+            lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+            lines.extend(metric.samples())
+        return ("\n".join(lines) + "\n").encode()
+
+
+REGISTRY = Registry()
+
+
+def make_handler(registry: Registry):
+    async def handler(stream):
+        h = http_stream.Http_stream(stream, h11.SERVER)
+        try:
+            request, _ = await h.receive_with_data()
+            if request.target.split(b"?")[0] == b"/metrics":
+                body = registry.render()
+                response = h11.Response(
+                    status_code=200,
+                    headers=[
+                        (b"content-type", b"text/plain; version=0.0.4; charset=utf-8"),
+                        (b"content-length", str(len(body)).encode()),
+                    ],
+                )
+            else:
+                body = b"Not found, try /metrics\n"
+                response = h11.Response(
+                    status_code=404, headers=[(b"content-length", str(len(body)).encode())]
+                )
+            await h.send_event(response)
+            await h.send_event(h11.Data(data=body))
+            await h.send_event(h11.EndOfMessage())
+        except Exception as e:
+            logger.warning("Failed to serve metrics because of {}".format(e))
+        finally:
+            await h.close()
+
+    return handler
+
+
+async def serve(port: int, registry: Registry = REGISTRY, host: str = "127.0.0.1"):
+    """
+    Serve the metrics at http://host:port/metrics, only on localhost by
+    default. If the port can't be used the error is logged and this
+    returns, so the torrents keep running without metrics.
+    """
+    try:
+        listeners = await trio.open_tcp_listeners(port, host=host)
+    except OSError as e:
+        logger.error("Could not serve metrics on {}:{} because of {}".format(host, port, e))
+        return
+    logger.info("Serving metrics on {}:{}".format(host, port))
+    await trio.serve_listeners(make_handler(registry), listeners)
@@ -1,17 +1,90 @@
 import logging
-from typing import Tuple, List
+from typing import Tuple, List, Optional
 
 import bitarray
 import trio
 
 import messages
 import peer_state
-
-from config import STREAM_CHUNK_SIZE, KEEPALIVE_SECONDS
+from rate_meter import RateMeter
+from token_bucket import TokenBucket
+
+from config import (
+    STREAM_CHUNK_SIZE,
+    RECEIVE_BUFFER_SIZE,
+    KEEPALIVE_SECONDS,
+    MAX_SEND_BATCH_BYTES,
+    MAX_OUTGOING_BYTES_PER_SECOND_PER_PEER,
+    MAX_INCOMING_BYTES_PER_SECOND_PER_PEER,
+    PEER_HANDSHAKE_TIMEOUT_SECONDS,
+)
 
 logger = logging.getLogger("peer")
 
 
+class ReceiveBuffer(object):
+    """
+    Growable buffer for data received from a stream. Data is appended at
+    the end and messages are taken from the front as memoryviews, so they
+    aren't copied again.
+
+    Space is never reused in place: once the tail of the storage is full
+    new storage is allocated and only the unconsumed bytes are moved.
+    This means memoryviews that have already been handed out stay valid
+    after the buffer has moved on.
+    """
+
+    def __init__(self, size: int = RECEIVE_BUFFER_SIZE) -> None:
+        self._size = size
+        self._storage = bytearray(size)
+        self._view = memoryview(self._storage)
+        self._start = 0
+        self._end = 0
+
+    def __len__(self) -> int:
+        return self._end - self._start
+
+    @property
+    def free_space(self) -> int:
+        return len(self._storage) - self._end
+
+    def _reallocate(self, needed: int) -> None:
+        remaining = len(self)
+        storage = bytearray(max(self._size, remaining + needed))
+        storage[:remaining] = self._view[self._start : self._end]
+        self._storage = storage
+        self._view = memoryview(storage)
+        self._start = 0
+        self._end = remaining
+
+    def append(self, data: bytes) -> None:
+        n = len(data)
+        if n > self.free_space:
+            self._reallocate(n)
+        self._view[self._end : self._end + n] = data
+        self._end += n
+
+    def next_frame(self) -> Optional[Tuple[int, memoryview]]:
+        """
+        Take one length-prefixed message, or return None if it hasn't been
+        completely received yet.
+        """
+        start = self._start
+        if self._end - start < 4:
+            return None
+        msg_length = int.from_bytes(self._view[start : start + 4], byteorder="big")
+        end = start + 4 + msg_length
+        if end > self._end:
+            return None
+        self._start = end
+        return (msg_length, self._view[start + 4 : end])
+
+    def take(self, n: int) -> memoryview:
+        view = self._view[self._start : self._start + n]
+        self._start += n
+        return view
+
+
 class PeerStream(object):
     """
     The aim is to wrap a stream with a peer protocol
@@ -21,73 +94,73 @@ class PeerStream(object):
     until it has enough.
     """
 
-    def __init__(self, stream, token_bucket=None):
+    def __init__(
+        self,
+        stream,
+        token_bucket: Optional[TokenBucket] = None,
+        receive_token_bucket: Optional[TokenBucket] = None,
+    ):
         self._stream = stream
-        self._msg_data = b""
-        self._token_bucket = token_bucket
+        self._msg_data = ReceiveBuffer()
+        # can be set later, e.g. once the handshake shows which torrent it is for
+        self.token_bucket = token_bucket
+        self.receive_token_bucket = receive_token_bucket
+        # count the bytes going each way, if set
+        self.send_meter: Optional[RateMeter] = None
+        self.receive_meter: Optional[RateMeter] = None
+
+    async def _receive_some(self) -> None:
+        data = await self._stream.receive_some(max(STREAM_CHUNK_SIZE, self._msg_data.free_space))
+        if data == b"":
+            logger.debug("empty data, about to raise EOF from {}".format(self._stream))
+            raise Exception("EOF")
+        logger.debug("received_message: Got {} from {}".format(len(data), self._stream))
+        if self.receive_token_bucket is not None:
+            # Nothing more is read from the stream until the tokens are
+            # available, so the peer's sends back up through TCP.
+            await self.receive_token_bucket.take(len(data))
+        if self.receive_meter is not None:
+            self.receive_meter.add(len(data))
+        self._msg_data.append(data)
 
     async def receive_handshake(self):
         logger.debug("Starting to received handshake on {}".format(self._stream))
         while len(self._msg_data) < 68:
-            data = await self._stream.receive_some(STREAM_CHUNK_SIZE)
-            if data == b"":
-                logger.debug(
-                    "empty data in handshake, about to raise EOF from {}".format(self._stream)
-                )
-                raise Exception("EOF in handshake")
-            logger.debug(
-                "Initial incoming handshake data from {}: {}".format(
-                    self._stream.socket.getpeername(), data
-                )
-            )
-            self._msg_data += data
-        handshake_data = self._msg_data[:68]
-        self._msg_data = self._msg_data[68:]
-        logger.debug("Final incoming handshake data {}".format(data))
+            await self._receive_some()
+        handshake_data = bytes(self._msg_data.take(68))
+        logger.debug("Final incoming handshake data {}".format(handshake_data))
         return handshake_data
 
-    def _parse_msg_data(self) -> List[Tuple[int, bytes]]:
-        messages: List[Tuple[int, bytes]] = []
-        msg_length = None
+    def _parse_msg_data(self) -> List[Tuple[int, memoryview]]:
+        messages: List[Tuple[int, memoryview]] = []
         while True:
-            total_length = len(self._msg_data)
-            if total_length < 4:
+            frame = self._msg_data.next_frame()
+            if frame is None:
                 return messages
-            else:
-                msg_length = int.from_bytes(self._msg_data[:4], byteorder="big")
-                if total_length < 4 + msg_length:
-                    return messages
-                else:
-                    messages.append((msg_length, self._msg_data[4 : 4 + msg_length]))
-                    self._msg_data = self._msg_data[4 + msg_length :]
-                    logger.debug(
-                        "Parsed message of length {} from {}".format(msg_length, self._stream)
-                    )
+            messages.append(frame)
+            logger.debug("Parsed message of length {} from {}".format(frame[0], self._stream))
 
-    async def receive_message(self) -> List[Tuple[int, bytes]]:
+    async def receive_message(self) -> List[Tuple[int, memoryview]]:
         logger.debug("Called receive_message for {}".format(self._stream))
         while True:
             messages = self._parse_msg_data()
             if messages:
                 return messages
             else:
-                data = await self._stream.receive_some(STREAM_CHUNK_SIZE)
-                if data != b"":
-                    logger.debug("received_message: Got {} from {}".format(len(data), self._stream))
-                else:
-                    logger.debug("empty data, about to raise EOF from {}".format(self._stream))
-                    raise Exception("EOF")
-                self._msg_data += data
-
-    async def send_message(self, msg: bytes) -> None:
-        l = len(msg)
-        data = l.to_bytes(4, byteorder="big") + msg
-        logger.debug("Pre-send message of length {} on {}".format(l, self._stream))
-        while not self._token_bucket.check_and_decrement(len(data)):
-            logger.debug("Token bucket is empty waiting 0.1s")
-            await trio.sleep(self._token_bucket.update_period)
+                await self._receive_some()
+
+    async def send_messages(self, data: bytes) -> None:
+        """
+        Send data holding one or more complete (length prefixed) messages
+        with a single write, taking tokens for all of it at once.
+        """
+        logger.debug("Pre-send {} bytes on {}".format(len(data), self._stream))
+        if self.token_bucket is not None:
+            await self.token_bucket.take(len(data))
         await self._stream.send_all(data)
-        logger.debug("Sent message of length {} on {}".format(l, self._stream))
+        if self.send_meter is not None:
+            self.send_meter.add(len(data))
+        logger.debug("Sent {} bytes on {}".format(len(data), self._stream))
 
     async def send_handshake(self, info_hash, peer_id):
         handshake_data = b"\x13BitTorrent protocol" + (b"\0" * 8) + info_hash + peer_id
@@ -97,10 +170,6 @@ class PeerStream(object):
         await self._stream.send_all(handshake_data)
         logger.debug("Sent handshake")
 
-    async def send_keepalive(self) -> None:
-        data = (0).to_bytes(4, byteorder="big")
-        await self._stream.send_all(data)
-
 
 class HandshakeError(Exception):
     def __init__(self, reason, data):
@@ -108,9 +177,29 @@ class HandshakeError(Exception):
         self.data = data
 
 
+def parse_handshake(data: bytes) -> Tuple[bytes, bytes]:
+    """
+    Check the fixed parts of a handshake and return the info hash and
+    peer id from it.
+    """
+    if len(data) < 20 + 8 + 20 + 20:
+        raise HandshakeError("Handshake data: wrong length", data)
+    header = data[:20]
+    _reserved_bytes = data[20 : 20 + 8]
+    sha1hash = data[20 + 8 : 20 + 8 + 20]
+    peer_id = data[20 + 8 + 20 : 20 + 8 + 20 + 20]
+    if not (header == b"\x13BitTorrent protocol"):
+        raise HandshakeError("Handshake data: wrong header", header)
+    return sha1hash, peer_id
+
+
 class PeerEngine(object):
     """
     PeerEngine is initialized with a stream and two queues.
+
+    If the peer's handshake has already been read from the stream (by a
+    Session to find which torrent it is for) it is passed in along with
+    the PeerStream it was read from.
     """
 
     def __init__(
@@ -120,33 +209,57 @@ class PeerEngine(object):
         expected_peer_id,
         stream,
         *,
-        send_peer_msg_to_engine: trio.MemorySendChannel
+        send_peer_msg_to_engine: trio.MemorySendChannel,
+        peer_stream: Optional[PeerStream] = None,
+        handshake: Optional[bytes] = None
     ):
         self._tstate = engine._state
         self._main_engine = engine
         self._peer_address = peer_address
         self._expected_peer_id = expected_peer_id
         self._peer_id_and_state = None
-        self._peer_stream = PeerStream(stream, engine.token_bucket)
+        # the peer_id from the peer's handshake
+        self._handshake_peer_id: Optional[bytes] = None
+        if peer_stream is None:
+            peer_stream = PeerStream(stream)
+        # uploads to this peer are limited by the peer's, torrent's and global buckets
+        peer_stream.token_bucket = TokenBucket(
+            MAX_OUTGOING_BYTES_PER_SECOND_PER_PEER, parent=engine.token_bucket
+        )
+        # and downloads in the same way
+        peer_stream.receive_token_bucket = TokenBucket(
+            MAX_INCOMING_BYTES_PER_SECOND_PER_PEER, parent=engine.download_token_bucket
+        )
+        # and both are measured for the peer and the torrent
+        peer_stream.send_meter = RateMeter(parent=engine.upload_meter)
+        peer_stream.receive_meter = RateMeter(parent=engine.download_meter)
+        self._peer_stream = peer_stream
+        self._handshake = handshake
         self._send_peer_msg_to_engine = send_peer_msg_to_engine
         self._receive_outgoing_data = None
 
     async def run(self, initiate=True):
         try:
             # Do handshakes before starting main loops
-            if initiate == True:
-                await self.send_handshake()
-                peer_id = await self.receive_handshake()
-            else:
-                peer_id = await self.receive_handshake()
-                await self.send_handshake()
+            with trio.fail_after(PEER_HANDSHAKE_TIMEOUT_SECONDS):
+                if initiate == True:
+                    await self.send_handshake()
+                    peer_id = await self.receive_handshake()
+                else:
+                    peer_id = await self.receive_handshake()
+                    await self.send_handshake()
+            self._handshake_peer_id = peer_id
             if peer_id in self._main_engine._peers:
                 # We already have peer, close connection
                 raise Exception("peer already exists")
             else:
                 peer_s = peer_state.PeerState(
-                    peer_id, self._tstate._num_pieces
-                )  # TODO don't use private property
+                    peer_id,
+                    self._tstate._num_pieces,  # TODO don't use private property
+                    download_token_bucket=self._peer_stream.receive_token_bucket,
+                    download_meter=self._peer_stream.receive_meter,
+                    upload_meter=self._peer_stream.send_meter,
+                )
                 self._main_engine._peers[peer_id] = peer_s
                 self._peer_id_and_state = (peer_id, peer_s)
                 self._receive_outgoing_data = peer_s.receive_outgoing_data
@@ -155,7 +268,7 @@ class PeerEngine(object):
                 nursery.start_soon(self.sending_loop)
         except Exception as e:
             if self._peer_id_and_state:
-                self._main_engine._peers.pop(peer_id)
+                self._main_engine.remove_peer(peer_id)
             logger.exception("Exception raised in PeerEngine")
             logger.info(
                 "Closing PeerEngine {} / {}".format(self._peer_address, self._peer_id_and_state)
@@ -163,26 +276,28 @@ class PeerEngine(object):
             raise e
         except trio.MultiError:
             if self._peer_id_and_state:
-                self._main_engine._peers.pop(peer_id)
+                self._main_engine.remove_peer(peer_id)
             logger.exception("MultiError raised in PeerEngine")
             logger.info(
                 "Closing PeerEngine {} / {}".format(self._peer_address, self._peer_id_and_state)
             )
             raise Exception("trio.MultiError was raised by PeerEngine")
 
+    @property
+    def peer_id(self) -> Optional[bytes]:
+        # set once the handshakes are done, even if the Engine already has
+        # a connection to the peer
+        return self._handshake_peer_id
+
     async def receive_handshake(self):
         # First, receive handshake
-        data = await self._peer_stream.receive_handshake()
+        if self._handshake is not None:
+            data = self._handshake
+        else:
+            data = await self._peer_stream.receive_handshake()
         logger.debug("Handshake data = {}".format(data))
         # Second, validation
-        if len(data) < 20 + 8 + 20 + 20:
-            raise HandshakeError("Handshake data: wrong length", data)
-        header = data[:20]
-        _reserved_bytes = data[20 : 20 + 8]
-        sha1hash = data[20 + 8 : 20 + 8 + 20]
-        peer_id = data[20 + 8 + 20 : 20 + 8 + 20 + 20]
-        if not (header == b"\x13BitTorrent protocol"):
-            raise HandshakeError("Handshake data: wrong header", header)
+        sha1hash, peer_id = parse_handshake(data)
         if not (sha1hash == self._tstate.info_hash):
             raise HandshakeError("Handshake data: wrong hash", sha1hash)
         if self._expected_peer_id:
@@ -216,17 +331,52 @@ class PeerEngine(object):
 
     async def send_bitfield(self):
         raw_pieces = self._tstate._complete  # TODO don't use private property
-        raw_msg = bytes([messages.PeerMsg.BITFIELD])
-        raw_msg += raw_pieces.tobytes()
-        await self._peer_stream.send_message(raw_msg)
-
-    async def send_choke(self):
-        raw_msg = bytes([messages.PeerMsg.CHOKE])
-        await self._peer_stream.send_message(raw_msg)
+        await self._peer_stream.send_messages(messages.encode_bitfield(raw_pieces))
 
-    async def send_unchoke(self):
-        raw_msg = bytes([messages.PeerMsg.UNCHOKE])
-        await self._peer_stream.send_message(raw_msg)
+    def _encode_command(self, buffer: bytearray, command, data) -> None:
+        peer_id = self._peer_id_and_state[0]
+        if command == "blocks_to_request":
+            for index, begin, length in data:
+                buffer += messages.encode_request_or_cancel(
+                    messages.PeerMsg.REQUEST, index, begin, length
+                )
+            logger.debug("Queued {} REQUESTs for {}".format(len(data), peer_id))
+        elif command == "blocks_to_cancel":
+            for index, begin, length in data:
+                buffer += messages.encode_request_or_cancel(
+                    messages.PeerMsg.CANCEL, index, begin, length
+                )
+            logger.debug("Queued {} CANCELs for {}".format(len(data), peer_id))
+        elif command == "block_to_upload":
+            upload_request, block_data = data
+            if upload_request.cancelled:
+                return
+            upload_requests = self._peer_id_and_state[1].upload_requests
+            if upload_requests.get(upload_request.block) is upload_request:
+                del upload_requests[upload_request.block]
+            index, begin, length = upload_request.block
+            self._tstate.add_uploaded(len(block_data))
+            buffer += messages.encode_piece_header(index, begin, len(block_data))
+            buffer += block_data
+            logger.debug("Queued PIECE {} to {}".format((index, begin, length), peer_id))
+        elif command == "announce_have_piece":
+            buffer += messages.encode_have(data)
+            logger.debug("Queued HAVE {} to {}".format(data, peer_id))
+        elif command == "choke":
+            buffer += messages.encode_no_payload(messages.PeerMsg.CHOKE)
+            logger.debug("Queued CHOKE to {}".format(peer_id))
+        elif command == "unchoke":
+            buffer += messages.encode_no_payload(messages.PeerMsg.UNCHOKE)
+            logger.debug("Queued UNCHOKE to {}".format(peer_id))
+        elif command == "keepalive":
+            buffer += messages.KEEPALIVE
+            logger.debug("Queued KEEPALIVE to {}".format(peer_id))
+        else:
+            logger.warning(
+                "PeerEngine for {} received unsupported message from Engine: {}".format(
+                    peer_id, (command, data)
+                )
+            )
 
     async def sending_loop(self):
         logger.debug("About to send bitfield to {}".format(self._peer_id_and_state[0]))
@@ -237,101 +387,55 @@ class PeerEngine(object):
             command, data = "keepalive", None
             with trio.move_on_after(KEEPALIVE_SECONDS):
                 command, data = await self._receive_outgoing_data.receive()
-            if command == "blocks_to_request":
-                for index, begin, length in data:
-                    raw_msg = bytes([messages.PeerMsg.REQUEST])
-                    raw_msg += (index).to_bytes(4, byteorder="big")
-                    raw_msg += (begin).to_bytes(4, byteorder="big")
-                    raw_msg += (length).to_bytes(4, byteorder="big")
-                    logger.debug(
-                        "Pre-send REQUEST for {} from {}".format(
-                            (index, begin, length), self._peer_id_and_state[0]
-                        )
-                    )
-                    await self._peer_stream.send_message(raw_msg)
-                    logger.debug(
-                        "Sent REQUEST for {} from {}".format(
-                            (index, begin, length), self._peer_id_and_state[0]
-                        )
-                    )
-            elif command == "block_to_upload":
-                (index, begin, length), block_data = data
-                raw_msg = bytes([messages.PeerMsg.PIECE])
-                raw_msg += (index).to_bytes(4, byteorder="big")
-                raw_msg += (begin).to_bytes(4, byteorder="big")
-                raw_msg += block_data
-                logger.debug(
-                    "Pre-send PIECE {} to {}".format(
-                        (index, begin, length), self._peer_id_and_state[0]
-                    )
-                )
-                await self._peer_stream.send_message(raw_msg)
-                logger.debug(
-                    "Sent PIECE {} to {}".format((index, begin, length), self._peer_id_and_state[0])
-                )
-            elif command == "announce_have_piece":
-                raw_msg = bytes([messages.PeerMsg.HAVE])
-                raw_msg += (data).to_bytes(4, byteorder="big")
-                logger.debug("Pre-send HAVE {} to {}".format(data, self._peer_id_and_state[0]))
-                await self._peer_stream.send_message(raw_msg)
-                logger.debug("Sent HAVE {} to {}".format(data, self._peer_id_and_state[0]))
-            elif command == "choke":
-                logger.debug("Pre-send CHOKE to {}".format(self._peer_id_and_state[0]))
-                await self.send_choke()
-                logger.debug("Sent CHOKE to {}".format(self._peer_id_and_state[0]))
-            elif command == "unchoke":
-                logger.debug("Pre-send UNCHOKE to {}".format(self._peer_id_and_state[0]))
-                await self.send_unchoke()
-                logger.debug("Sent UNCHOKE to {}".format(self._peer_id_and_state[0]))
-            elif command == "keepalive":
-                logger.debug("Pre-send KEEPALIVE to {}".format(self._peer_id_and_state[0]))
-                await self._peer_stream.send_keepalive()
-                logger.debug("Sent KEEPALIVE to {}".format(self._peer_id_and_state[0]))
-
-            else:
-                logger.warning(
-                    "PeerEngine for {} received unsupported message from Engine: {}".format(
-                        self._peer_id_and_state[0], (command, data)
-                    )
-                )
-
-
-async def start_peer_engine(engine, peer_address, stream, initiate=True):
+            # Drain everything else that is already queued for this peer
+            # so it goes out in one write. The limit is checked before each
+            # message is added, so the last one can take the batch over it.
+            buffer = bytearray()
+            self._encode_command(buffer, command, data)
+            while len(buffer) < MAX_SEND_BATCH_BYTES:
+                try:
+                    command, data = self._receive_outgoing_data.receive_nowait()
+                except trio.WouldBlock:
+                    break
+                self._encode_command(buffer, command, data)
+            await self._peer_stream.send_messages(buffer)
+            logger.debug("Sent {} bytes to {}".format(len(buffer), self._peer_id_and_state[0]))
+
+
+async def start_peer_engine(
+    engine, peer_address, stream, initiate=True, peer_stream=None, handshake=None
+):
     """
     Find (or create) queues for relevant stream, and create PeerEngine.
     """
     peer_engine = PeerEngine(
-        engine, peer_address, None, stream, send_peer_msg_to_engine=engine.peer_messages
+        engine,
+        peer_address,
+        None,
+        stream,
+        send_peer_msg_to_engine=engine.peer_messages,
+        peer_stream=peer_stream,
+        handshake=handshake,
     )
-    await peer_engine.run(initiate=True)
+    await peer_engine.run(initiate=initiate)
+
+
+def stream_peer_address(stream) -> peer_state.PeerAddress:
+    peer_info = stream.socket.getpeername()
+    ip: str = peer_info[0]
+    port: int = peer_info[1]
+    return peer_state.PeerAddress(ip, port)
 
 
 def make_handler(engine):
     async def handler(stream):
         try:
-            peer_info = stream.socket.getpeername()
-            ip: string = peer_info[0]
-            port: int = peer_info[1]
-            peer_address = peer_state.PeerAddress(ip, port)
-            logger.debug("Received incoming peer connection from {}".format(peer_address))
-            await start_peer_engine(engine, peer_address, stream, initiate=False)
-        except Exception as e:  # TODO this might be too general
-            logger.warning(
-                "Failed to maintain peer connection to {} because of {}".format(peer_address, e)
-            )
+            peer_address = stream_peer_address(stream)
+        except Exception as e:
+            logger.warning("Failed to accept peer connection because of {}".format(e))
+            await stream.aclose()
+            return
+        logger.debug("Received incoming peer connection from {}".format(peer_address))
+        await engine.connections.handle_incoming(stream, peer_address)
 
     return handler
-
-
-async def make_standalone(engine, peer_address):
-    logger.debug("Starting outgoing peer connection to {}".format(peer_address))
-    stream = None
-    try:
-        stream = await trio.open_tcp_stream(peer_address.ip, peer_address.port)
-        await start_peer_engine(engine, peer_address, stream, initiate=True)
-    except Exception as e:  # TODO this might be too general
-        logger.warning(
-            "Failed to maintain peer connection to {} because of {}".format(peer_address, e)
-        )
-        if stream:
-            await stream.aclose()
@@ -1,11 +1,13 @@
 import datetime
 from enum import Enum
-from typing import NamedTuple, Tuple, Set
+from typing import Dict, NamedTuple, Optional, Tuple, Set
 
 import bitarray
 import trio
 
 import config
+from rate_meter import RateMeter
+from token_bucket import TokenBucket
 
 PeerAddress = NamedTuple("PeerAddress", [("ip", bytes), ("port", int)])
 
@@ -20,8 +22,36 @@ class ChokeAlert(Enum):
     DONT_ALERT = 1
 
 
+Block = Tuple[int, int, int]
+
+
+class UploadRequest(object):
+    """
+    A block a peer asked us for, passed from the Engine to the FileManager
+    to be read and back to be sent. Memory channels can't have items
+    removed, so a CANCEL marks the request as cancelled and each stage
+    drops cancelled requests when it gets to them.
+    """
+
+    __slots__ = ("peer_id", "block", "cancelled", "read_started")
+
+    def __init__(self, peer_id: bytes, block: Block) -> None:
+        self.peer_id = peer_id
+        self.block = block
+        self.cancelled = False
+        # set by the FileManager when it takes the request off the read queue
+        self.read_started = False
+
+
 class PeerState(object):
-    def __init__(self, peer_id: bytes, num_pieces: int) -> None:
+    def __init__(
+        self,
+        peer_id: bytes,
+        num_pieces: int,
+        download_token_bucket: Optional[TokenBucket] = None,
+        download_meter: Optional[RateMeter] = None,
+        upload_meter: Optional[RateMeter] = None,
+    ) -> None:
         now = datetime.datetime.now()
         pieces = bitarray.bitarray(num_pieces)
         pieces.setall(False)
@@ -30,13 +60,15 @@ class PeerState(object):
         self._outgoing_data_channel = trio.open_memory_channel(config.INTERNAL_QUEUE_SIZE)
         self._choked_us = True
         self._choked_them = True
-        # stats
+        # limits what we download from the peer
+        self.download_token_bucket = download_token_bucket
+        # blocks the peer requested that haven't been sent yet
+        self.upload_requests: Dict[Block, UploadRequest] = dict()
+        # stats, the meters count all the bytes sent and received
         self._first_seen = now
         self._last_seen = now
-        self._total_download_count = 0
-        self._current_10_second_download_count = 0
-        self._prev_10_second_download_count = 0
-        self._total_upload_count = 0
+        self.download_meter = download_meter if download_meter is not None else RateMeter()
+        self.upload_meter = upload_meter if upload_meter is not None else RateMeter()
 
     def choke_us(self):
         self._choked_us = True
@@ -66,6 +98,17 @@ class PeerState(object):
     def is_peer_choked(self):
         return self._choked_them
 
+    def cancel_uploads(self) -> int:
+        """
+        Cancel all the blocks waiting to be sent to the peer, returns how
+        many there were.
+        """
+        for request in self.upload_requests.values():
+            request.cancelled = True
+        count = len(self.upload_requests)
+        self.upload_requests.clear()
+        return count
+
     def get_pieces(self):
         return self._pieces
 
@@ -94,17 +137,3 @@ class PeerState(object):
     @property
     def send_outgoing_data(self) -> trio.MemorySendChannel:
         return self._outgoing_data_channel[0]
-
-    def inc_download_counters(self) -> None:
-        self._total_download_count += 1
-        self._current_10_second_download_count += 1
-
-    def inc_upload_counters(self) -> None:
-        self._total_upload_count += 1
-
-    def reset_rolling_download_count(self) -> None:
-        self._prev_10_second_download_count = self._current_10_second_download_count
-        self._current_10_second_download_count = 0
-
-    def get_20_second_rolling_download_count(self) -> int:
-        return self._prev_10_second_download_count + self._current_10_second_download_count
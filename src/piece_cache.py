@@ -0,0 +1,60 @@
+import collections
+import logging
+from typing import Optional
+
+logger = logging.getLogger("piece_cache")
+
+
+class PieceCache(object):
+    """
+    Least recently used cache of complete pieces, limited by the total
+    size of the pieces it holds. It is used on the upload path so a piece
+    is read from disk once and then served to many peers from memory.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self._max_bytes = max_bytes
+        self._size = 0
+        self._pieces: "collections.OrderedDict[int, bytes]" = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def max_bytes(self) -> int:
+        return self._max_bytes
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def __len__(self) -> int:
+        return len(self._pieces)
+
+    def get(self, index: int, count: bool = True) -> Optional[bytes]:
+        # count=False for a second look for the same request, so each
+        # request is only counted once as a hit or a miss
+        piece = self._pieces.get(index)
+        if piece is None:
+            if count:
+                self.misses += 1
+        else:
+            if count:
+                self.hits += 1
+            self._pieces.move_to_end(index)
+        return piece
+
+    def put(self, index: int, piece: bytes) -> None:
+        if len(piece) > self._max_bytes:
+            return
+        if index in self._pieces:
+            self._size -= len(self._pieces.pop(index))
+        self._pieces[index] = piece
+        self._size += len(piece)
+        while self._size > self._max_bytes:
+            _, evicted = self._pieces.popitem(last=False)
+            self._size -= len(evicted)
+
+    def __repr__(self):
+        return "PieceCache(pieces={}, bytes={}/{}, hits={}, misses={})".format(
+            len(self._pieces), self._size, self._max_bytes, self.hits, self.misses
+        )
@@ -0,0 +1,174 @@
+import logging
+import random
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import bitarray
+
+logger = logging.getLogger("piece_picker")
+
+_ONE = bitarray.bitarray("1")
+
+
+def _pick_random_one_in_bitarray(b):
+    n = len(b)
+    start = random.randint(0, n - 1)
+    # look at tail
+    try:
+        i = b.index(True, start)
+        return i
+    except ValueError:
+        pass
+    # look at head
+    try:
+        i = b.index(True, 0, start)
+        return i
+    except ValueError:
+        return None
+
+
+def _iter_set_bits_from(b, start: int) -> Iterator[int]:
+    # tail first, then wrap around to the head
+    for lo, hi in ((start, len(b)), (0, start)):
+        i = lo
+        while i < hi:
+            try:
+                i = b.index(True, i, hi)
+            except ValueError:
+                break
+            yield i
+            i += 1
+
+
+class RandomPicker(object):
+    """
+    Picks a random piece that the peer has and we don't, without
+    keeping any information about the rest of the swarm.
+    """
+
+    def __init__(self, complete: bitarray.bitarray) -> None:
+        self._wanted = ~complete
+
+    def is_wanted(self, index: int) -> bool:
+        return self._wanted[index]
+
+    def add_peer_pieces(self, pieces: bitarray.bitarray) -> None:
+        pass
+
+    def remove_peer_pieces(self, pieces: bitarray.bitarray) -> None:
+        pass
+
+    def peer_has_piece(self, index: int) -> None:
+        pass
+
+    def piece_complete(self, index: int) -> None:
+        self._wanted[index] = False
+
+    def wanted_pieces(self) -> Iterator[int]:
+        return iter(self._wanted.search(_ONE))
+
+    def candidates(self, peer_pieces: bitarray.bitarray, partial: Iterable[int]) -> Iterator[int]:
+        targets = self._wanted & peer_pieces
+        start = _pick_random_one_in_bitarray(targets)
+        if start is not None:
+            yield from _iter_set_bits_from(targets, start)
+
+
+class RarestFirstPicker(object):
+    """
+    Keeps a count of how many connected peers have each piece and offers
+    the pieces we still need, rarest first. Pieces with the same
+    availability are kept in a bucket, so they can be added, moved and
+    removed in O(1) and ties are broken by scanning the bucket from a
+    random position.
+
+    Pieces we have already received some blocks for are offered before
+    anything else, so we finish pieces rather than start new ones.
+    """
+
+    def __init__(self, complete: bitarray.bitarray) -> None:
+        num_pieces = len(complete)
+        self._availability: List[int] = [0] * num_pieces
+        # position of a wanted piece in its bucket, -1 once we have the piece
+        self._position: List[int] = [-1] * num_pieces
+        self._buckets: Dict[int, List[int]] = dict()
+        for index in range(num_pieces):
+            if not complete[index]:
+                self._insert(index)
+
+    def _insert(self, index: int) -> None:
+        bucket = self._buckets.setdefault(self._availability[index], [])
+        self._position[index] = len(bucket)
+        bucket.append(index)
+
+    def _remove(self, index: int) -> None:
+        availability = self._availability[index]
+        bucket = self._buckets[availability]
+        position = self._position[index]
+        last = bucket.pop()
+        if last != index:
+            bucket[position] = last
+            self._position[last] = position
+        self._position[index] = -1
+        if not bucket:
+            del self._buckets[availability]
+
+    def is_wanted(self, index: int) -> bool:
+        return self._position[index] >= 0
+
+    def _change_availability(self, index: int, change: int) -> None:
+        if self.is_wanted(index):
+            self._remove(index)
+            self._availability[index] += change
+            self._insert(index)
+        else:
+            self._availability[index] += change
+
+    def availability(self, index: int) -> int:
+        return self._availability[index]
+
+    def add_peer_pieces(self, pieces: bitarray.bitarray) -> None:
+        for index in pieces.search(_ONE):
+            self._change_availability(index, 1)
+
+    def remove_peer_pieces(self, pieces: bitarray.bitarray) -> None:
+        for index in pieces.search(_ONE):
+            self._change_availability(index, -1)
+
+    def peer_has_piece(self, index: int) -> None:
+        self._change_availability(index, 1)
+
+    def piece_complete(self, index: int) -> None:
+        if self.is_wanted(index):
+            self._remove(index)
+
+    def wanted_pieces(self) -> Iterator[int]:
+        for bucket in self._buckets.values():
+            yield from bucket
+
+    def candidates(self, peer_pieces: bitarray.bitarray, partial: Iterable[int]) -> Iterator[int]:
+        in_progress = [i for i in partial if self.is_wanted(i) and peer_pieces[i]]
+        random.shuffle(in_progress)
+        in_progress.sort(key=self.availability)
+        yield from in_progress
+        for availability in sorted(self._buckets):
+            if availability == 0:
+                # the peer can't have a piece that nobody has
+                continue
+            bucket = self._buckets[availability]
+            start = random.randrange(len(bucket))
+            for position in range(start, start + len(bucket)):
+                index = bucket[position % len(bucket)]
+                if peer_pieces[index] and index not in in_progress:
+                    yield index
+
+
+PICKERS = {"rarest-first": RarestFirstPicker, "random": RandomPicker}
+
+
+def make_picker(strategy: str, complete: bitarray.bitarray):
+    try:
+        picker_class = PICKERS[strategy]
+    except KeyError:
+        raise Exception("Unknown piece picking strategy: {}".format(strategy))
+    logger.info("Using {} piece picker".format(strategy))
+    return picker_class(complete)
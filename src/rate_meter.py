@@ -0,0 +1,101 @@
+import math
+from typing import List, Optional
+
+import trio
+
+import config
+
+
+class RateMeter(object):
+    """
+    Counts bytes and measures how fast they're going, both over a sliding
+    window of the last `window_seconds` and as an exponentially weighted
+    moving average with a time constant of `ewma_seconds`.
+
+    Bytes are added to a bucket for the current whole second, and the
+    window and average are only updated when the second changes, so
+    adding bytes is cheap enough to do for every message.
+
+    Meters can be nested like TokenBuckets (e.g. peer -> torrent), bytes
+    added to a meter are also added to its parent.
+    """
+
+    def __init__(
+        self,
+        window_seconds: int = config.RATE_WINDOW_SECONDS,
+        ewma_seconds: float = config.RATE_EWMA_SECONDS,
+        parent: Optional["RateMeter"] = None,
+    ) -> None:
+        self.parent = parent
+        self.total = 0
+        self._buckets: List[int] = [0] * window_seconds
+        self._window_total = 0
+        # the whole second bytes are being added to, and when the meter started,
+        # both set on first use as trio's clock can only be read inside trio.run
+        self._second: Optional[int] = None
+        self._start = 0.0
+        self._decay = math.exp(-1 / ewma_seconds)
+        self._ewma = 0.0
+
+    def _advance(self, now: float) -> None:
+        second = int(now)
+        if self._second is None:
+            self._second = second
+            self._start = now
+            return
+        elapsed = second - self._second
+        if elapsed <= 0:
+            return
+        # the finished second updates the average, the seconds after it had no bytes
+        finished = self._buckets[self._second % len(self._buckets)]
+        self._ewma = (self._ewma * self._decay + finished * (1 - self._decay)) * (
+            self._decay ** (elapsed - 1)
+        )
+        # empty the buckets for the new seconds, which drops them from the window
+        for s in range(self._second + 1, self._second + 1 + min(elapsed, len(self._buckets))):
+            i = s % len(self._buckets)
+            self._window_total -= self._buckets[i]
+            self._buckets[i] = 0
+        self._second = second
+
+    def add(self, num_bytes: int) -> None:
+        now = trio.current_time()
+        meter: Optional[RateMeter] = self
+        while meter is not None:
+            meter._advance(now)
+            meter.total += num_bytes
+            meter._buckets[meter._second % len(meter._buckets)] += num_bytes
+            meter._window_total += num_bytes
+            meter = meter.parent
+
+    def window_rate(self) -> float:
+        """
+        Bytes per second over the window, or since the meter started if
+        that's shorter.
+        """
+        now = trio.current_time()
+        self._advance(now)
+        # the window is the last few whole seconds and part of the current one
+        seconds = min(len(self._buckets) - 1 + now - self._second, now - self._start)
+        return self._window_total / max(seconds, 1)
+
+    def ewma_rate(self) -> float:
+        """
+        Bytes per second, averaged over the whole seconds so far with more
+        weight on recent ones.
+        """
+        self._advance(trio.current_time())
+        return self._ewma
+
+    def __repr__(self):
+        return "RateMeter(total={}, window_rate={:.0f}, ewma_rate={:.0f})".format(
+            self.total, self.window_rate(), self.ewma_rate()
+        )
+
+
+def format_bytes(num_bytes: float) -> str:
+    for unit in ("B", "KB", "MB"):
+        if num_bytes < 1024:
+            return "{:.1f} {}".format(num_bytes, unit)
+        num_bytes /= 1024
+    return "{:.1f} GB".format(num_bytes)
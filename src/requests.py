@@ -1,49 +1,111 @@
 import datetime
+import heapq
 import logging
-from typing import List, Dict, Tuple, Set
+from typing import List, Dict, Optional, Tuple, Set
 
 import peer_state
 
 logger = logging.getLogger("requests")
 
+Block = Tuple[int, int, int]
+
 
 class RequestManager(object):
     """
     Keeps track of blocks client requested by index, peer_address
     and block.
+
+    Every request is stored once with the time it was made, and indexed
+    by peer and by piece so lookups don't need to scan every request.
+    A heap ordered by request time is used to find stale requests, entries
+    in it are removed lazily, so it can hold requests that have since been
+    deleted or made again.
     """
 
     def __init__(self):
-        self._requests: Set[Tuple[bytes, Tuple[int, int, int], datetime.datettime]] = set()
+        self._requests: Dict[Tuple[bytes, Block], datetime.datetime] = dict()
+        self._by_peer: Dict[bytes, Set[Block]] = dict()
+        self._by_piece: Dict[int, Set[Tuple[bytes, Block]]] = dict()
+        self._by_time: List[Tuple[datetime.datetime, bytes, Block]] = []
 
     @property
     def size(self):
         return len(self._requests)
 
-    def add_request(self, peer_id: bytes, block: Tuple[int, int, int]):
-        self._requests.add((peer_id, block, datetime.datetime.now()))
+    def add_request(self, peer_id: bytes, block: Block):
+        now = datetime.datetime.now()
+        self._requests[(peer_id, block)] = now
+        self._by_peer.setdefault(peer_id, set()).add(block)
+        self._by_piece.setdefault(block[0], set()).add((peer_id, block))
+        heapq.heappush(self._by_time, (now, peer_id, block))
+        if len(self._by_time) > 2 * len(self._requests) + 1024:
+            self._rebuild_time_index()
+
+    def _rebuild_time_index(self):
+        self._by_time = [(t, p_id, r) for (p_id, r), t in self._requests.items()]
+        heapq.heapify(self._by_time)
+
+    def _delete(self, peer_id: bytes, block: Block) -> None:
+        del self._requests[(peer_id, block)]
+        peer_blocks = self._by_peer[peer_id]
+        peer_blocks.discard(block)
+        if not peer_blocks:
+            del self._by_peer[peer_id]
+        piece_requests = self._by_piece[block[0]]
+        piece_requests.discard((peer_id, block))
+        if not piece_requests:
+            del self._by_piece[block[0]]
+
+    def request_time(self, peer_id: bytes, block: Block) -> Optional[datetime.datetime]:
+        return self._requests.get((peer_id, block))
+
+    def delete_request(self, peer_id: bytes, block: Block) -> None:
+        if (peer_id, block) in self._requests:
+            self._delete(peer_id, block)
 
     def delete_all_for_piece(self, index: int):
-        to_delete = set((p_id, r, t) for p_id, r, t in self._requests if r[0] == index)
+        to_delete = self._by_piece.get(index, set())
         logger.info(
             "Found {} block requests to delete for piece index {}".format(len(to_delete), index)
         )
-        self._requests = set((p_id, r, t) for p_id, r, t in self._requests if not r[0] == index)
+        for p_id, r in list(to_delete):
+            self._delete(p_id, r)
 
     def delete_all_for_peer(self, peer_id: bytes):
-        self._requests = set((p_id, r, t) for p_id, r, t in self._requests if p_id != peer_id)
+        for r in list(self._by_peer.get(peer_id, set())):
+            self._delete(peer_id, r)
 
     def delete_all(self):
-        self._requests = set()
+        self._requests = dict()
+        self._by_peer = dict()
+        self._by_piece = dict()
+        self._by_time = []
 
     def delete_older_than(self, *, seconds: int) -> int:
-        now = datetime.datetime.now()
-        prev_len = len(self._requests)
-        self._requests = set(
-            (p_id, r, t) for p_id, r, t in self._requests if (now - t).seconds > seconds
-        )
-        new_len = len(self._requests)
-        return prev_len - new_len
+        cutoff = datetime.datetime.now() - datetime.timedelta(seconds=seconds)
+        count = 0
+        while self._by_time and self._by_time[0][0] < cutoff:
+            t, p_id, r = heapq.heappop(self._by_time)
+            # skip entries for requests that were deleted or made again later
+            if self._requests.get((p_id, r)) == t:
+                self._delete(p_id, r)
+                count += 1
+        return count
+
+    def existing_requests_for_peer(self, peer_id: bytes) -> Set[Block]:
+        return set(self._by_peer.get(peer_id, set()))
+
+    def existing_requests_for_piece(self, index: int) -> Set[Block]:
+        return set(r for _, r in self._by_piece.get(index, set()))
+
+    def num_requests_for_peer(self, peer_id: bytes) -> int:
+        return len(self._by_peer.get(peer_id, ()))
+
+    def peers_for_block(self, block: Block) -> List[bytes]:
+        return [p_id for p_id, r in self._by_piece.get(block[0], ()) if r == block]
+
+    def num_requests_for_block(self, block: Block) -> int:
+        return len(self.peers_for_block(block))
 
-    def existing_requests_for_peer(self, peer_id: bytes) -> Set[Tuple[int, int, int]]:
-        return set(r for p_id, r, _ in self._requests if p_id == peer_id)
+    def all_requests(self) -> List[Tuple[bytes, Block, datetime.datetime]]:
+        return [(p_id, r, t) for (p_id, r), t in self._requests.items()]
@@ -0,0 +1,130 @@
+import logging
+from typing import Dict, Optional, Tuple
+
+import trio
+
+import config
+import display
+import engine
+import file_manager
+import metrics
+import peer_connection
+import torrent as state
+
+logger = logging.getLogger("session")
+
+
+class Session(object):
+    """
+    Runs the Engines for many torrents in one trio loop. The torrents
+    share one listening port, the global token buckets for uploads and
+    downloads and the limits on the number of peer connections and dials.
+
+    Incoming connections are handed to the Engine for the info hash in the
+    peer's handshake, so the torrents must all be created with the
+    session's listening port.
+    """
+
+    def __init__(
+        self,
+        listening_port: int,
+        max_connections: int = config.MAX_PEER_CONNECTIONS,
+        metrics_port: Optional[int] = config.METRICS_PORT,
+    ):
+        self._listening_port = listening_port
+        self._metrics_port = metrics_port
+        self._engines: Dict[bytes, Tuple[engine.Engine, file_manager.FileManager]] = dict()
+        self.token_bucket = engine.make_token_bucket()
+        self.download_token_bucket = engine.make_download_token_bucket()
+        self.connection_limiter = trio.CapacityLimiter(max_connections)
+        self.dial_limiter = trio.CapacityLimiter(config.MAX_CONCURRENT_DIALS)
+
+    def __len__(self) -> int:
+        return len(self._engines)
+
+    def add_torrent(self, torrent: state.Torrent, **options) -> engine.Engine:
+        """
+        Open the files for a torrent and create its Engine, the options are
+        passed to engine.make_engine.
+        """
+        if torrent.info_hash in self._engines:
+            raise Exception("Torrent {} is already in the session".format(torrent.name))
+        file_engine, torrent_engine = engine.make_engine(
+            torrent,
+            global_token_bucket=self.token_bucket,
+            global_download_token_bucket=self.download_token_bucket,
+            connection_limiter=self.connection_limiter,
+            dial_limiter=self.dial_limiter,
+            serve_incoming=False,
+            show_display=False,
+            **options
+        )
+        self._engines[torrent.info_hash] = (torrent_engine, file_engine)
+        logger.info("Added {} to the session".format(torrent.name))
+        return torrent_engine
+
+    async def run(self):
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(self.peer_server_loop)
+            nursery.start_soon(self.info_loop)
+            if self._metrics_port is not None:
+                nursery.start_soon(metrics.serve, self._metrics_port)
+            for torrent_engine, file_engine in self._engines.values():
+                nursery.start_soon(file_engine.run)
+                nursery.start_soon(torrent_engine.run)
+
+    async def peer_server_loop(self):
+        await trio.serve_tcp(self.handle_incoming, self._listening_port)
+
+    async def handle_incoming(self, stream):
+        peer_address = None
+        # connections count towards the limit while the handshake is read,
+        # so they can't pile up before we know which torrent they are for
+        token = object()
+        try:
+            self.connection_limiter.acquire_on_behalf_of_nowait(token)
+        except trio.WouldBlock:
+            logger.info("Too many connections, closing incoming connection")
+            await stream.aclose()
+            return
+        try:
+            peer_address = peer_connection.stream_peer_address(stream)
+            logger.debug("Received incoming peer connection from {}".format(peer_address))
+            # read the handshake to find the torrent, the Engine's PeerEngine
+            # checks the rest of it
+            peer_stream = peer_connection.PeerStream(stream)
+            with trio.fail_after(config.PEER_HANDSHAKE_TIMEOUT_SECONDS):
+                handshake = await peer_stream.receive_handshake()
+            info_hash, _ = peer_connection.parse_handshake(handshake)
+            if info_hash not in self._engines:
+                raise peer_connection.HandshakeError("Handshake data: unknown hash", info_hash)
+        except Exception as e:  # TODO this might be too general
+            logger.warning("Failed to accept peer connection because of {}".format(e))
+            self.connection_limiter.release_on_behalf_of(token)
+            await stream.aclose()
+            return
+        torrent_engine, _ = self._engines[info_hash]
+        await torrent_engine.connections.handle_incoming(
+            stream, peer_address, peer_stream=peer_stream, handshake=handshake, limiter_token=token
+        )
+
+    async def info_loop(self):
+        while True:
+            logger.info(
+                "{} torrents, {} peer connections".format(
+                    len(self._engines), self.connection_limiter.borrowed_tokens
+                )
+            )
+            display.print_torrents(
+                [
+                    (
+                        e.torrent.name,
+                        e.torrent._complete,  # TODO remove private access
+                        e.num_peers,
+                        e.download_meter,
+                        e.upload_meter,
+                    )
+                    for e, _ in self._engines.values()
+                ]
+            )
+            await trio.sleep(1)
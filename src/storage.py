@@ -0,0 +1,232 @@
+# Storage backends used by FileWrapper to read and write an open file,
+# and TorrentStorage, which maps offsets in a torrent onto its files.
+#
+# Both backends can be used from several threads at once, as long as
+# the same bytes aren't written concurrently.
+
+import bisect
+import collections
+import logging
+import mmap
+import os
+import threading
+from typing import Any, Dict, List, Tuple
+
+import config
+
+logger = logging.getLogger("storage")
+
+
+class FileStorage(object):
+    """
+    Positional reads and writes on a file descriptor, so there is no
+    shared file offset.
+    """
+
+    def __init__(self, path: str) -> None:
+        self._fd = os.open(path, os.O_RDWR | getattr(os, "O_BINARY", 0))
+
+    def read(self, offset: int, length: int) -> bytes:
+        data = os.pread(self._fd, length, offset)
+        # only a read at the end of the file should be short
+        while len(data) < length:
+            more = os.pread(self._fd, length - len(data), offset + len(data))
+            if not more:
+                break
+            data += more
+        return data
+
+    def write(self, offset: int, data) -> None:
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(self._fd, view, offset)
+            view = view[written:]
+            offset += written
+
+    def flush(self, offset: int, length: int) -> None:
+        # writes already went to the OS
+        pass
+
+    def moved(self, path: str) -> None:
+        # the file descriptor stays valid after the file is renamed
+        pass
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+
+class MmapStorage(object):
+    """
+    The whole file is memory mapped. Reads are slices of the mapping and
+    writes are copied straight into it, without a system call for each
+    block. The file must already have its full size.
+    """
+
+    def __init__(self, path: str) -> None:
+        self._mmap = self._map(path)
+
+    @staticmethod
+    def _map(path: str) -> mmap.mmap:
+        fd = os.open(path, os.O_RDWR | getattr(os, "O_BINARY", 0))
+        try:
+            return mmap.mmap(fd, 0)
+        finally:
+            # the mapping keeps its own reference to the file
+            os.close(fd)
+
+    def read(self, offset: int, length: int) -> bytes:
+        return self._mmap[offset : offset + length]
+
+    def write(self, offset: int, data) -> None:
+        self._mmap[offset : offset + len(data)] = data
+
+    def flush(self, offset: int, length: int) -> None:
+        # msync needs an offset that is a multiple of the page size
+        start = offset - offset % mmap.ALLOCATIONGRANULARITY
+        self._mmap.flush(start, offset + length - start)
+
+    def moved(self, path: str) -> None:
+        # Map the file at its new path. The old mapping isn't closed here,
+        # as another thread may still be reading from it, it is unmapped
+        # once nothing refers to it.
+        self._mmap = self._map(path)
+        logger.info("Remapped {}".format(path))
+
+    def close(self) -> None:
+        self._mmap.close()
+
+
+STORAGE_BACKENDS = {"file": FileStorage, "mmap": MmapStorage}
+
+
+class FileSpans(object):
+    """
+    Offset table for the files of a torrent, treated as one stream of
+    bytes in the order they are listed. Finding the files under a range
+    is a binary search, so it stays cheap with many thousands of files.
+    """
+
+    def __init__(self, lengths: List[int]) -> None:
+        # empty files never hold any bytes, so they aren't in the table
+        self._starts: List[int] = []
+        self._lengths: List[int] = []
+        self._file_indices: List[int] = []
+        offset = 0
+        for i, length in enumerate(lengths):
+            if length > 0:
+                self._starts.append(offset)
+                self._lengths.append(length)
+                self._file_indices.append(i)
+            offset += length
+
+    def segments(self, offset: int, length: int) -> List[Tuple[int, int, int]]:
+        """
+        Returns (file index, offset in file, length) for each file that
+        overlaps the range. A range past the end of the last file is cut
+        short, like a read at the end of a file.
+        """
+        result = []
+        i = bisect.bisect_right(self._starts, offset) - 1
+        while length > 0 and 0 <= i < len(self._starts):
+            file_offset = offset - self._starts[i]
+            n = min(length, self._lengths[i] - file_offset)
+            if n > 0:
+                result.append((self._file_indices[i], file_offset, n))
+                offset += n
+                length -= n
+            i += 1
+        return result
+
+
+class TorrentStorage(object):
+    """
+    Reads and writes at offsets in the torrent, which may be split across
+    several files, using one of STORAGE_BACKENDS for each file. A piece
+    that spans a file boundary is read or written in several parts.
+
+    Files are opened when first used and the least recently used ones are
+    closed once more than max_open_files are open, unless a read or write
+    is still using them.
+    """
+
+    def __init__(
+        self, root: str, files, backend, max_open_files: int = config.MAX_OPEN_FILES
+    ) -> None:
+        self._root = root
+        self._files = files
+        self._backend = backend
+        self._spans = FileSpans([f.length for f in files])
+        self._max_open_files = max_open_files
+        self._open_files: "collections.OrderedDict[int, Any]" = collections.OrderedDict()
+        self._users: Dict[int, int] = collections.Counter()
+        self._lock = threading.Lock()
+
+    def _path(self, file_index: int) -> str:
+        return os.path.join(self._root, *self._files[file_index].path)
+
+    def _acquire(self, file_index: int):
+        with self._lock:
+            f = self._open_files.get(file_index)
+            if f is None:
+                f = self._backend(self._path(file_index))
+                self._open_files[file_index] = f
+                self._users[file_index] += 1
+                self._close_idle_files()
+            else:
+                self._open_files.move_to_end(file_index)
+                self._users[file_index] += 1
+            return f
+
+    def _release(self, file_index: int) -> None:
+        with self._lock:
+            self._users[file_index] -= 1
+
+    def _close_idle_files(self) -> None:
+        # least recently used first
+        for file_index in list(self._open_files):
+            if len(self._open_files) <= self._max_open_files:
+                return
+            if self._users[file_index] == 0:
+                self._open_files.pop(file_index).close()
+
+    def read(self, offset: int, length: int) -> bytes:
+        parts = []
+        for file_index, file_offset, n in self._spans.segments(offset, length):
+            f = self._acquire(file_index)
+            try:
+                parts.append(f.read(file_offset, n))
+            finally:
+                self._release(file_index)
+        # joining a single part doesn't copy it
+        return b"".join(parts)
+
+    def write(self, offset: int, data) -> None:
+        view = memoryview(data)
+        pos = 0
+        for file_index, file_offset, n in self._spans.segments(offset, len(view)):
+            f = self._acquire(file_index)
+            try:
+                f.write(file_offset, view[pos : pos + n])
+            finally:
+                self._release(file_index)
+            pos += n
+
+    def flush(self, offset: int, length: int) -> None:
+        for file_index, file_offset, n in self._spans.segments(offset, length):
+            f = self._acquire(file_index)
+            try:
+                f.flush(file_offset, n)
+            finally:
+                self._release(file_index)
+
+    def moved(self, root: str) -> None:
+        with self._lock:
+            self._root = root
+            for file_index, f in self._open_files.items():
+                f.moved(self._path(file_index))
+
+    def close(self) -> None:
+        with self._lock:
+            while self._open_files:
+                _, f = self._open_files.popitem()
+                f.close()
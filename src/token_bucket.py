@@ -1,42 +1,98 @@
-from collections import deque
 import logging
+from typing import Optional
 
 import trio
 
 logger = logging.getLogger("token_bucket")
 
 
-class NullBucket(object):
-    def __init__(self):
-        pass
-
-    def check_and_decrement(self, _packet_size):
-        return True
+class TokenBucket(object):
+    """
+    Rate limiter for bytes sent (or received). Tokens are added according
+    to the time elapsed since the last refill, rather than by a loop.
 
-    async def loop(self):
-        pass
+    Senders that can't take their tokens wait on a trio.Lock, which wakes
+    them in the order they arrived, so a large message can't be starved by
+    a stream of small ones. Only the sender at the front of the queue
+    sleeps, for exactly as long as its tokens take to arrive.
 
+    Buckets can be nested (e.g. global -> torrent -> peer), bytes have to
+    be taken from a bucket and then from each of its parents. A bucket
+    without a rate doesn't limit anything itself, but still passes the
+    bytes on to its parent.
+    """
 
-class TokenBucket(object):
-    def __init__(self, bytes_per_second, max_size_in_bytes=None, updates_per_second=10):
-        self.bucket = 0
-        self.max_size_in_bytes = max_size_in_bytes if max_size_in_bytes else 2 * bytes_per_second
+    def __init__(
+        self,
+        bytes_per_second: Optional[float],
+        max_size_in_bytes: Optional[int] = None,
+        parent: Optional["TokenBucket"] = None,
+    ) -> None:
         self.bytes_per_second = bytes_per_second
-        self.updates_per_second = updates_per_second
+        if max_size_in_bytes:
+            self.max_size_in_bytes = max_size_in_bytes
+        elif bytes_per_second:
+            self.max_size_in_bytes = 2 * bytes_per_second
+        else:
+            self.max_size_in_bytes = 0
+        self.parent = parent
+        self._tokens = 0.0
+        # set on first use, as trio's clock can only be read inside trio.run
+        self._last_refill: Optional[float] = None
+        self._lock = trio.Lock()
+        self.bytes_taken = 0
+        self.waits = 0
 
     @property
-    def update_period(self):
-        return 1.0 / self.updates_per_second
+    def limited(self) -> bool:
+        return self.bytes_per_second is not None
 
-    def check_and_decrement(self, packet_size):
-        if self.bucket >= packet_size:
-            self.bucket -= packet_size
-            return True
-        else:
-            return False
+    def lowest_rate(self) -> Optional[float]:
+        """
+        The tightest limit on this bucket and its parents, None if none of
+        them are limited.
+        """
+        rates = []
+        bucket: Optional[TokenBucket] = self
+        while bucket is not None:
+            if bucket.limited:
+                rates.append(bucket.bytes_per_second)
+            bucket = bucket.parent
+        return min(rates) if rates else None
+
+    def _refill(self) -> None:
+        now = trio.current_time()
+        if self._last_refill is not None:
+            elapsed = now - self._last_refill
+            self._tokens = min(
+                self._tokens + elapsed * self.bytes_per_second, self.max_size_in_bytes
+            )
+        self._last_refill = now
+
+    async def _take_local(self, num_bytes: int) -> None:
+        async with self._lock:
+            self._refill()
+            if self._tokens < num_bytes:
+                self.waits += 1
+                # A message larger than the bucket can't wait for all its
+                # tokens, it waits for a full bucket and leaves it in debt.
+                needed = min(num_bytes, self.max_size_in_bytes)
+                await trio.sleep((needed - self._tokens) / self.bytes_per_second)
+                self._refill()
+            self._tokens -= num_bytes
+
+    async def take(self, num_bytes: int) -> None:
+        """
+        Wait until num_bytes can be sent, within this bucket's limit and
+        the limits of its parents.
+        """
+        if self.limited:
+            await self._take_local(num_bytes)
+        self.bytes_taken += num_bytes
+        if self.parent is not None:
+            await self.parent.take(num_bytes)
 
-    async def loop(self):
-        while True:
-            await trio.sleep(self.update_period)
-            increment = self.bytes_per_second / self.updates_per_second
-            self.bucket = min(self.bucket + increment, self.max_size_in_bytes)
+    def __repr__(self):
+        return "TokenBucket(bytes_per_second={}, bytes_taken={}, waits={})".format(
+            self.bytes_per_second, self.bytes_taken, self.waits
+        )
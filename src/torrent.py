@@ -18,6 +18,9 @@ logger = logging.getLogger("torrent")
 #
 # d['announce'] -> the url of the tracker
 #
+# d['announce-list'] -> optional list of tiers, each a list of tracker urls
+# (BEP 12), used instead of d['announce'] when present
+#
 # d['info']['name'] -> suggested file or directory name
 #
 # d['info']['pieces'] -> string with length that's a multiple of 20, each 20 byte
@@ -34,6 +37,14 @@ logger = logging.getLogger("torrent")
 
 Piece = NamedTuple("Piece", [("filename", str), ("index", int), ("sha1hash", bytes)])
 
+TrackerUrl = NamedTuple(
+    "TrackerUrl", [("scheme", str), ("address", bytes), ("port", int), ("path", bytes)]
+)
+
+# path is a list of directory and file names relative to Torrent.file_path,
+# it is empty for a single file torrent
+FileInfo = NamedTuple("FileInfo", [("path", List[str]), ("length", int)])
+
 
 def _random_char() -> str:
     # ASCII ranges
@@ -66,6 +77,56 @@ def _parse_pieces(bstring: bytes) -> List[bytes]:
         return l
 
 
+_DEFAULT_TRACKER_PORTS = {"http": 80}
+
+
+def _parse_tracker_url(raw_url: bytes) -> Optional[TrackerUrl]:
+    r = re.compile(r"((?P<scheme>[a-z]+)://)?(?P<address>[^:/]+)(:(?P<port>\d+))?(?P<path>/.*)?")
+    m = r.fullmatch(raw_url.decode(errors="replace"))
+    if not m:
+        return None
+    scheme = m["scheme"] or "http"
+    if m["port"]:
+        port = int(m["port"])
+    elif scheme in _DEFAULT_TRACKER_PORTS:
+        port = _DEFAULT_TRACKER_PORTS[scheme]
+    else:
+        return None
+    return TrackerUrl(scheme, m["address"].encode(), port, (m["path"] or "/").encode())
+
+
+def _parse_trackers(tdict) -> List[List[TrackerUrl]]:
+    if b"announce-list" in tdict:
+        raw_tiers = tdict[b"announce-list"]
+    else:
+        raw_tiers = [[tdict[b"announce"]]]
+    tiers = []
+    for raw_tier in raw_tiers:
+        tier = []
+        for raw_url in raw_tier:
+            url = _parse_tracker_url(raw_url)
+            if url is None:
+                logger.warning("Ignoring tracker url {}".format(raw_url))
+            else:
+                tier.append(url)
+        if tier:
+            # BEP 12: trackers in a tier are tried in a random order
+            random.shuffle(tier)
+            tiers.append(tier)
+    return tiers
+
+
+def _parse_file_path(raw_path: List[bytes]) -> List[str]:
+    path = [bytes.decode(p) for p in raw_path]
+    for p in path:
+        # don't let a torrent write outside of its directory
+        if p in ("", ".", "..") or "/" in p or os.sep in p:
+            raise Exception("Invalid file path in torrent: {}".format(path))
+    if not path:
+        raise Exception("Empty file path in torrent")
+    return path
+
+
 class Torrent(object):
     """
     The Torrent object stores all information about an active torrent.
@@ -85,44 +146,42 @@ class Torrent(object):
         self._uploaded = 0
         self._downloaded = 0
         self._piece_length = int(tdict[b"info"][b"piece length"])
+        # store hash and a bolean to mark if we have the piece or not
+        self._torrent_name = bytes.decode(tdict[b"info"][b"name"])
+        if custom_name:
+            self._filename = os.path.join(directory, custom_name)
+        else:
+            self._filename = os.path.join(directory, self._torrent_name)
+
+        self._pieces = [
+            Piece(self._filename, i, sha1)
+            for i, sha1 in enumerate(_parse_pieces(tdict[b"info"][b"pieces"]))
+        ]
+
         if b"files" in tdict[b"info"]:  # multi-file case
-            raise Exception("multi-file torrents not yet supported")
+            # the files are inside a directory at self._filename
+            self._files = [
+                FileInfo(_parse_file_path(f[b"path"]), int(f[b"length"]))
+                for f in tdict[b"info"][b"files"]
+            ]
         else:  # single file case
-            # store hash and a bolean to mark if we have the piece or not
-            self._torrent_name = bytes.decode(tdict[b"info"][b"name"])
-            if custom_name:
-                self._filename = os.path.join(directory, custom_name)
-            else:
-                self._filename = os.path.join(directory, self._torrent_name)
+            self._files = [FileInfo([], int(tdict[b"info"][b"length"]))]
+        # total length of all the files
+        self._file_length = sum(f.length for f in self._files)
+        self._left = self._file_length
 
-            self._pieces = [
-                Piece(self._filename, i, sha1)
-                for i, sha1 in enumerate(_parse_pieces(tdict[b"info"][b"pieces"]))
-            ]
+        self._num_pieces = len(self._pieces)
+        self._complete = bitarray.bitarray(self._num_pieces)
+        self._complete.setall(False)
 
-            self._file_length = int(tdict[b"info"][b"length"])
-            self._left = self._file_length
-
-            self._num_pieces = len(self._pieces)
-            self._complete = bitarray.bitarray(self._num_pieces)
-            self._complete.setall(False)
-
-        # deconstruct url
-        self._raw_tracker_url = tdict[b"announce"]
-        r = re.compile(r"(?P<http>http://)?(?P<address>.+):(?P<port>\d+)(?P<path>.+)")
-        m = r.fullmatch(self._raw_tracker_url.decode())
-        g = m.groupdict()
-        self._tracker_address = m["address"].encode()
-        self._tracker_port = int(m["port"])
-        self._tracker_path = m["path"].encode()
-        logger.info(
-            "Tracker address: {}, port: {}, path: {}".format(
-                self._tracker_address, self._tracker_port, self._tracker_path
-            )
-        )
+        # tiers of trackers, the tracker that answers is moved to the front
+        # of its tier
+        self._trackers = _parse_trackers(tdict)
+        logger.info("Trackers: {}".format(self._trackers))
 
         # info not from .torrent file
         self._interval = 100
+        self._min_interval: Optional[int] = None
         self._complete_peers = 0
         self._incomplete_peers = 0
 
@@ -133,10 +192,20 @@ class Torrent(object):
         else:
             return DEFAULT_LISTENING_PORT
 
+    @property
+    def name(self) -> str:
+        return self._torrent_name
+
     @property
     def file_path(self):
+        # the file for a single file torrent, or the directory containing
+        # the files for a multi-file torrent
         return self._filename
 
+    @property
+    def files(self) -> List[FileInfo]:
+        return self._files
+
     def piece_length(self, index: int) -> int:
         last_piece = self._num_pieces - 1
         if index < last_piece:
@@ -157,26 +226,36 @@ class Torrent(object):
         return self._interval
 
     @property
-    def tracker_address(self) -> bytes:
-        return self._tracker_address
+    def min_interval(self) -> Optional[int]:
+        return self._min_interval
 
-    @property
-    def tracker_port(self) -> int:
-        return self._tracker_port
+    def update_from_tracker(self, tracker_info) -> None:
+        # tracker_info is a decoded announce response
+        self._interval = int(tracker_info.get(b"interval", self._interval))
+        if b"min interval" in tracker_info:
+            self._min_interval = int(tracker_info[b"min interval"])
+        self._complete_peers = int(tracker_info.get(b"complete", self._complete_peers))
+        self._incomplete_peers = int(tracker_info.get(b"incomplete", self._incomplete_peers))
 
     @property
-    def tracker_path(self):
-        return self._tracker_path
+    def trackers(self) -> List[List[TrackerUrl]]:
+        return self._trackers
 
     @property
-    def uploaded(self):
-        # TODO this needs to update while we run
-        return 0
+    def uploaded(self) -> int:
+        # bytes of piece data sent to peers
+        return self._uploaded
+
+    def add_uploaded(self, num_bytes: int) -> None:
+        self._uploaded += num_bytes
 
     @property
-    def downloaded(self):
-        # TODO this needs to update while we run
-        return 0
+    def downloaded(self) -> int:
+        # bytes of piece data received from peers
+        return self._downloaded
+
+    def add_downloaded(self, num_bytes: int) -> None:
+        self._downloaded += num_bytes
 
     @property
     def left(self):
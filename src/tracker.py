@@ -1,11 +1,15 @@
-import io
 import logging
+import random
+import socket
+import struct
+from typing import Dict, Tuple
 from urllib import parse as urllib_parse  # hack to fix mypy warning
 
 import h11
 import trio
 
 import bencode
+import config
 import http_stream
 
 logger = logging.getLogger("tracker")
@@ -15,7 +19,11 @@ def _int2bytes(i: int) -> bytes:
     return b"%d" % i
 
 
-def tracker_request(torrent, event) -> h11.Request:
+class TrackerError(Exception):
+    pass
+
+
+def tracker_request(torrent, url, event) -> h11.Request:
     """
     Tracker request is an http GET request, sent with parameters telling
     the tracker about your client.
@@ -30,9 +38,8 @@ def tracker_request(torrent, event) -> h11.Request:
         b"downloaded": _int2bytes(torrent.downloaded),
         b"left": _int2bytes(torrent.left)
         # , b'event': event
-        # , b'compact': b'1'
         ,
-        b"compact": b"0"
+        b"compact": b"1"
         # testing
         # , b'supportcrypto': b'1'
         # , b'key': b'71c04610'
@@ -41,8 +48,8 @@ def tracker_request(torrent, event) -> h11.Request:
     if event:
         d[b"event"] = event
     params = b"&".join([k + b"=" + v for k, v in d.items()])
-    path = torrent.tracker_path + b"?" + params
-    host = torrent.tracker_address + b":" + str(torrent.tracker_port).encode()
+    path = url.path + b"?" + params
+    host = url.address + b":" + str(url.port).encode()
     headers = [
         ("Host", host),
         ("Accept-Encoding", "gzip;q=1.0, deflate, identity"),
@@ -53,19 +60,154 @@ def tracker_request(torrent, event) -> h11.Request:
     return r
 
 
-async def query(torrent, event) -> bytes:
-    url: bytes = torrent.tracker_address
-    port: bytes = torrent.tracker_port
-    logger.debug("url/port = {}/{}".format(url, port))
+async def query(torrent, url, event) -> bytes:
+    logger.debug("url/port = {}/{}".format(url.address, url.port))
     stream = await trio.open_tcp_stream(
-        url.decode("ascii"), port
+        url.address.decode("ascii"), url.port
     )  # TODO fix hack with string/bytes issue
     logger.debug("Opened raw stream")
     h = http_stream.Http_stream(stream, h11.CLIENT)
     logger.debug("Created Http_stream")
 
-    await h.send_event(tracker_request(torrent, event))
-    await h.send_event(h11.EndOfMessage())
+    try:
+        await h.send_event(tracker_request(torrent, url, event))
+        await h.send_event(h11.EndOfMessage())
 
-    response, data = await h.receive_with_data()
+        response, data = await h.receive_with_data()
+    finally:
+        await h.close()
+    if response.status_code != 200:
+        raise TrackerError("HTTP status {}".format(response.status_code))
     return b"".join(d.data for d in data)
+
+
+# ----- UDP trackers (BEP 15) --------------------------------------------------
+#
+# Each announce is two small datagrams: a connect request returns a
+# connection id, which is then sent with the announce. Connection ids are
+# cached for a minute and shared by all torrents using the tracker.
+
+UDP_PROTOCOL_ID = 0x41727101980
+UDP_CONNECT = 0
+UDP_ANNOUNCE = 1
+UDP_ERROR = 3
+UDP_EVENTS = {None: 0, b"completed": 1, b"started": 2, b"stopped": 3}
+# a connection id can be used for a minute after the tracker sends it
+UDP_CONNECTION_ID_SECONDS = 60
+
+# identifies this client to trackers if its address changes
+_udp_key = random.getrandbits(32)
+# (address, port) -> (connection id, time it was received)
+_udp_connection_ids: Dict[Tuple[bytes, int], Tuple[int, float]] = dict()
+
+
+async def _udp_request(sock, request: bytes, transaction_id: int, action: int) -> bytes:
+    # Send the request and wait for the matching response, sending it again
+    # if there's no answer, with the wait doubling each time.
+    timeout = config.UDP_TRACKER_RETRANSMIT_SECONDS
+    for attempt in range(config.UDP_TRACKER_ATTEMPTS):
+        await sock.send(request)
+        with trio.move_on_after(timeout):
+            while True:
+                response = await sock.recv(config.UDP_TRACKER_MAX_DATAGRAM)
+                if len(response) < 8:
+                    continue
+                response_action, response_transaction_id = struct.unpack_from("!II", response)
+                if response_transaction_id != transaction_id:
+                    # a late answer to an earlier attempt
+                    continue
+                if response_action == UDP_ERROR:
+                    raise TrackerError(response[8:].decode(errors="replace"))
+                if response_action != action:
+                    raise TrackerError("Unexpected UDP tracker action {}".format(response_action))
+                return response
+        logger.debug("No answer from UDP tracker after {}s (attempt {})".format(timeout, attempt))
+        timeout *= 2
+    raise TrackerError("No answer from UDP tracker")
+
+
+async def _udp_connection_id(sock, url) -> int:
+    key = (url.address, url.port)
+    cached = _udp_connection_ids.get(key)
+    if cached and trio.current_time() - cached[1] < UDP_CONNECTION_ID_SECONDS:
+        return cached[0]
+    transaction_id = random.getrandbits(32)
+    request = struct.pack("!QII", UDP_PROTOCOL_ID, UDP_CONNECT, transaction_id)
+    response = await _udp_request(sock, request, transaction_id, UDP_CONNECT)
+    if len(response) < 16:
+        raise TrackerError("UDP connect response too short")
+    (connection_id,) = struct.unpack_from("!Q", response, 8)
+    _udp_connection_ids[key] = (connection_id, trio.current_time())
+    return connection_id
+
+
+def udp_announce_request(torrent, connection_id: int, transaction_id: int, event) -> bytes:
+    return struct.pack(
+        "!QII20s20sQQQIIIiH",
+        connection_id,
+        UDP_ANNOUNCE,
+        transaction_id,
+        torrent.info_hash,
+        torrent.peer_id,
+        torrent.downloaded,
+        torrent.left,
+        torrent.uploaded,
+        UDP_EVENTS[event],
+        0,  # IP address, 0 means the one the request came from
+        _udp_key,
+        -1,  # number of peers wanted, -1 lets the tracker choose
+        torrent.listening_port,
+    )
+
+
+async def udp_announce(torrent, url, event) -> dict:
+    """
+    Announce to a udp:// tracker. The response is returned in the same form
+    as a decoded HTTP response with compact peers.
+    """
+    addresses = await trio.socket.getaddrinfo(url.address, url.port, type=socket.SOCK_DGRAM)
+    if not addresses:
+        raise TrackerError("Could not resolve {}".format(url.address))
+    family, sock_type, proto, _, address = addresses[0]
+    with trio.socket.socket(family, sock_type, proto) as sock:
+        await sock.connect(address)
+        try:
+            connection_id = await _udp_connection_id(sock, url)
+            transaction_id = random.getrandbits(32)
+            request = udp_announce_request(torrent, connection_id, transaction_id, event)
+            response = await _udp_request(sock, request, transaction_id, UDP_ANNOUNCE)
+        except TrackerError:
+            # the connection id may have expired on the tracker
+            _udp_connection_ids.pop((url.address, url.port), None)
+            raise
+    if len(response) < 20:
+        raise TrackerError("UDP announce response too short")
+    interval, leechers, seeders = struct.unpack_from("!III", response, 8)
+    # the peers are in the address family of the socket the tracker answered
+    peers_key = b"peers6" if family == socket.AF_INET6 else b"peers"
+    entry_size = 18 if family == socket.AF_INET6 else 6
+    peers = response[20:]
+    return {
+        b"interval": interval,
+        b"incomplete": leechers,
+        b"complete": seeders,
+        peers_key: peers[: len(peers) - len(peers) % entry_size],
+    }
+
+
+async def announce(torrent, url, event) -> dict:
+    """
+    Announce to one tracker and return its decoded response, raises
+    TrackerError if the tracker reports a failure.
+    """
+    if url.scheme == "udp":
+        return await udp_announce(torrent, url, event)
+    if url.scheme != "http":
+        raise TrackerError("Unsupported tracker protocol: {}".format(url.scheme))
+    raw_tracker_info = await query(torrent, url, event)
+    tracker_info = bencode.decode(raw_tracker_info)
+    if not isinstance(tracker_info, dict):
+        raise TrackerError("Response is not a dictionary")
+    if b"failure reason" in tracker_info:
+        raise TrackerError(tracker_info[b"failure reason"].decode(errors="replace"))
+    return tracker_info
@@ -0,0 +1,94 @@
+# A small UDP tracker (BEP 15) for testing and benchmarking the UDP
+# tracker client without a real tracker. It hands out the same peer
+# list to everyone and keeps no swarm state.
+#
+# usage: python udp_tracker_server.py PORT [PEER_PORT ...]
+
+import logging
+import random
+import socket
+import struct
+import sys
+from typing import Dict, List, Tuple
+
+import trio
+
+import config
+import tracker
+
+logger = logging.getLogger("udp_tracker_server")
+
+
+class UdpTrackerServer(object):
+    def __init__(
+        self,
+        peers: List[Tuple[str, int]],
+        interval: int = 1800,
+        drop_every: int = 0,
+        connection_id_seconds: float = 120,
+    ) -> None:
+        self._compact_peers = b"".join(
+            socket.inet_aton(ip) + struct.pack("!H", port) for ip, port in peers
+        )
+        self._interval = interval
+        # ignore every nth datagram, to exercise the client's retransmits
+        self._drop_every = drop_every
+        self._connection_id_seconds = connection_id_seconds
+        # connection id -> time it expires
+        self._connection_ids: Dict[int, float] = dict()
+        self.received = 0
+        self.connects = 0
+        self.announces: List[Tuple[bytes, int]] = []
+
+    def _error(self, transaction_id: int, message: bytes) -> bytes:
+        return struct.pack("!II", tracker.UDP_ERROR, transaction_id) + message
+
+    def handle(self, data: bytes) -> bytes:
+        """
+        Return the response to one request datagram.
+        """
+        if len(data) < 16:
+            return b""
+        connection_id, action, transaction_id = struct.unpack_from("!QII", data)
+        now = trio.current_time()
+        if action == tracker.UDP_CONNECT:
+            if connection_id != tracker.UDP_PROTOCOL_ID:
+                return self._error(transaction_id, b"bad protocol id")
+            self.connects += 1
+            new_connection_id = random.getrandbits(64)
+            self._connection_ids[new_connection_id] = now + self._connection_id_seconds
+            return struct.pack("!IIQ", tracker.UDP_CONNECT, transaction_id, new_connection_id)
+        if self._connection_ids.get(connection_id, 0) < now:
+            return self._error(transaction_id, b"unknown connection id")
+        if action == tracker.UDP_ANNOUNCE:
+            if len(data) < 98:
+                return self._error(transaction_id, b"announce too short")
+            info_hash = data[16:36]
+            (event,) = struct.unpack_from("!I", data, 80)
+            self.announces.append((info_hash, event))
+            return (
+                struct.pack("!IIIII", tracker.UDP_ANNOUNCE, transaction_id, self._interval, 0, 1)
+                + self._compact_peers
+            )
+        return self._error(transaction_id, b"unsupported action")
+
+    async def serve(self, port: int, host: str = "127.0.0.1", task_status=trio.TASK_STATUS_IGNORED):
+        sock = trio.socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        with sock:
+            await sock.bind((host, port))
+            logger.info("UDP tracker listening on {}".format(sock.getsockname()))
+            task_status.started(sock.getsockname()[1])
+            while True:
+                data, address = await sock.recvfrom(config.UDP_TRACKER_MAX_DATAGRAM)
+                self.received += 1
+                if self._drop_every and self.received % self._drop_every == 0:
+                    continue
+                response = self.handle(data)
+                if response:
+                    await sock.sendto(response, address)
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1])
+    peers = [("127.0.0.1", int(p)) for p in sys.argv[2:]]
+    trio.run(UdpTrackerServer(peers).serve, port)